@@ -0,0 +1,42 @@
+"""
+Benchmark of the vectorized spatial information bootstrapping (place_cell_pipeline.get_spatial_info) on a synthetic
+session with 500 cells. Run from the 'custom scripts' directory.
+"""
+from timeit import default_timer as timer
+import numpy as np
+from standard_pipeline import place_cell_pipeline as pipe
+
+N_CELLS = 500
+N_TRIALS = 30
+N_BOOTSTRAP = 2000
+SAMPLES_PER_FRAME = 67       # 2 kHz behavior sampling, 30 Hz imaging
+
+rng = np.random.default_rng(0)
+
+# behavior arrays: position runs from -10 to 110 cm, encoder column shows movement during most frames
+behavior = []
+for trial in range(N_TRIALS):
+    n_samples = int(rng.integers(40000, 60000))
+    beh = np.zeros((n_samples, 5))
+    beh[:, 1] = np.linspace(-10, 110, n_samples)
+    beh[::SAMPLES_PER_FRAME, 3] = 1
+    beh[:, 4] = -rng.integers(0, 3, n_samples)
+    for stop in rng.integers(0, n_samples - 2000, 20):
+        beh[stop:stop + 2000, 4] = 0                                          # stationary periods
+    behavior.append(beh)
+n_frames = int(np.sum([np.nansum(beh[:, 3]) for beh in behavior]))
+
+# spike probabilities: sparse background activity, half of the cells with a place field
+data = rng.exponential(0.5, (n_frames, N_CELLS)) * (rng.random((n_frames, N_CELLS)) < 0.05)
+field_frames = (np.arange(n_frames) % (n_frames // N_TRIALS)) < 60
+data[np.ix_(field_frames, np.arange(0, N_CELLS, 2))] += rng.exponential(1, (np.sum(field_frames), N_CELLS // 2))
+
+print(f'Session: {N_CELLS} cells, {N_TRIALS} trials, {n_frames} frames, {N_BOOTSTRAP} bootstraps')
+start = timer()
+si = pipe.get_spatial_info(data, behavior, n_bootstrap=0)
+print(f'\nRaw spatial information: {timer() - start:.2f} s')
+
+start = timer()
+si_norm = pipe.get_spatial_info(data, behavior, n_bootstrap=N_BOOTSTRAP, seed=0)
+print(f'\nSpatial information with bootstrapping: {timer() - start:.2f} s')
+print(f'Significant cells (p < 0.05): {np.sum(si_norm[:, 1] < 0.05)} / {N_CELLS}')
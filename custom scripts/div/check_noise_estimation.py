@@ -0,0 +1,63 @@
+"""
+Regression check of the headless noise estimation (standard_pipeline/noise_estimation.py) against the former
+seaborn-based PlaceCellFinder.get_noise_fwhm() on synthetic dF/F traces (Gaussian noise with calcium transients).
+kde_fwhm() has to reproduce the sigma of the sns.distplot() density within RTOL. Run from the 'custom scripts'
+directory.
+"""
+from timeit import default_timer as timer
+import warnings
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import seaborn as sns
+from standard_pipeline import noise_estimation as noise
+
+N_TRACES = 50
+N_FRAMES = 3000
+RTOL = 1e-6
+
+rng = np.random.default_rng(0)
+warnings.simplefilter('ignore', UserWarning)        # distplot deprecation
+warnings.simplefilter('ignore', FutureWarning)
+
+
+def get_noise_fwhm_seaborn(data):
+    """ Former PlaceCellFinder.get_noise_fwhm(), with the density taken from the line drawn by sns.distplot(). """
+    if np.all(data == 0):  # catch trials without data
+        sigma = 0
+    else:
+        plt.figure()
+        x_data, y_data = sns.distplot(data).get_lines()[0].get_data()
+        y_max = y_data.argmax()  # get idx of half maximum
+        nearest_above = (np.abs(y_data[y_max:] - max(y_data) / 2)).argmin()
+        nearest_below = (np.abs(y_data[:y_max] - max(y_data) / 2)).argmin()
+        fwhm = x_data[nearest_above + y_max] - x_data[nearest_below]
+        sigma = fwhm/2.3548
+        plt.close()
+    return sigma
+
+
+# Gaussian noise with different levels, plus exponentially decaying transients at random onsets
+true_sigma = rng.uniform(0.02, 0.3, N_TRACES)
+traces = rng.normal(0, 1, (N_TRACES, N_FRAMES)) * true_sigma[:, np.newaxis]
+kernel = np.exp(-np.arange(60) / 15)
+for trace in traces:
+    onsets = np.zeros(N_FRAMES)
+    onsets[rng.integers(0, N_FRAMES, rng.integers(0, 30))] = rng.uniform(0.5, 2)
+    trace += np.convolve(onsets, kernel)[:N_FRAMES]
+traces[0] = 0                                       # trial without data
+
+start = timer()
+sigma_old = np.array([get_noise_fwhm_seaborn(trace) for trace in traces])
+time_old = timer() - start
+
+start = timer()
+sigma_new = noise.kde_fwhm(traces)
+time_new = timer() - start
+
+np.testing.assert_allclose(sigma_new, sigma_old, rtol=RTOL)
+np.testing.assert_allclose(noise.get_noise_level(traces[1]), sigma_old[1], rtol=RTOL)   # default method, 1D input
+rel_diff = np.abs(sigma_new[1:] - sigma_old[1:]) / sigma_old[1:]
+print(f'{N_TRACES} traces: max relative sigma difference {np.max(rel_diff):.2e} (tolerance {RTOL:.0e})')
+print(f'seaborn: {time_old:.2f} s, kde_fwhm: {time_new:.3f} s')
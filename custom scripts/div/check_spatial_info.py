@@ -0,0 +1,125 @@
+"""
+Numerical check of the shared Skaggs SI kernel (standard_pipeline/si_kernel.py) against the former per-cell loop
+implementations of the three call sites, on synthetic data with empty position bins and silent cells:
+    - PlaceCellFinder.get_spatial_information (natural log, silent bins contribute 0)
+    - place_cell_pipeline.si_formula (log2, firing rate per second, silent bins are ignored)
+    - compute_si.spatial_info.compute_spatial_info (log2, Gaussian smoothing, silent bins propagate)
+Run from the 'custom scripts' directory.
+"""
+import warnings
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from standard_pipeline import si_kernel
+
+N_CELLS = 200
+N_SAMPLES = 20000
+N_BINS = 80
+SIGMA = 1
+
+rng = np.random.default_rng(0)
+warnings.simplefilter('ignore', RuntimeWarning)     # empty bins and silent cells in the old loops
+
+
+def pcf_si_loop(data, idx, n_bins):
+    """ Former loop of PlaceCellFinder.get_spatial_information. """
+    unique_elements, counts_elements = np.unique(idx, return_counts=True)
+    bin_freq = np.array([x / np.sum(counts_elements) for x in counts_elements])
+    bin_mean_act = np.zeros((n_bins, data.shape[1]))
+    for bin_nr in range(n_bins):
+        curr_bin_idx = np.where(idx == bin_nr + 1)[0]
+        bin_mean_act[bin_nr, :] = np.mean(data[curr_bin_idx], axis=0)
+    total_firing_rate = np.mean(data, axis=0)
+    spatial_info = np.zeros(len(total_firing_rate))
+    for cell in range(len(total_firing_rate)):
+        curr_trace = bin_mean_act[:, cell]
+        tot_act = total_firing_rate[cell]
+        bin_si = np.zeros(n_bins)
+        for i in range(n_bins):
+            if curr_trace[i] <= 0 or tot_act <= 0:
+                bin_si[i] = 0
+            else:
+                bin_si[i] = curr_trace[i] / tot_act * np.log(curr_trace[i] / tot_act) * bin_freq[i]
+        spatial_info[cell] = np.sum(bin_si)
+    return spatial_info
+
+
+def pipeline_si_loop(data, idx, n_bins):
+    """ Former loop of place_cell_pipeline.si_formula. """
+    unique_elements, counts_elements = np.unique(idx, return_counts=True)
+    bin_freq = np.array([x / np.sum(counts_elements) for x in counts_elements])
+    bin_mean_act = np.zeros((n_bins, data.shape[1]))
+    for bin_nr in range(n_bins):
+        curr_bin_idx = np.where(idx == bin_nr + 1)[0]
+        bin_act = data[curr_bin_idx]
+        bin_mean_act[bin_nr, :] = np.sum(bin_act, axis=0) / (bin_act.shape[0] / 30)
+    total_firing_rate = np.sum(data, axis=0) / (data.shape[0] / 30)
+    spatial_info = np.zeros(len(total_firing_rate))
+    for cell in range(len(total_firing_rate)):
+        curr_trace = bin_mean_act[:, cell]
+        tot_act = total_firing_rate[cell]
+        bin_si = np.zeros(n_bins)
+        for i in range(n_bins):
+            if curr_trace[i] <= 0 or tot_act <= 0:
+                bin_si[i] = np.nan
+            else:
+                bin_si[i] = curr_trace[i] * np.log2(curr_trace[i] / tot_act) * bin_freq[i]
+        if np.all(np.isnan(bin_si)):
+            spatial_info[cell] = np.nan
+        else:
+            spatial_info[cell] = np.nansum(bin_si)
+    return spatial_info
+
+
+def compute_si_old(act_map, occupancy, sigma):
+    """ Former compute_si.spatial_info.compute_spatial_info. """
+    p_occ = np.sum(occupancy, axis=0) / np.sum(occupancy)
+    p_occ = p_occ[None, :]
+    act_bin = np.mean(gaussian_filter1d(act_map, sigma, axis=1), axis=2)
+    act_rel = act_bin.T / np.sum(p_occ * act_bin, axis=1)
+    return np.sum(p_occ * act_rel.T * np.log2(act_rel.T), axis=1)
+
+
+def check(name, old, new):
+    np.testing.assert_allclose(new, old, rtol=1e-10, atol=1e-12, equal_nan=True)
+    print(f'{name}: {np.sum(np.isfinite(old))} finite / {np.sum(np.isnan(old))} NaN cells match')
+
+
+# Sparse activity with place fields, plus silent cells and cells that are only active in a few bins
+data = rng.exponential(0.5, (N_SAMPLES, N_CELLS)) * (rng.random((N_SAMPLES, N_CELLS)) < 0.05)
+position = np.tile(np.linspace(-10, 110, N_SAMPLES // 10), 10)
+data[np.ix_(position < 20, np.arange(0, N_CELLS, 3))] += 1
+data[:, :10] = 0
+data[:, 10:20] *= (position > 90)[:, np.newaxis]
+
+# Empty bin: samples of bin 30 are moved below the track (label 0), so the occupancy still has one entry per bin, as
+# required by the old loops (they raise an IndexError if fewer labels than bins are occupied)
+borders = np.linspace(-10, 110, N_BINS)
+empty_pos = np.where(np.digitize(position, borders) == 30, -10.5, position)
+
+for label, pos in (('full track', position), ('empty bin', empty_pos)):
+    # PlaceCellFinder: fixed bin borders from -10 to 110 cm
+    idx = np.digitize(pos, borders)
+    new = si_kernel.skaggs_si(si_kernel.bin_activity(data, idx, N_BINS),
+                              si_kernel.bin_occupancy(idx, N_BINS, rank_order=True), mean_act=np.mean(data, axis=0),
+                              log_base=np.e, normalize=True, invalid='zero')
+    check(f'PCF ({label})', pcf_si_loop(data, idx, N_BINS), new)
+
+    # place_cell_pipeline: bin borders from position range, firing rate per second
+    idx = np.digitize(pos, np.linspace(int(min(pos)), int(max(pos)), N_BINS))
+    new = si_kernel.skaggs_si(si_kernel.bin_activity(data, idx, N_BINS) * 30,
+                              si_kernel.bin_occupancy(idx, N_BINS, rank_order=True),
+                              mean_act=np.sum(data, axis=0) / (data.shape[0] / 30), log_base=2, normalize=False,
+                              invalid='nan')
+    check(f'Pipeline ({label})', pipeline_si_loop(data, idx, N_BINS), new)
+
+# compute_si: trial-wise activity maps (n_cells, n_bins, n_trials), some bins never visited in any trial
+n_trials = 10
+occupancy = [rng.integers(5, 30, N_BINS) for _ in range(n_trials)]
+for trial_occ in occupancy:
+    trial_occ[40:45] = 0
+act_map = rng.exponential(1, (N_CELLS, N_BINS, n_trials)) * (rng.random((N_CELLS, N_BINS, n_trials)) < 0.3)
+act_map[:10] = 0
+act_map[:, 40:45] = 0
+new = si_kernel.skaggs_si(np.mean(act_map, axis=2), np.sum(occupancy, axis=0) / np.sum(occupancy), log_base=2,
+                          normalize=True, sigma=SIGMA)
+check('compute_si', compute_si_old(act_map, occupancy, SIGMA), new)
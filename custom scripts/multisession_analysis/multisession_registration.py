@@ -6,20 +6,18 @@ from caiman.utils import visualization
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as grid
-from skimage.registration import phase_cross_correlation
+from matplotlib.collections import LineCollection
 from math import ceil
 from scipy.ndimage import zoom
+from scipy import fft
+from scipy.spatial import cKDTree
 import os
 import pandas as pd
 from div import file_manager as fm
 from copy import deepcopy
+import shutil
 import tifffile as tiff
 
-try:
-    from point2d import Point2D
-except ModuleNotFoundError:
-    print('Could not import point2d, multisession_registration.py might not work.')
-
 #%% LOADING AND AUTOMATICALLY ALIGNING MULTISESSION DATA
 
 
@@ -133,68 +131,118 @@ def plot_all_cells_multisession(direct_list, spatial_list, template_list):
 
 def save_alignment(directory, align_array, ref_sess_date, pcf_list, place_cell_mode=True):
     """
-    Saves manual alignment array to a txt file with session dates as headers for each column. NaNs (no match found)
-    are replaced by -10 to maintain visibility.
+    Saves manual alignment array as a binary alignment table (.npz) in the given directory. The table holds the integer
+    neuron IDs with shape (n_placecells, n_sessions), where -1 marks cells without a match (NaN) or not yet aligned, as
+    well as the session dates, the reference session of every row and the mouse ID (see read_alignment_file()). The
+    boolean 'aligned' mask keeps "no match" and "not yet aligned" (-1) apart, so that a partly aligned table can be
+    resumed with load_alignment_array().
+    :param directory: str, path to the directory where the table is saved
     :param align_array: data array, shape (n_placecells, n_sessions), from manual_place_cell_alignment()
     :param ref_sess_date: str, date of reference session (where place cells are from)
-    :param pcf_list: list of paths to session folders
+    :param pcf_list: list of PCF objects (or CNM objects if place_cell_mode=False) of all aligned sessions
     :param place_cell_mode: bool flag whether to load PCF objects or CNM objects (for Jithin)
     :return:
     """
-    sess_dates = []
-    header = 'Neur_ID_'
     if place_cell_mode:
         mouse = pcf_list[0].params["mouse"]
-        for pcf in pcf_list:
-            sess_dates.append(pcf.params['session'])
-            header = header + f'{pcf.params["session"]}\t'
+        sess_dates = [pcf.params['session'] for pcf in pcf_list]
     else:
         mouse = pcf_list[0].mmap_file.split(sep=os.path.sep)[-3]
-        for cnm in pcf_list:
-            sess_dates.append(cnm.mmap_file.split(sep=os.path.sep)[-4])
-            header = header + f'{cnm.mmap_file.split(sep=os.path.sep)[-4]}\t'
-    file_name = f'pc_alignment_{mouse}_{ref_sess_date}.txt'
+        sess_dates = [cnm.mmap_file.split(sep=os.path.sep)[-4] for cnm in pcf_list]
+    file_name = f'pc_alignment_{mouse}_{ref_sess_date}.npz'
     file_path = os.path.join(directory, file_name)
     if os.path.isfile(file_path):
         answer = None
         while answer not in ("y", "n", 'yes', 'no'):
             answer = input(f"File [...]{file_path[-40:]} already exists!\nOverwrite? [y/n] ")
-            if answer == "yes" or answer == 'y':
-                print(f'Saving alignment table to {file_path}...')
-                align_fix = np.nan_to_num(align_array, nan=-10).astype('int')
-                np.savetxt(file_path, align_fix, delimiter='\t', header=header, fmt='%d')
-            elif answer == "no" or answer == 'n':
+            if answer == "no" or answer == 'n':
                 print('Saving cancelled.')
                 return None
-            else:
+            elif answer != "yes" and answer != 'y':
                 print("Please enter yes/y or no/n.")
-    else:
-        print(f'Saving alignment table to {file_path}...')
-        align_fix = np.nan_to_num(align_array, nan=-10).astype('int')
-        np.savetxt(file_path, align_fix, delimiter='\t', header=header, fmt='%d')
 
+    print(f'Saving alignment table to {file_path}...')
+    align_array = np.asarray(align_array, dtype=float)
+    cells = np.where(np.isnan(align_array) | (align_array < 0), -1, align_array).astype(np.int64)
+    np.savez(file_path, cells=cells, aligned=align_array != -1, sessions=np.array(sess_dates, dtype=str),
+             ref_dates=np.full(len(cells), str(ref_sess_date)), mouse=np.array(str(mouse)))
 
-def load_alignment(file_paths):
+
+def convert_alignment_txt(file_path, save=False):
     """
-    Loads one or more alignment.txt files from the list in a Pandas DataFrame
-    :param file_paths: list of alignment.txt files (from save_alignment())
-    :return: Pandas Dataframe with all aligned cells from all text files
+    Converts an old tab-separated alignment.txt file into the binary alignment table format. Unmatched (-10) and not
+    aligned (-1) cells are both marked with -1 and told apart by the 'aligned' mask. Mouse ID and reference session are
+    taken from the file name (pc_alignment_{mouse}_{ref_date}.txt).
+    :param file_path: str, path to the alignment.txt file
+    :param save: bool flag whether the table should be saved as .npz file next to the text file
+    :return: dict with the alignment table, same format as read_alignment_file()
     """
-    cell_list = [np.loadtxt(x) for x in file_paths]
-    with open(file_paths[0]) as file:
+    with open(file_path) as file:
         dates = file.readline().strip().split('\t')
         dates[0] = dates[0].split('_')[-1]
-    dates.insert(0, 'ref_date')
-    dtypes = [[x, 'float64'] for x in dates]
-    dtypes[0][1] = 'int32'
-    dtypes = dict(dtypes)
-    ref_dates = [os.path.splitext(os.path.split(x)[1])[0].split('_')[-1] for x in file_paths]
-    ref_idx = []
-    for i in range(len(cell_list)):
-        ref_idx.extend([ref_dates[i]]*len(cell_list[i]))
-    ref_idx = np.array(ref_idx)[..., np.newaxis]
-    df = pd.DataFrame(np.hstack((ref_idx, np.vstack(cell_list))), columns=dates)
-    return df.astype(dtypes)
+    cells = np.loadtxt(file_path, ndmin=2).astype(np.int64)
+    aligned = cells != -1
+    cells[cells < 0] = -1
+    name_parts = os.path.splitext(os.path.split(file_path)[1])[0].split('_')
+    table = dict(cells=cells, aligned=aligned, sessions=np.array(dates, dtype=str), ref_dates=np.full(len(cells), name_parts[-1]),
+                 mouse=np.array(name_parts[-2] if len(name_parts) > 3 else ''))
+    if save:
+        np.savez(os.path.splitext(file_path)[0] + '.npz', **table)
+    return table
+
+
+def read_alignment_file(file_path):
+    """
+    Reads a single alignment table. Binary tables (.npz, from save_alignment()) are loaded directly, old text files
+    (.txt) are converted with convert_alignment_txt().
+    :param file_path: str, path to the alignment file
+    :return: dict with keys 'cells' (int np.array with shape (n_cells, n_sessions), neuron ID of every cell in every
+            session, -1 if the cell was not found), 'aligned' (bool np.array with the same shape, False if the cell has
+            not been aligned yet), 'sessions' (session dates), 'ref_dates' (reference session of every cell) and
+            'mouse' (mouse ID)
+    """
+    if os.path.splitext(file_path)[1] == '.txt':
+        return convert_alignment_txt(file_path)
+    with np.load(file_path) as file:
+        table = {key: file[key] for key in ('cells', 'sessions', 'ref_dates', 'mouse')}
+        # tables saved without 'aligned' mask: all missing cells are treated as not aligned
+        table['aligned'] = file['aligned'] if 'aligned' in file.files else table['cells'] != -1
+    return table
+
+
+def load_alignment_array(file_path):
+    """
+    Loads a single (partly) aligned table back into the alignment array format of manual_place_cell_alignment(), to
+    pick up the alignment where it was left.
+    :param file_path: str, path to the alignment file (.npz from save_alignment() or old alignment.txt file)
+    :return: np.array with shape (n_placecells, n_sessions) with the neuron IDs, NaN for cells without a match and -1
+            for cells that have not been aligned yet
+    """
+    table = read_alignment_file(file_path)
+    alignment = table['cells'].astype(float)
+    alignment[table['aligned'] & (table['cells'] < 0)] = np.nan
+    alignment[~table['aligned']] = -1
+    return alignment
+
+
+def load_alignment(file_paths):
+    """
+    Loads one or more alignment tables (.npz from save_alignment() or old alignment.txt files) in a Pandas DataFrame
+    :param file_paths: str or list of str, paths to the alignment files. All tables have to contain the same sessions.
+    :return: Pandas Dataframe with all aligned cells from all files. Column 'ref_date' holds the reference session of
+            each cell, the other columns hold the neuron ID in each session (-1 if the cell was not found).
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    tables = [read_alignment_file(x) for x in file_paths]
+    dates = list(tables[0]['sessions'])
+    for path, table in zip(file_paths, tables):
+        if list(table['sessions']) != dates:
+            raise ValueError(f'Sessions of {path} do not match sessions of {file_paths[0]}.')
+
+    df = pd.DataFrame(np.vstack([x['cells'] for x in tables]), columns=dates)
+    df.insert(0, 'ref_date', np.concatenate([x['ref_dates'] for x in tables]).astype('int32'))
+    return df
 
 
 def align_traces(mousepath, alignment, ignore=None):
@@ -202,7 +250,8 @@ def align_traces(mousepath, alignment, ignore=None):
     Load PCF objects of the sessions that were aligned in the alignment array
     :param mousepath: str, path to the folder of the corresponding mouse
     :param alignment: pd.DataFrame from load_alignment
-    :param ignore: optional list holding sessions that should not be loaded (e.g. first sess after stroke w/o behavior)
+    :param ignore: optional list holding sessions that should not be loaded (e.g. first sess after stroke w/o behavior).
+                    Traces of these sessions are NaN.
     :return: data (dict): PCF objects of all aligned sessions, session dates as keys
     :return: traces (np.array): binned traces of each cell and every session with shape (#neurons, #sessions, #bins)
     :return: unique (pd.DataFrame): unique tracked cells with respective neuron IDs for every session
@@ -221,24 +270,101 @@ def align_traces(mousepath, alignment, ignore=None):
     # Filter alignment IDs for unique cells
     cell_ids = alignment[dates]
     unique = cell_ids[~alignment[dates].duplicated()]
-
-    # Put VR-aligned traces of each cell and every session in a 3D array with shape (#neurons, #sessions, #bins)
-    traces = np.zeros((len(unique), len(dates), data[dates[0]].params['n_bins']))+np.nan
+    cells = unique.values.astype(np.int64)
+
+    # Stack binned activity of all sessions, ignored sessions get no rows. The last row (NaN) is used for missing cells.
+    activity = [data[date].bin_avg_activity if date in data else np.zeros((0, 0)) for date in dates]
+    n_cells = np.array([len(x) for x in activity])
+    n_bins = data[next(iter(data))].params['n_bins']
+    stacked = np.vstack([x for x in activity if len(x) > 0] + [np.full((1, n_bins), np.nan)])
+
+    found = (cells >= 0) & (n_cells > 0)
+    # Check that all IDs exist in their session and that there are no mismatched cells
+    out_of_range = found & (cells >= n_cells)
+    if np.any(out_of_range):
+        bad_sess = dates[np.any(out_of_range, axis=0)]
+        raise ValueError(f'Neuron IDs out of range in sessions {list(bad_sess)}, check alignments again.')
     for date_idx, date in enumerate(dates):
-        found_cells = unique[date].loc[unique[date] != -10]
-        # Check that there are no mismatched cells
-        if len(found_cells.unique()) != len(found_cells):
+        found_cells = np.sort(cells[found[:, date_idx], date_idx])
+        if np.any(found_cells[1:] == found_cells[:-1]):
             raise ValueError(f'Double Neuron IDs in session {date}, check alignments again.')
 
-        # Go through all cells in that session and put the traces for each cell into the array
-        for cell_idx, cell in enumerate(unique[date]):
-            if int(cell) != -10:
-                traces[cell_idx, date_idx, :] = data[date].bin_avg_activity[int(cell)]
+    # Put VR-aligned traces of each cell and every session in a 3D array with shape (#neurons, #sessions, #bins)
+    offsets = np.concatenate(([0], np.cumsum(n_cells)[:-1]))
+    traces = stacked[np.where(found, cells + offsets, len(stacked) - 1)]
 
     return data, traces, unique
 
 
-def piecewise_fov_shift(ref_img, tar_img, n_patch=8):
+def batch_phase_cross_correlation(ref_patches, tar_patches, upsample_factor=100, normalization='phase', workers=-1):
+    """
+    Subpixel shifts between many pairs of image patches with phase correlation, a batched version of
+    skimage.registration.phase_cross_correlation (same algorithm and results). The FFTs of all patches are computed in
+    one call, the whole-pixel peak search is vectorized over patches, and the peaks are refined with a matrix-multiply
+    DFT that is only evaluated in a 1.5 pixel region around each peak.
+    :param ref_patches: np.array with shape (..., height, width), reference patches
+    :param tar_patches: np.array with same shape as ref_patches, target patches that are registered to the references
+    :param upsample_factor: int, patches are registered to within 1 / upsample_factor of a pixel
+    :param normalization: str, 'phase' to normalize the cross-power spectrum (default of skimage >= 0.19), or None for
+                          plain cross-correlation (skimage < 0.19)
+    :param workers: int, number of workers for the FFTs (-1 uses all CPUs)
+    :return: np.array with shape (..., 2) containing (row, column) shift of every patch
+    """
+    ref_patches = np.asarray(ref_patches)
+    tar_patches = np.asarray(tar_patches)
+    if ref_patches.shape != tar_patches.shape:
+        raise ValueError('Reference and target patches must have the same shape.')
+    if np.any(np.isnan(ref_patches)) or np.any(np.isnan(tar_patches)):
+        raise ValueError('NaN values found, please remove NaNs from the images.')
+
+    shape = np.array(ref_patches.shape[-2:])
+    batch_shape = ref_patches.shape[:-2]
+
+    # Cross-power spectrum of all patch pairs
+    freq = fft.fft2(np.stack((ref_patches, tar_patches)), workers=workers)
+    image_product = freq[0] * freq[1].conj()
+    if normalization == 'phase':
+        eps = np.finfo(image_product.real.dtype).eps
+        image_product /= np.maximum(np.abs(image_product), 100 * eps)
+    elif normalization is not None:
+        raise ValueError('normalization must be either phase or None')
+    cross_correlation = fft.ifft2(image_product, workers=workers)
+    float_dtype = image_product.real.dtype
+
+    # Whole-pixel shift: locate maximum of every patch
+    maxima = np.argmax(np.abs(cross_correlation).reshape(batch_shape + (-1,)), axis=-1)
+    shift = np.stack(np.unravel_index(maxima, tuple(shape)), axis=-1).astype(float_dtype)
+    midpoint = np.trunc(shape / 2)
+    shift = np.where(shift > midpoint, shift - shape, shift).astype(float_dtype)
+
+    if upsample_factor > 1:
+        # Initial shift estimate in upsampled grid
+        upsample_factor = np.array(upsample_factor, dtype=float_dtype)
+        shift = np.round(shift * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        # Center of output array at dftshift + 1
+        dftshift = np.trunc(upsampled_region_size / 2.0)
+        sample_region_offset = dftshift - shift * upsample_factor
+
+        # Matrix multiply DFT around the current shift estimate of every patch: kernel_row @ data @ kernel_col.T
+        kernels = []
+        for dim in range(2):
+            kernel = ((np.arange(upsampled_region_size) - sample_region_offset[..., dim, np.newaxis])[..., np.newaxis] *
+                      fft.fftfreq(int(shape[dim]), upsample_factor))
+            kernels.append(np.exp(-1j * 2 * np.pi * kernel).astype(image_product.dtype, copy=False))
+        cross_correlation = (kernels[0] @ (image_product.conj() @ np.swapaxes(kernels[1], -1, -2))).conj()
+
+        # Locate maximum and map back to original pixel grid
+        maxima = np.argmax(np.abs(cross_correlation).reshape(batch_shape + (-1,)), axis=-1)
+        maxima = np.stack(np.unravel_index(maxima, (upsampled_region_size, upsampled_region_size)), axis=-1)
+        shift = shift + (maxima - dftshift).astype(float_dtype) / upsample_factor
+
+    # If its only one row or column the shift along that dimension has no effect
+    shift[..., shape == 1] = 0
+    return shift
+
+
+def piecewise_fov_shift(ref_img, tar_img, n_patch=8, workers=-1):
     """
     Calculates FOV-shift map between a reference and a target image. Images are split in n_patch X n_patch patches, and
     shift is calculated for each patch separately with phase correlation. The resulting shift map is scaled up and
@@ -246,25 +372,66 @@ def piecewise_fov_shift(ref_img, tar_img, n_patch=8):
     :param ref_img: np.array, reference image
     :param tar_img: np.array, target image to which FOV shift is calculated. Has to be same dimensions as ref_img
     :param n_patch: int, root number of patches the FOV should be subdivided into for piecewise phase correlation
+    :param workers: int, number of workers for the FFTs of the patches (-1 uses all CPUs)
     :return: two np.arrays containing estimated shifts per pixel (upscaled x_shift_map, upscaled y_shift_map)
     """
     img_dim = ref_img.shape
     patch_size = int(img_dim[0]/n_patch)
 
-    shift_map_x = np.zeros((n_patch, n_patch))
-    shift_map_y = np.zeros((n_patch, n_patch))
-    for row in range(n_patch):
-        for col in range(n_patch):
-            curr_ref_patch = ref_img[row*patch_size:row*patch_size+patch_size, col*patch_size:col*patch_size+patch_size]
-            curr_tar_patch = tar_img[row*patch_size:row*patch_size+patch_size, col*patch_size:col*patch_size+patch_size]
-            patch_shift = phase_cross_correlation(curr_ref_patch, curr_tar_patch, upsample_factor=100, return_error=False)
-            shift_map_x[row, col] = patch_shift[0]
-            shift_map_y[row, col] = patch_shift[1]
+    if img_dim[1] < n_patch*patch_size or tar_img.shape != img_dim:
+        raise ValueError(f'Images with shape {img_dim} and {tar_img.shape} cannot be split into {n_patch} x {n_patch} '
+                         f'patches of {patch_size} x {patch_size} pixels.')
+
+    # All patches with shape (n_patch, n_patch, patch_size, patch_size)
+    def get_patches(img):
+        img = np.asarray(img)[:n_patch*patch_size, :n_patch*patch_size]
+        return img.reshape(n_patch, patch_size, n_patch, patch_size).swapaxes(1, 2)
+
+    patch_shift = batch_phase_cross_correlation(get_patches(ref_img), get_patches(tar_img), upsample_factor=100,
+                                                workers=workers)
+    shift_map_x = patch_shift[..., 0].astype(float)
+    shift_map_y = patch_shift[..., 1].astype(float)
     shift_map_x_big = zoom(shift_map_x, patch_size, order=3)
     shift_map_y_big = zoom(shift_map_y, patch_size, order=3)
     return shift_map_x_big, shift_map_y_big
 
 
+def fit_lims(coord, half_size, max):
+    """
+    Takes a coordinate and calculates axis limits of 'half_size' points around it. Caps at template shapes.
+    :param coord: int, center of mass coordinate
+    :param half_size: int, half size of the final region
+    :param max: maximum value of this axis, from template.shape
+    :return lim: tuple, axis limits
+    """
+    lim = [coord - half_size, coord + half_size]
+    if lim[0] < 0:
+        lim[1] = lim[1] - lim[0]
+        lim[0] = 0
+    elif lim[1] > max:
+        diff = lim[1] - max
+        lim[1] = lim[1] - diff
+        lim[0] = lim[0] - diff
+    return tuple(lim)
+
+
+def set_lims(com, ax, half_size, max_lims):
+    """
+    Sets axis limits of Axes around the center of mass of a neuron to create a 50x50 area centered on the CoM.
+    :param com: tuple, center of mass X and Y coordinates of a neuron
+    :param ax: Axes whose limits should be set
+    :param half_size: int, half size in pixels of the final area
+    :param max_lims: tuple, maximum values of X and Y axis, from template.shape
+    :return: axis limits of X and Y
+    """
+    lim_x = fit_lims(com[1], half_size, max_lims[1])  # X is second coordinate
+    lim_y = fit_lims(com[0], half_size, max_lims[0])
+
+    ax.set_xlim(lim_x[0], lim_x[1])
+    ax.set_ylim(lim_y[1], lim_y[0])  # Y limits have to be swapped because image origin is top-left
+    return lim_x, lim_y
+
+
 def plot_single_contour(ax, spatial, template, half_size=50, color='w', verbose=False):
     """
     Draws the contour of one component and focuses the template image around its center.
@@ -276,39 +443,6 @@ def plot_single_contour(ax, spatial, template, half_size=50, color='w', verbose=
     :param verbose: bool flag whether the contour threshold should be printed upon plotting
     :returns: CoM of the drawn contour
     """
-
-    def set_lims(com, ax, half_size, max_lims):
-        """
-        Sets axis limits of Axes around the center of mass of a neuron to create a 50x50 area centered on the CoM.
-        :param com: tuple, center of mass X and Y coordinates of a neuron
-        :param half_size: int, half size in pixels of the final area
-        :param max_lims: tuple, maximum values of X and Y axis, from template.shape
-        """
-
-        def fit_lims(coord, half_size, max):
-            """
-            Takes a coordinate and calculates axis limits of 'half_size' points around it. Caps at template shapes.
-            :param coord: int, center of mass coordinate
-            :param half_size: int, half size of the final region
-            :param max: maximum value of this axis, from template.shape
-            :return lim: tuple, axis limits
-            """
-            lim = [coord - half_size, coord + half_size]
-            if lim[0] < 0:
-                lim[1] = lim[1] - lim[0]
-                lim[0] = 0
-            elif lim[1] > max:
-                diff = lim[1] - max
-                lim[1] = lim[1] - diff
-                lim[0] = lim[0] - diff
-            return tuple(lim)
-
-        lim_x = fit_lims(com[1], half_size, max_lims[1])  # X is second coordinate
-        lim_y = fit_lims(com[0], half_size, max_lims[0])
-
-        ax.set_xlim(lim_x[0], lim_x[1])
-        ax.set_ylim(lim_y[1], lim_y[0])  # Y limits have to be swapped because image origin is top-left
-
     plt.sca(ax)
     plt.cla()       # clear axes from potential previous data
     out = visualization.plot_contours(spatial, template, display_numbers=False, colors=color, verbose=verbose)
@@ -317,6 +451,85 @@ def plot_single_contour(ax, spatial, template, half_size=50, color='w', verbose=
     return com
 
 
+def get_contour_segments(contours):
+    """
+    Splits the contour coordinates of visualization.plot_contours() into separate closed lines that can be drawn with
+    a LineCollection.
+    :param contours: list of contour dicts of one session (one entry of all_contours)
+    :return: list with one entry per neuron, holding a list of (n_points, 2) arrays with (x, y) of every contour line
+    """
+    segments = []
+    for contour in contours:
+        coords = np.asarray(contour['coordinates'], dtype=float).reshape(-1, 2)
+        is_nan = np.any(np.isnan(coords), axis=1)
+        # contour lines are separated by NaN rows
+        line_id = np.cumsum(is_nan)[~is_nan]
+        coords = coords[~is_nan]
+        segments.append([coords[line_id == i] for i in np.unique(line_id)])
+    return segments
+
+
+def create_contour_panel(ax):
+    """
+    Prepares an Axes for plot_contour_panel(): adds an empty template image, a single LineCollection for all contours
+    and a text label. These artists are then updated in-place instead of clearing and redrawing the Axes.
+    :param ax: Axes of the panel
+    :return: dict with the Axes ('ax') and its artists ('image', 'contours', 'text')
+    """
+    ax.set_xticks([])
+    ax.set_yticks([])
+    image = ax.imshow(np.zeros((1, 1)))
+    contours = LineCollection([])
+    ax.add_collection(contours)
+    text = ax.text(0.5, 0.5, '', va='center', ha='center', transform=ax.transAxes)
+    return {'ax': ax, 'image': image, 'contours': contours, 'text': text, 'line_comp': np.zeros(0, dtype=int)}
+
+
+def plot_contour_panel(panel, segments, highlight, template, com, clims, half_size=50, color='w', color_other='gray'):
+    """
+    Draws precomputed contours of several components on the template, highlights one of them and focuses the view
+    around its center. Faster alternative to plot_single_contour() if the contours are already known (e.g. from
+    prepare_manual_alignment_data()): the artists of the panel are updated in-place and only the visible part of the
+    template is drawn.
+    :param panel: dict with the Axes and its artists, from create_contour_panel()
+    :param segments: list of components, each a list of contour line arrays (from get_contour_segments())
+    :param highlight: int, index of the highlighted component in segments
+    :param template: background template image on which to draw the contours
+    :param com: tuple, center of mass (row, column) of the highlighted component
+    :param clims: tuple, (vmin, vmax) color limits of the template
+    :param half_size: int, half size in pixels of the final area
+    :param color: color of the highlighted contour
+    :param color_other: color of the other contours
+    """
+    lim_x = fit_lims(com[1], half_size, template.shape[1])
+    lim_y = fit_lims(com[0], half_size, template.shape[0])
+    x0, x1 = max(int(lim_x[0]), 0), int(np.ceil(lim_x[1])) + 1
+    y0, y1 = max(int(lim_y[0]), 0), int(np.ceil(lim_y[1])) + 1
+    crop = template[y0:y1, x0:x1]
+    panel['image'].set_data(crop)
+    panel['image'].set_extent((x0 - 0.5, x0 + crop.shape[1] - 0.5, y0 + crop.shape[0] - 0.5, y0 - 0.5))
+    panel['image'].set_cmap(plt.rcParams['image.cmap'])
+    panel['image'].set_clim(clims)
+
+    panel['contours'].set_segments([line for comp in segments for line in comp])
+    panel['line_comp'] = np.repeat(np.arange(len(segments)), [len(comp) for comp in segments])
+    set_contour_highlight(panel, highlight, color=color, color_other=color_other)
+    set_lims(com, panel['ax'], half_size, template.shape)
+
+
+def set_contour_highlight(panel, highlight, color='w', color_other='gray'):
+    """
+    Updates the highlighted component of a panel from plot_contour_panel() in-place.
+    :param panel: dict with the Axes and its artists, from create_contour_panel()
+    :param highlight: int, index of the component that should be highlighted
+    :param color: color of the highlighted contour
+    :param color_other: color of the other contours
+    """
+    is_highlight = panel['line_comp'] == highlight
+    panel['contours'].set_color([color if x else color_other for x in is_highlight])
+    panel['contours'].set_linewidth(np.where(is_highlight, 1.5, 0.5))
+
+
 def shift_com(com, shift, dims):
     """
     Shifts a center-of-mass coordinate point by a certain step size. Caps coordinates at 0 and dims limits
@@ -492,15 +705,15 @@ def manual_place_cell_alignment(pcf_sessions, target_sessions, cell_idx, alignme
             plt.setp(ax, url=idx, title=f'{ref_sess} (Index {ref_session}), Neuron {cell_idx[idx]} (Index {idx})')
         return com
 
-    def find_target_cells(reference_com, session_contours, dims, fov_shift, max_dist=25):
+    def find_target_cells(reference_com, session_idx, dims, fov_shift, max_dist=25):
         """
         Finds cells in tar_sess that are close to the reference cell
         :param reference_com: tuple, (x,y) of center of mass of reference cell
-        :param session_contours: list of contour dicts holding contour information of all target cells
+        :param session_idx: int, index of the target session in all_contours
         :param dims: tuple, (x,y) of FOV dimensions
         :param fov_shift: np.array of FOV shifts between reference and target session (from all_shifts)
         :param max_dist: int, maximum radial distance between reference and target cell to be considered 'nearby'
-        :return: list of contours of nearby cells sorted by distance
+        :return: list of indices (in all_contours[session_idx]) of nearby cells sorted by distance
         """
         # Find shift of reference CoM by indexing fov_shift
         # Correct reference center-of-mass by the shift to be better aligned with the FOV of the second session
@@ -508,111 +721,128 @@ def manual_place_cell_alignment(pcf_sessions, target_sessions, cell_idx, alignme
                                         (fov_shift[0][reference_com[0], reference_com[1]],
                                          fov_shift[1][reference_com[0], reference_com[1]]), dims)
 
-        # transform CoM into a Point2D that can handle radial distances
-        ref_point = Point2D(reference_com_shift[0], reference_com_shift[1])
+        # Query the KD-tree of the session for all cells that have a CoM near the reference cell
+        valid_idx = session_valid[session_idx]
+        near_idx = np.sort(valid_idx[session_trees[session_idx].query_ball_point(reference_com_shift, max_dist)])
+        distances = np.linalg.norm(session_coms[session_idx][near_idx] - reference_com_shift, axis=1)
 
-        # Go through all cells and select the ones that have a CoM near the reference cell, also remember their distance
-        near_contours = []
-        distances = []
-        for contour in session_contours:
-            new_point = Point2D(contour['CoM'][0], contour['CoM'][1])
-            rad_dist = (new_point - ref_point).r
-            if rad_dist <= max_dist:
-                near_contours.append(contour)
-                distances.append(rad_dist)
+        # return indices sorted by their distance to the reference CoM
+        return near_idx[np.argsort(distances, kind='stable')]
 
-        # return contours sorted by their distance to the reference CoM
-        return [x for _, x in sorted(zip(distances, near_contours), key=lambda pair: pair[0])]
-
-    def draw_target_cells(outer_grid, near_contours_sort, idx, ref_cell_idx):
+    def get_candidate_panels(n_rows, n_cols):
+        """
+        Returns the plots of a grid layout for the target cells. The plots of each layout are only created once and
+        then reused, plots of other layouts are hidden (and can not be clicked).
+        :param n_rows: int, number of rows of the grid
+        :param n_cols: int, number of columns of the grid
+        :return: list of panel dicts (from create_contour_panel), ordered row by row
         """
-        Draws target cells in the right part of the figure.
-        :param outer_grid: GridSpec object where the target cells are to be drawn
-        :param near_contours_sort: list, contains contour data of target cells (from find_target_cells)
+        if (n_rows, n_cols) not in panel_cache:
+            candidates = outer_grid[1].subgridspec(n_rows, n_cols)  # create grid layout
+            panel_cache[(n_rows, n_cols)] = [create_contour_panel(fig.add_subplot(candidates[row, column]))
+                                             for row in range(n_rows) for column in range(n_cols)]
+        for layout, panels in panel_cache.items():
+            for panel in panels:
+                panel['ax'].set_visible(layout == (n_rows, n_cols))
+                panel['ax'].set_picker(True if layout == (n_rows, n_cols) else None)  # picker enables clicking
+        return panel_cache[(n_rows, n_cols)]
+
+    def draw_target_cells(near_idx, idx, ref_cell_idx):
+        """
+        Draws target cells in the right part of the figure. Every candidate is highlighted in its own plot, the
+        contours of all candidates are drawn from the cached contour lines as one LineCollection per plot.
+        :param near_idx: list, contains indices of target cells in all_contours (from find_target_cells)
         :param idx: int, index of the target session the target cells belong to
         :param ref_cell_idx: index of reference cell, needed to label axes
         :return:
         """
         n_cols = 5
         real_idx = targ_to_real_idx(idx)  # exchange the target-session specific idx into a pcf_sessions index
-        n_plots = len(near_contours_sort)+1
+        n_plots = len(near_idx)+1
+        near_segments = [session_segments[idx][i] for i in near_idx]
         # draw possible matching cells in the plots on the right
         if n_plots < 15:  # make a 5x3 grid for up to 14 nearby cells + 1 'No Match' plot
             n_rows = ceil(n_plots/n_cols)    # number of rows needed to plot into 5 columns
         else:
             n_rows = 4      # if there are more than 14 cells, make 4 rows and extend columns as much as necessary
             n_cols = ceil(n_plots/n_rows)
-        candidates = outer_grid[1].subgridspec(n_rows, n_cols)  # create grid layout
-        counter = 0                                     # counter that keeps track of plotted contour number
-        for row in range(n_rows):
-            for column in range(n_cols):
-                curr_ax = fig.add_subplot(candidates[row, column], picker=True)  # picker enables clicking subplots
-                try:
-                    # -1 because the neuron_id from visualization.plot_contours starts counting at 1
-                    curr_neuron = near_contours_sort[counter]['neuron_id']-1
-                    # plot the current candidate
-                    if place_cell_mode:
-                        curr_cont = plot_single_contour(ax=curr_ax,
-                                                        spatial=target_sessions[idx].cnmf.estimates.A[:, curr_neuron],
-                                                        template=target_sessions[idx].cnmf.estimates.Cn)
-                    else:
-                        curr_cont = plot_single_contour(ax=curr_ax,
-                                                        spatial=target_sessions[idx].estimates.A[:, curr_neuron],
-                                                        template=target_sessions[idx].estimates.Cn)
-                    if show_neuron_id:
-                        t = curr_ax.text(0.5, 0.5, f'{curr_neuron}', va='center', ha='center', transform=curr_ax.transAxes)
-                    # the url property of the Axes is used as a tag to remember which neuron has been clicked
-                    # as well as which target session it belonged to
-                    plt.setp(curr_ax, url=(ref_cell_idx, real_idx, curr_neuron))
-                    curr_ax.tick_params(labelbottom=False, labelleft=False)
-                    counter += 1
-
-                # if there are no more candidates to plot, make plot into a "no matches" button and mark it with -10
-                except IndexError:
-                    dummy = np.ones(dim)
-                    dummy[0, 0] = 0
-                    curr_ax.imshow(dummy, cmap='gray')
-                    t = curr_ax.text(0.5, 0.5, 'No Matches', va='center', ha='center',  transform=curr_ax.transAxes)
-                    plt.setp(curr_ax, url=(ref_cell_idx, real_idx, -10))
-                    curr_ax.tick_params(labelbottom=False, labelleft=False)
-                if row == 0 and column == int(n_cols/2):
-                    if place_cell_mode:
-                        curr_session = target_sessions[idx].params["session"]
-                        curr_ax.set_title(f'Session {curr_session} (Index {real_idx})')
-                    else:
-                        curr_ax.set_title(f'Session {real_idx+1} (Index {real_idx})')
+        panels = get_candidate_panels(n_rows, n_cols)
+        for counter, panel in enumerate(panels):
+            curr_ax = panel['ax']
+            if counter < len(near_idx):
+                # -1 because the neuron_id from visualization.plot_contours starts counting at 1
+                curr_neuron = all_contours[idx][near_idx[counter]]['neuron_id']-1
+                # plot the current candidate
+                curr_com = np.round(session_coms[idx][near_idx[counter]]).astype(int)
+                plot_contour_panel(panel, segments=near_segments, highlight=counter, template=session_templates[idx],
+                                   com=curr_com, clims=session_clims[idx])
+                panel['text'].set_text(f'{curr_neuron}' if show_neuron_id else '')
+                # the url property of the Axes is used as a tag to remember which neuron has been clicked
+                # as well as which target session it belonged to
+                plt.setp(curr_ax, url=(ref_cell_idx, real_idx, curr_neuron))
+
+            # if there are no more candidates to plot, make plot into a "no matches" button and mark it with -10
+            else:
+                dummy = np.ones(dim)
+                dummy[0, 0] = 0
+                panel['image'].set_data(dummy)
+                panel['image'].set_extent((-0.5, dim[1] - 0.5, dim[0] - 0.5, -0.5))
+                panel['image'].set_cmap('gray')
+                panel['image'].set_clim(0, 1)
+                panel['contours'].set_segments([])
+                curr_ax.set_xlim(-0.5, dim[1] - 0.5)
+                curr_ax.set_ylim(dim[0] - 0.5, -0.5)
+                panel['text'].set_text('No Matches')
+                plt.setp(curr_ax, url=(ref_cell_idx, real_idx, -10))
+            if counter == int(n_cols/2):
+                if place_cell_mode:
+                    curr_session = target_sessions[idx].params["session"]
+                    curr_ax.set_title(f'Session {curr_session} (Index {real_idx})')
+                else:
+                    curr_ax.set_title(f'Session {real_idx+1} (Index {real_idx})')
 
     def draw_both_sides(ref_idx, targ_sess_idx):
-        fig.clear()  # remove potential previous layouts
-        outer_grid = grid.GridSpec(1, 2)  # initialize outer structure (two fields horizontally)
-
-        ref = grid.GridSpecFromSubplotSpec(1, 1, subplot_spec=outer_grid[0])  # initialize reference plot
-        ref_ax = fig.add_subplot(ref[0])  # draw reference plot
-
-        # first draw the reference cell
-        if place_cell_mode:
-            ref_com = draw_reference(ref_ax, pcf_sessions[ref_session].cnmf, ref_idx)
-        else:
-            ref_com = draw_reference(ref_ax, pcf_sessions[ref_session], ref_idx)
+        # first draw the reference cell (only if it changed, the same cell is shown for all target sessions)
+        if drawn_reference.get('idx') != ref_idx:
+            if place_cell_mode:
+                drawn_reference['com'] = draw_reference(ref_ax, pcf_sessions[ref_session].cnmf, ref_idx)
+            else:
+                drawn_reference['com'] = draw_reference(ref_ax, pcf_sessions[ref_session], ref_idx)
+            drawn_reference['idx'] = ref_idx
+        ref_com = drawn_reference['com']
 
         # Find cells in the next session(s) that have their center of mass near the reference cell
-        nearby_contours = find_target_cells(reference_com=ref_com,
-                                            session_contours=all_contours[targ_sess_idx],
-                                            dims=dim,
-                                            fov_shift=all_shifts[targ_sess_idx])
+        nearby_cells = find_target_cells(reference_com=ref_com,
+                                         session_idx=targ_sess_idx,
+                                         dims=dim,
+                                         fov_shift=all_shifts[targ_sess_idx])
 
         # Draw target cells in the right plots
-        draw_target_cells(outer_grid, nearby_contours, targ_sess_idx, ref_idx)
+        draw_target_cells(nearby_cells, targ_sess_idx, ref_idx)
 
 ##########################################################################################
 ################ START OF PLOTTING #######################################################
 
     ref_session = get_ref_idx(pcf_sessions, ref_sess, place_cell_mode)
 
+    # Cache for every target session: KD-tree over the CoMs of all components (components without valid CoM are left
+    # out), the contour lines of all components, and the template with its color limits (1st and 99th percentile, as in
+    # visualization.plot_contours)
+    session_coms = [np.array([contour['CoM'] for contour in contours], dtype=float).reshape(-1, 2)
+                    for contours in all_contours]
+    session_valid = [np.where(np.all(np.isfinite(coms), axis=1))[0] for coms in session_coms]
+    session_trees = [cKDTree(coms[valid].reshape(-1, 2)) for coms, valid in zip(session_coms, session_valid)]
+    session_segments = [get_contour_segments(contours) for contours in all_contours]
+    if place_cell_mode:
+        session_templates = [sess.cnmf.estimates.Cn for sess in target_sessions]
+    else:
+        session_templates = [sess.estimates.Cn for sess in target_sessions]
+    session_clims = [tuple(np.nanpercentile(template, (1, 99))) for template in session_templates]
+
     # see if the alignment array has already been (partly) filled to skip processed cells
     if len(np.unique(alignment)) != 1:
         untagged_cells = np.where(alignment == -1)
-        if len(untagged_cells) == 0:
+        if len(untagged_cells[0]) == 0:
             return print("All cells aligned!")
         else:
             start_ref = untagged_cells[0][0]   # row of first -1 shows with which reference cell to start
@@ -627,6 +857,11 @@ def manual_place_cell_alignment(pcf_sessions, target_sessions, cell_idx, alignme
 
     # build figure
     fig = plt.figure(figsize=(18, 8))  # draw figure
+    outer_grid = grid.GridSpec(1, 2)  # initialize outer structure (two fields horizontally)
+    ref = grid.GridSpecFromSubplotSpec(1, 1, subplot_spec=outer_grid[0])  # initialize reference plot
+    ref_ax = fig.add_subplot(ref[0])  # draw reference plot
+    panel_cache = {}    # plots of the target cells for every grid layout, reused between clicks
+    drawn_reference = {}    # index and CoM of the reference cell that is currently drawn
 
     # First drawing
     draw_both_sides(start_ref, start_tar)  # Draw the first reference (place) cell and the target cells
@@ -655,8 +890,7 @@ def manual_place_cell_alignment(pcf_sessions, target_sessions, cell_idx, alignme
         # else, only draw the target cells of the next session
         else:
             draw_both_sides(ref_id, targ_sess_id+1)
-        fig.canvas.draw()
-        fig.canvas.flush_events()
+        fig.canvas.draw_idle()
 
     plt.tight_layout()
     fig.canvas.mpl_connect('pick_event', onpick)
@@ -712,25 +946,31 @@ def check_alignment(alignments, save=None):
     """
     Checks alignment arrays for cells that received different IDs in the same session. The results are stored in a list
     of DataFrames, each DF holding the IDs of one cell across sessions. The results can also be saved as a text file.
-    :param alignments: pandas DataFrame with all alignment.txt data
-    :return:
+    :param alignments: pandas DataFrame with all alignment data, from load_alignment()
+    :param save: str, optional, path of the text file where the mismatched cells are saved
+    :return: list of DataFrames, one per mismatched cell
     """
     dates = alignments.columns[1:]
+    cells = alignments[dates].values
     misalign = []
-    breakpoint = False
-    for sess in dates:
-        # Get all unique cell IDs (and remove un-assigned -10s)
-        unique = np.unique(alignments[sess])
-        unique = np.delete(unique, np.where(unique == -10))
-        unique = np.delete(unique, np.where(unique == -1))
-        for cell in unique:
-            # Get the cross-session IDs of the same cells
-            rows = alignments.loc[alignments[sess] == cell]
-            exists = [rows.equals(x) for x in misalign]
-            has_mismatch = [True if len(rows[date].unique())>1 else False for date in dates]
-            # if it has not been checked before and the cell was tracked more than 1 time, save it
-            if not any(exists) and len(rows) > 1 and any(has_mismatch):
-                misalign.append(rows)
+    checked = set()
+    for sess_idx in range(len(dates)):
+        # Get rows of all assigned cell IDs (without -1 and -10), sorted by ID (stable, rows stay in original order)
+        rows = np.where(cells[:, sess_idx] >= 0)[0]
+        rows = rows[np.argsort(cells[rows, sess_idx], kind='stable')]
+        ids, starts, counts = np.unique(cells[rows, sess_idx], return_index=True, return_counts=True)
+        if len(ids) == 0:
+            continue
+        # A cell is mismatched if its rows do not have the same ID in every session
+        sorted_cells = cells[rows]
+        has_mismatch = np.any(np.maximum.reduceat(sorted_cells, starts) != np.minimum.reduceat(sorted_cells, starts),
+                              axis=1)
+        # if it has not been checked before and the cell was tracked more than 1 time, save it
+        for start, count in zip(starts[has_mismatch & (counts > 1)], counts[has_mismatch & (counts > 1)]):
+            cell_rows = tuple(rows[start:start+count])
+            if cell_rows not in checked:
+                checked.add(cell_rows)
+                misalign.append(alignments.iloc[list(cell_rows)])
 
     if save is not None:
         with open(save, 'w') as f:
@@ -782,42 +1022,37 @@ def check_alignment(alignments, save=None):
 def reset_misaligned_cells(misalignment, file_list):
     """
     OLD FUNCTION, NOT RECOMMENDED! USE "MISALIGN" LIST FROM CHECK_DOUBLE_CELLS!
-    Takes misalignment list from check_alignment() and resets the IDs in the .txt files to -1 so it can be checked
-    again.
-    :param misalignment:
-    :param file_list:
+    Takes misalignment list from check_alignment() and resets the IDs in the alignment tables to -1 (not aligned) so
+    it can be checked again. A copy of every original file is saved first. The tables are saved as .npz (old .txt
+    tables get a new .npz table next to the text file).
+    :param misalignment: list of DataFrames, from check_alignment()
+    :param file_list: list of paths to the alignment files (.npz or old alignment.txt) of the misaligned cells
     :return:
     """
     # load the alignment files and save a copy
     align = {}
     for file in file_list:
         date = os.path.splitext(file)[0].split('_')[-1]
-        with open(file) as f:
-            header = f.readline()
-        align[date] = np.loadtxt(file)
-        # Get next filename and save the array
-        new_file = fm.get_next_filename(file)
-        np.savetxt(new_file, align[date], delimiter='\t', header=header, fmt='%d')
-
-    new_align = deepcopy(align)
+        align[date] = read_alignment_file(file)
+        # Get next filename and save a copy of the file
+        shutil.copyfile(file, fm.get_next_filename(file))
 
     for cell in misalignment:
         # Get indices of the columns with the mismatched IDs for numpy indexing
         bad_cols = [cell.columns.get_loc(session)-1 for session in cell.columns[1:] if len(cell[session].unique()) > 1]
         for date in cell['ref_date']:
-            arr = align[str(date)]
+            arr = align[str(date)]['cells']
             # Find row of the cell in each np alignment array
             row = np.where((arr == np.array(cell.loc[cell['ref_date'] == int(date), cell.columns[1:]]))
                            .all(axis=1))[0][0]
-            # Change the value of the cell at the session to -1
-            new_align[str(date)][row, bad_cols] = -1
+            # Change the value of the cell at the session to -1 (not aligned)
+            arr[row, bad_cols] = -1
+            align[str(date)]['aligned'][row, bad_cols] = False
 
     # save new alignment files
     for file in file_list:
         date = os.path.splitext(file)[0].split('_')[-1]
-        with open(file) as f:
-            header = f.readline()
-        np.savetxt(file, new_align[date], delimiter='\t', header=header, fmt='%d')
+        np.savez(os.path.splitext(file)[0] + '.npz', **align[date])
 
 
 
@@ -879,8 +1114,8 @@ def plot_aligned_cells(cell_list, pcf_objects_list, ref_dates, color=False, colb
         this_cell = np.ones((ncols, 80))
         for col in range(ncols):
             curr_neur_id = int(all_cell_array[comb_bins_sort[nrow], col])
-            #if curr_neur_id == -10 or col == 3 and curr_neur_id == 346: # if the ID is -10 (not recognized), set values to 0 to be filtered out later
-            if curr_neur_id == -10 or col == 3 and curr_neur_id == 646 or curr_neur_id == 565:  # if the ID is -10 (not recognized), set values to 0 to be filtered out later
+            #if curr_neur_id < 0 or col == 3 and curr_neur_id == 346: # if the ID is -1 (not recognized), set values to 0 to be filtered out later
+            if curr_neur_id < 0 or col == 3 and curr_neur_id == 646 or curr_neur_id == 565:  # if the ID is -1 (not recognized), set values to 0 to be filtered out later
                 this_cell[col] = np.zeros((1, 80))
             else:
                 this_cell[col] = pcf_objects_list[col].bin_avg_activity[curr_neur_id]
@@ -1034,14 +1269,14 @@ if __name__ == '__main__':
     spatial_union, assignments, matchings, spatial, templates, pcf_objects = align_multisession(dir_list)
 
     # load manual assignment
-    manual = np.loadtxt(r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191125.txt')
+    manual = read_alignment_file(r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191125.txt')['cells']
 
     # get the same cells from CaImAn tool
     caiman_results = np.zeros(manual.shape)
     for row in range(manual.shape[0]):
         curr_row = manual[row]
         caiman_results[row] = assignments[np.where(assignments[:, 0] == curr_row[0])]
-    caiman_results[np.isnan(caiman_results)] = -10  # make nans to -10 to make it comparable with manual
+    caiman_results[np.isnan(caiman_results)] = -1  # make nans to -1 to make it comparable with manual
     # compare how many hits CaImAn has
     sum_equal = np.equal(manual, caiman_results)
     performance = np.sum(sum_equal[:, 2:4])/sum_equal[:, 2:4].size
@@ -1075,7 +1310,7 @@ if __name__ == '__main__':
 
     idx_file_list = [r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191125_full.txt',
                      ]
-    # load data from txt files
+    # load alignment tables (.npz or old .txt files)
     idx_file_list = [r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191125.txt',
                      r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191126b.txt',
                      r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis\pc_alignment_20191127a.txt',
@@ -1084,7 +1319,7 @@ if __name__ == '__main__':
 
     alignments_all = []
     for file in idx_file_list:
-        alignments_all.append(np.loadtxt(file, delimiter='\t'))
+        alignments_all.append(read_alignment_file(file)['cells'])
     pc_idx_list = []
     for obj in pcf_objects:
         pc_idx_list.append([x[0] for x in obj.place_cells])
@@ -1098,7 +1333,7 @@ if __name__ == '__main__':
     # skip cells that didnt get recognized in all sessions
     alignments = []
     for session in alignments_all:
-        alignments.append(session[np.all(session != -10, axis=1)])
+        alignments.append(session[np.all(session >= 0, axis=1)])
 
     flat_list = np.vstack(alignments)
 
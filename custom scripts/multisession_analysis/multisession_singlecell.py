@@ -80,8 +80,8 @@ for idx, row in unique.iterrows():
     for session_idx in row.index:
         # Skip session of poststroke day 1 because mouse was not running, data is meaningless
         if session_idx != '20200826':
-            # -10 means that cell was not found in that session
-            if not int(row[session_idx]) == -10:
+            # -1 means that cell was not found in that session
+            if int(row[session_idx]) >= 0:
                 # Plot data
                 ax[ax_row, ax_col].plot(data[session_idx].bin_avg_activity[int(row[session_idx])])
 
@@ -121,22 +121,22 @@ with open(r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\M19\2019120
 #%% load alignment files and store data in a DataFrame
 alignment_root = r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch2\batch_analysis'
 
-alignment_paths = glob(alignment_root+r'\pc_alignment*.txt')
+alignment_paths = glob(alignment_root+r'\pc_alignment*.npz') + glob(alignment_root+r'\pc_alignment*.txt')
 sess_list = [path.split(os.path.sep)[-2] for path in roots]
 
 # load alignment files and enter data into a data frame with columns (data, glob_id, session, sess_id, pc_sess)
 single_rows = []
 glob_id = 0
 for path in alignment_paths:
-    file = np.loadtxt(path)
-    pc_sess = path.split(os.path.sep)[-1].split('_')[-1][:-4]  # isolate session date
+    file = multi.read_alignment_file(path)['cells']
+    pc_sess = os.path.splitext(path.split(os.path.sep)[-1])[0].split('_')[-1]  # isolate session date
 
     # go through the table and enter data of current cell into a temporary data frame
     for cell in range(file.shape[0]):
         for sess in range(file.shape[1]):
             session = sess_list[sess]                               # get name of current session
             sess_id = int(file[cell, sess])                         # get ID of current neuron in the current session
-            if sess_id != -10:
+            if sess_id >= 0:
                 data = pcf_dict[session].cnmf.estimates.F_dff[sess_id]  # get calcium data of that cell
                 # append row to a list that will be concatenated to a single DF in the end
                 single_rows.append(pd.DataFrame({'data': [data], 'glob_id': int(glob_id), 'session': session,
@@ -6,6 +6,8 @@ import yaml
 import gc
 from statistics import mean, stdev
 
+from standard_pipeline import pvc_kernel
+
 # params to set
 MD = yaml.load(open("custom scripts/metadata.yaml"), Loader=yaml.FullLoader) #metadata
 
@@ -50,26 +52,7 @@ def pvc_curve(activity_matrix, plot=True, max_delta_bins=30):
        curve_yvals:
            array of mean pvc curve (idx = delta_bin)
     """
-    num_bins = np.size(activity_matrix,0)
-    num_neurons = np.size(activity_matrix,1)
-    curve_yvals = np.empty(max_delta_bins + 1)
-    curve_stdev = np.empty(max_delta_bins + 1)
-    for delta_bin in range(max_delta_bins + 1):
-        pvc_vals = []
-        for offset in range(num_bins - delta_bin):
-            idx_x = offset
-            idx_y = offset + delta_bin
-            pvc_xy_num = pvc_xy_den_term1 = pvc_xy_den_term2 = 0
-            for neuron in range(num_neurons):
-                pvc_xy_num += activity_matrix[idx_x][neuron] * activity_matrix[idx_y][neuron]
-                pvc_xy_den_term1 += activity_matrix[idx_x][neuron]*activity_matrix[idx_x][neuron]
-                pvc_xy_den_term2 += activity_matrix[idx_y][neuron]*activity_matrix[idx_y][neuron]
-            pvc_xy = pvc_xy_num / (np.sqrt(pvc_xy_den_term1*pvc_xy_den_term2))
-            pvc_vals.append(pvc_xy)
-        mean_pvc_delta_bin = np.mean(pvc_vals)
-        stdev_delta_bin = np.std(pvc_vals)
-        curve_yvals[delta_bin] = mean_pvc_delta_bin
-        curve_stdev[delta_bin] = stdev_delta_bin
+    curve_yvals, curve_stdev = pvc_kernel.pvc_curve(activity_matrix, max_delta_bins=max_delta_bins)
 
     if plot:
         plot_pvc_curve(curve_yvals, curve_stdev, show=True)
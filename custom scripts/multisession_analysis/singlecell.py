@@ -174,7 +174,7 @@ def get_single_spikerate(alignment, data, split_pc=False):
                                                                             data[date].cnmf.params.data['fr'])
         pc_idx = [x[0] for x in data[date].place_cells]
         for cell_idx, cell in enumerate(alignment[date]):
-            if int(cell) != -10:
+            if int(cell) >= 0:
                 if split_pc:
                     if int(cell) in pc_idx:
                         fr[0][cell_idx, date_idx] = spike_dist[int(cell)]
@@ -53,8 +53,8 @@ target_session_list, place_cell_indices, alignment_array, all_contours_list, all
 
 # If you started to align the place cells of this session, but saved the table incomplete and want to continue, you can
 # load the table here and pick up where you left. Note that the file path should include the file name and extension
-file_path = r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch3\batch_processing\cell_alignments\pc_alignment_20200826.txt'
-alignment_array = msr.load_alignment(file_path)
+file_path = r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch3\batch_processing\cell_alignments\pc_alignment_M33_20200826.npz'
+alignment_array = msr.load_alignment_array(file_path)
 
 # This is the main function for the tracking. It creates the interactive plot and saves the results in the
 # alignment_array, which has one place cell for each row, one session in each column, and each entry is the neuron ID
@@ -74,8 +74,8 @@ alignment_array = msr.manual_place_cell_alignment(pcf_sessions=pcf_objects,
 # access the correct session from the list and the correct cell ID.
 msr.show_whole_fov(reference_session=pcf_objects[5], target_session=pcf_objects[2], ref_cell_id=120)
 
-# Save the alignment array under the provided directory as a csv table. Every row is one place cell from the reference
-# session, every column is one session, and the entries are the IDs of each cell in the corresponding session.
+# Save the alignment array under the provided directory as a binary table (.npz). Every row is one place cell from the
+# reference session, every column is one session, and the entries are the IDs of each cell in the corresponding session.
 file_directory = r'W:\Neurophysiology-Storage1\Wahl\Hendrik\PhD\Data\Batch3\batch_processing\cell_alignments'
 msr.save_alignment(file_directory, alignment_array, reference_session, pcf_objects)
 
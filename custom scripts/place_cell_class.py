@@ -7,13 +7,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import random
-import copy
+import multiprocessing
+import tempfile
+import shutil
 from glob import glob
 from math import ceil, floor
 import os
 import re
 from standard_pipeline.behavior_import import progress
 from standard_pipeline.performance_check import is_session_novel
+from standard_pipeline import noise_estimation as noise
+from standard_pipeline import behavior_alignment as align
+from standard_pipeline import behavior_store
+from standard_pipeline import si_kernel
 import tifffile as tiff
 # from manual_selection_gui import gui_without_movie as gui
 from caiman.utils import visualization
@@ -29,8 +35,349 @@ except ModuleNotFoundError:
 
 
 
-#todo: create a class "data" that includes all data trace arrays (session, session_trans, bin_act, bin_avg_act) and
-# is initialized twice, once for dF/F data and once for spike probabilities
+class SessionData:
+    """
+    Container for the traces of all neurons of a session (dF/F, spike probabilities or transient-only traces).
+    The data is stored as one contiguous array [n_neurons x n_frames] together with the trial borders and the
+    resting masks, and trial traces are handed out as views into this array (no copies).
+    For compatibility with the former nested lists, SessionData can still be indexed as session[neuron][trial].
+    """
+    def __init__(self, traces, frame_list, resting_mask=None):
+        """
+        :param traces: 2D array [n_neurons x n_frames] holding the traces of all trials, concatenated
+        :param frame_list: list of number of frames in every trial
+        :param resting_mask: optional, 1D bool array [n_frames] that is True for frames where the mouse was running
+        """
+        self.traces = traces
+        self.trial_offsets = np.concatenate(([0], np.cumsum(frame_list))).astype(int)
+        if self.trial_offsets[-1] != traces.shape[1]:
+            raise ValueError(f'Frame list sums up to {self.trial_offsets[-1]} frames, but traces have '
+                             f'{traces.shape[1]} frames.')
+        self.resting_mask = resting_mask
+
+    @classmethod
+    def from_trial_lists(cls, session, resting_mask=None):
+        """
+        Builds a SessionData object from the nested list structure session[neuron][trial] (e.g. old PCF objects).
+        :param session: list of neurons, each a list of 1D arrays with the trace of every trial
+        :param resting_mask: optional, list of 1D bool arrays (one per trial) or 1D bool array [n_frames]
+        :return: SessionData object
+        """
+        if isinstance(session, cls):
+            return session
+        frame_list = [len(trial) for trial in session[0]]
+        if resting_mask is not None and not isinstance(resting_mask, np.ndarray):
+            resting_mask = np.concatenate(resting_mask)
+        return cls(np.vstack([np.concatenate(neuron) for neuron in session]), frame_list, resting_mask)
+
+    @property
+    def n_neuron(self):
+        return self.traces.shape[0]
+
+    @property
+    def n_trial(self):
+        return len(self.trial_offsets) - 1
+
+    @property
+    def frame_list(self):
+        return list(np.diff(self.trial_offsets))
+
+    def set_resting_mask(self, masks):
+        """
+        :param masks: list of 1D bool arrays (one per trial, from import_behavior_and_align_traces()), True for frames
+                      where the mouse was running
+        """
+        self.resting_mask = np.concatenate(masks)
+
+    def trial(self, trial, running_only=False):
+        """
+        :param trial: int, index of the trial
+        :param running_only: bool flag whether resting frames should be removed (returns a copy instead of a view)
+        :return: 2D array [n_neurons x n_frames_trial] with the traces of all neurons during the trial
+        """
+        trial_traces = self.traces[:, self.trial_offsets[trial]:self.trial_offsets[trial+1]]
+        if running_only:
+            return trial_traces[:, self.trial_mask(trial)]
+        return trial_traces
+
+    def trace(self, neuron, trial):
+        """
+        :param neuron: int, index of the neuron
+        :param trial: int, index of the trial
+        :return: 1D array with the trace of the neuron during the trial (view)
+        """
+        return self.traces[neuron, self.trial_offsets[trial]:self.trial_offsets[trial+1]]
+
+    def trial_mask(self, trial):
+        """
+        :param trial: int, index of the trial
+        :return: 1D bool array, resting mask of the trial (True for running frames)
+        """
+        return self.resting_mask[self.trial_offsets[trial]:self.trial_offsets[trial+1]]
+
+    def neuron(self, neuron):
+        """
+        :param neuron: int, index of the neuron
+        :return: 1D array with the trace of the neuron across all trials (view)
+        """
+        return self.traces[neuron]
+
+    def __len__(self):
+        return self.n_neuron
+
+    def __getitem__(self, neuron):
+        # compatibility with the nested list structure: session[neuron] is a list of trial views
+        if isinstance(neuron, slice):
+            return [self[i] for i in range(self.n_neuron)[neuron]]
+        return [self.trace(neuron, trial) for trial in range(self.n_trial)]
+
+    def __iter__(self):
+        for neuron in range(self.n_neuron):
+            yield self[neuron]
+
+
+class TransientData(SessionData):
+    """
+    Transient-only version of a SessionData object. Instead of a copy of the traces, only a boolean mask of the
+    significant transients is stored together with a reference to the original data. Values outside of transients
+    are 0 when traces are accessed.
+    """
+    def __init__(self, data, mask):
+        """
+        :param data: SessionData object with the original traces
+        :param mask: 2D bool array [n_neurons x n_frames], True for frames that are part of a significant transient
+        """
+        self.data = data
+        self.mask = mask
+        self.trial_offsets = data.trial_offsets
+
+    @property
+    def resting_mask(self):
+        return self.data.resting_mask
+
+    @resting_mask.setter
+    def resting_mask(self, mask):
+        self.data.resting_mask = mask
+
+    @property
+    def traces(self):
+        return np.where(self.mask, self.data.traces, 0)
+
+    def trial(self, trial, running_only=False):
+        trial_slice = slice(self.trial_offsets[trial], self.trial_offsets[trial+1])
+        trial_traces = np.where(self.mask[:, trial_slice], self.data.traces[:, trial_slice], 0)
+        if running_only:
+            return trial_traces[:, self.trial_mask(trial)]
+        return trial_traces
+
+    def trace(self, neuron, trial):
+        trial_slice = slice(self.trial_offsets[trial], self.trial_offsets[trial+1])
+        return np.where(self.mask[neuron, trial_slice], self.data.traces[neuron, trial_slice], 0)
+
+    def neuron(self, neuron):
+        return np.where(self.mask[neuron], self.data.traces[neuron], 0)
+
+
+def detect_transients(traces, trial_offsets, sigma, thresh, min_length):
+    """
+    Detects significant transients in all neurons and trials at once via run-lengths of above-threshold frames
+    (Koay et al., 2019). With a tuple threshold (Dombeck et al., 2007), transients start above thresh[0]*sigma and are
+    extended until the trace drops to thresh[1]*sigma. This is done for every transient except the last one of each
+    trial, and a transient that never drops again is extended until the end of the trial (same as the original
+    per-trial loop in PlaceCellFinder.create_transient_only_traces()).
+    :param traces: 2D array [n_neurons x n_frames], dF/F traces of the whole session
+    :param trial_offsets: 1D array [n_trials+1] with the first frame of every trial (and the total frame count)
+    :param sigma: 2D array [n_neurons x n_trials], noise level of every trial. Trials with sigma = 0 have no transients.
+    :param thresh: int or tuple of two ints, factor(s) of sigma for on- (and offset) of transients
+    :param min_length: int, minimum length in frames of a significant transient
+    :return: 2D bool array [n_neurons x n_frames], True for frames that are part of a significant transient
+    """
+    if type(thresh) == int:  # use one threshold for borders of transient (Koay)
+        on_factor = thresh
+    elif type(thresh) == tuple:  # use different thresholds for on and offset of transients
+        on_factor = thresh[0]
+    else:
+        raise Exception(f'Parameter "trans_thresh" has to be int or tuple, but was {type(thresh)}!')
+
+    trial_lengths = np.diff(trial_offsets)
+    n_frames = traces.shape[1]
+    frame_sigma = np.repeat(sigma, trial_lengths, axis=1)
+    # trial identity and first/last frame of the trial for every frame
+    frame_trial = np.repeat(np.arange(len(trial_lengths)), trial_lengths)
+    trial_start = trial_offsets[:-1][frame_trial]
+    trial_stop = trial_offsets[1:][frame_trial]
+
+    # get time points where the signal is above threshold and split them into consecutive runs inside each trial
+    above = (traces >= on_factor * frame_sigma) & (frame_sigma != 0)
+    first_frame = np.zeros(n_frames, dtype=bool)
+    first_frame[trial_offsets[:-1][trial_lengths > 0]] = True
+    last_frame = np.zeros(n_frames, dtype=bool)
+    last_frame[trial_offsets[1:][trial_lengths > 0] - 1] = True
+    prev_above = np.concatenate((np.zeros((traces.shape[0], 1), dtype=bool), above[:, :-1]), axis=1)
+    next_above = np.concatenate((above[:, 1:], np.zeros((traces.shape[0], 1), dtype=bool)), axis=1)
+    run_neuron, run_start = np.where(above & (~prev_above | first_frame[None, :]))
+    run_stop = np.where(above & (~next_above | last_frame[None, :]))[1] + 1
+    run_size = run_stop - run_start
+
+    if type(thresh) == tuple and run_start.size > 0:
+        # all runs except the last run of every trial are extended
+        run_trial = frame_trial[run_start]
+        is_last = np.ones(run_start.size, dtype=bool)
+        is_last[:-1] = (run_neuron[1:] != run_neuron[:-1]) | (run_trial[1:] != run_trial[:-1])
+        extend = ~is_last
+
+        off_thresh = thresh[1] * frame_sigma
+        drops = traces <= off_thresh             # frames where the trace crosses the 2nd threshold
+        not_above_off = ~(traces >= off_thresh)  # frames that break "transient goes until the end"
+        next_drop = np.zeros(traces.shape, dtype=int)
+        next_break = np.zeros(traces.shape, dtype=int)
+        for trial in range(len(trial_lengths)):
+            curr = slice(trial_offsets[trial], trial_offsets[trial+1])
+            frame_idx = np.arange(trial_offsets[trial], trial_offsets[trial+1])
+            # index of the next frame (incl. the current one) inside the trial that fulfills the condition
+            for cond, result in ((drops, next_drop), (not_above_off, next_break)):
+                idx = np.where(cond[:, curr], frame_idx[None, :], trial_offsets[trial+1])
+                result[:, curr] = np.minimum.accumulate(idx[:, ::-1], axis=1)[:, ::-1]
+
+        start = run_start[extend]
+        neuron = run_neuron[extend]
+        length = trial_stop[start] - trial_start[start]
+        goes_until_end = next_break[neuron, start] == trial_stop[start]
+        # if the transient goes until the end, the original loop extends it by (trial length - 1) frames
+        new_size = np.where(goes_until_end, length - 1, next_drop[neuron, start] - start)
+        run_size[extend] = new_size
+        run_stop[extend] = np.minimum(start + new_size, trial_stop[start])
+
+    # find runs of at least min_length and merge them into one mask
+    keep = run_size >= min_length
+    edges = np.zeros((traces.shape[0], n_frames + 1), dtype=int)
+    np.add.at(edges, (run_neuron[keep], run_start[keep]), 1)
+    np.add.at(edges, (run_neuron[keep], run_stop[keep]), -1)
+    return np.cumsum(edges[:, :-1], axis=1) > 0
+
+
+def get_binned_frames(trial_offsets, bin_frame_count, resting_mask=None):
+    """
+    Precomputes which session frames are binned and to which bin they belong. Frames of every trial (only running
+    frames if a resting mask is given) are assigned to consecutive bins according to bin_frame_count.
+    :param trial_offsets: 1D array [n_trials+1] with the first frame of every trial (and the total frame count)
+    :param bin_frame_count: array [n_bins x n_trials] with the number of frames in each bin of every trial
+    :param resting_mask: optional, 1D bool array [n_frames] that is True for running frames
+    :return: 1D int array with the session indices of all binned frames, sorted by trial and bin
+    """
+    frame_idx = []
+    for trial in range(bin_frame_count.shape[1]):
+        curr_idx = np.arange(trial_offsets[trial], trial_offsets[trial+1])
+        if resting_mask is not None:
+            curr_idx = curr_idx[resting_mask[trial_offsets[trial]:trial_offsets[trial+1]]]
+        if len(curr_idx) < np.sum(bin_frame_count[:, trial]):
+            raise Exception('Something went wrong during binning...')
+        # frames after the last bin are not used
+        frame_idx.append(curr_idx[:np.sum(bin_frame_count[:, trial])])
+    return np.concatenate(frame_idx)
+
+
+def bin_session_activity(traces, spikes, trial_offsets, bin_frame_count, frame_rate, resting_mask=None,
+                         chunk_size=100):
+    """
+    Bins the dF/F traces and spike probabilities of all neurons and trials to the VR position in one segment reduction
+    (same results as PlaceCellFinder.bin_neuron_activity_to_vr() applied to every neuron).
+    dF/F is averaged per bin. Spike probabilities are summed per bin, smoothed across bins and divided by the time
+    occupied by the bin to get firing rates.
+    :param traces: 2D array [n_neurons x n_frames] of dF/F traces (e.g. SessionData.traces)
+    :param spikes: 2D array [n_neurons x n_frames] of spike probabilities
+    :param trial_offsets: 1D array [n_trials+1] with the first frame of every trial (e.g. SessionData.trial_offsets)
+    :param bin_frame_count: array [n_bins x n_trials] with the number of frames in each bin of every trial
+    :param frame_rate: float, frame rate of the recording in Hz
+    :param resting_mask: optional, 1D bool array [n_frames] that is True for running frames (resting frames removed)
+    :param chunk_size: int, number of neurons that are binned at once (limits memory usage)
+    :return: bin_activity and bin_spike_rate as arrays [n_neurons x n_trials x n_bins], bin_avg_activity and
+             bin_avg_spike_rate as arrays [n_neurons x n_bins]
+    """
+    n_bins, n_trials = bin_frame_count.shape
+    frame_idx = get_binned_frames(trial_offsets, bin_frame_count, resting_mask)
+
+    # bins are consecutive segments of frame_idx, empty bins are left out of the reduction (they stay 0)
+    counts = bin_frame_count.T.ravel()
+    has_frames = counts > 0
+    seg_starts = (np.cumsum(counts) - counts)[has_frames]
+
+    bin_act = np.zeros((traces.shape[0], n_trials * n_bins))
+    bin_spikes = np.zeros((traces.shape[0], n_trials * n_bins))
+    for start in range(0, traces.shape[0], chunk_size):
+        rows = slice(start, start + chunk_size)
+        bin_act[rows, has_frames] = np.add.reduceat(traces[rows][:, frame_idx], seg_starts, axis=1)
+        # sum instead of mean (Peters spike probability is cumulative)
+        bin_spikes[rows, has_frames] = np.add.reduceat(np.nan_to_num(spikes[rows][:, frame_idx]), seg_starts, axis=1)
+    bin_act[:, has_frames] /= counts[has_frames]
+    bin_act = bin_act.reshape(traces.shape[0], n_trials, n_bins)
+
+    # Smooth spike rate and transform values into mean firing rates by dividing by the time in s occupied by the bin
+    bin_spike_rate = gaussian_filter1d(bin_spikes.reshape(traces.shape[0], n_trials, n_bins), 1, axis=2)
+    bin_spike_rate = bin_spike_rate / (bin_frame_count.T * (1 / frame_rate))[None, :, :]
+
+    return bin_act, np.mean(bin_act, axis=1), bin_spike_rate, np.nanmean(bin_spike_rate, axis=1)
+
+
+def neuron_seed(seed, neuron_id):
+    """
+    Derives the seed of the random stream of a single neuron from the global seed, so that bootstrapping results of a
+    neuron do not depend on which neurons were processed before it (or in which worker process).
+    :param seed: int, global seed
+    :param neuron_id: int, index of the neuron
+    :return: int, seed for random.seed()
+    """
+    return int(np.random.SeedSequence([seed, neuron_id]).generate_state(1)[0])
+
+
+def get_n_workers(dview):
+    """
+    Number of worker processes of a CaImAn cluster.
+    :param dview: multiprocessing Pool or ipyparallel view (from cm.cluster.setup_cluster())
+    :return: int, number of workers (number of CPUs if it cannot be determined)
+    """
+    if 'multiprocessing' in str(type(dview)):
+        n_workers = getattr(dview, '_processes', None)
+    else:
+        try:
+            n_workers = len(dview)
+        except TypeError:
+            n_workers = None
+    return n_workers if n_workers else os.cpu_count()
+
+
+def find_place_cells_chunk(args):
+    """
+    Worker function of PlaceCellFinder.find_place_cells_parallel(). Builds a lightweight PCF object without CNMF object
+    around SessionData objects of the memory-mapped session arrays and runs the place cell search on a chunk of neurons.
+    Without CNMF object, bootstrapping is only possible in its vectorized form (the default of bootstrapping()).
+    :param args: tuple of (neuron_ids, bin_avg_activity of these neurons, dict with paths of the shared session,
+                 session_trans and resting_mask arrays, params dict, global seed)
+    :return: tuple of place_results rows, place_cells and place_cells_reject of the chunk
+    """
+    neuron_ids, bin_avg_activity, shared, params, seed = args
+
+    resting_mask = np.load(shared['resting_mask'])
+
+    pcf = PlaceCellFinder.__new__(PlaceCellFinder)
+    pcf.cnmf = None
+    pcf.params = dict(params)
+    pcf.params['resting_mask'] = np.split(resting_mask, np.cumsum(params['frame_list'])[:-1])
+    pcf.params['place_results'] = np.zeros((params['n_neuron'], 5), dtype='bool')
+    pcf.session = SessionData(np.load(shared['session'], mmap_mode='r'), params['frame_list'], resting_mask)
+    session_trans = np.load(shared['session_trans'], mmap_mode='r')
+    if session_trans.dtype == bool:
+        pcf.session_trans = TransientData(pcf.session, session_trans)
+    else:
+        pcf.session_trans = SessionData(session_trans, params['frame_list'], resting_mask)
+    pcf.place_cells = []
+    pcf.place_cells_reject = []
+
+    for neuron_id, data in zip(neuron_ids.tolist(), bin_avg_activity):
+        random.seed(neuron_seed(seed, neuron_id))
+        pcf.find_place_field_neuron(data, neuron_id)
+
+    return pcf.params['place_results'][neuron_ids], pcf.place_cells, pcf.place_cells_reject
 
 
 class PlaceCellFinder:
@@ -55,8 +402,8 @@ class PlaceCellFinder:
         :param param_dict: dictionary that holds all parameters. All keys that are not initialized get default value.
         """
         self.cnmf = cnmf                # CNMF object that you obtain from the CaImAn pipeline
-        self.session = None             # List of neurons containing dF/F traces ordered by neurons and trials
-        self.session_spikes = None      # List of neurons containing spike probabilities ordered by neurons and trials
+        self.session = None             # SessionData with dF/F traces, can be indexed by session[neuron][trial]
+        self.session_spikes = None      # SessionData with spike probabilities, same structure as session
         self.session_trans = None       # Same as session, just with significant transients only (rest is 0)
         self.behavior = None            # Array containing behavioral data and frame time stamps (for alignment)
         self.bin_activity = None        # Same structure as session, but binned activity normalized to VR position
@@ -129,7 +476,7 @@ class PlaceCellFinder:
             # Get final trial directory list
             self.params['trial_list'] = [os.path.dirname(file) for file in file_list]
             # Get frame counts of all trials from merged_behavior files
-            self.params['frame_list'] = [int(np.sum(np.loadtxt(file)[:, 3])) for file in file_list]
+            self.params['frame_list'] = behavior_store.get_frame_counts(file_list)
 
         # Load mean intensity image
         self.params['mean_intensity_path'] = os.path.join(self.params['root'], 'mean_intensity_image.tif')
@@ -253,10 +600,11 @@ class PlaceCellFinder:
         Takes raw, across-trial DF/F traces from the CNMF object and splits it into separate trials using the frame
         counts provided in frame_list. In case bad trials occured in the session, they are filtered out and removed from
         trial_list and frame_list if self.params['excl_bad_trials'] == True.
-        It returns a "session" list of all neurons. Each neuron itself is a list of 1D arrays that hold the DF/F trace
-        for each trial in that session. "Session" can thus be indexed as session[number_neurons][number_trials].
+        It returns a "session" SessionData object that holds the DF/F traces of all neurons in one array, together with
+        the trial borders. "Session" can still be indexed as session[number_neurons][number_trials], which returns
+        the 1D trace of this trial as a view into the session array.
 
-        :return: Updated PCF object with the session list
+        :return: Updated PCF object with the session SessionData
         """
 
         if self.params['excl_bad_trials']:
@@ -287,135 +635,70 @@ class PlaceCellFinder:
             spikes = self.cnmf.estimates.spikes
             self.params['trial_excluded'] = False
         n_trials = len(self.params['frame_list'])
-
-        n_neuron = data.shape[0]
-        session = list(np.zeros(n_neuron))
-        session_spikes = list(np.zeros(n_neuron))
-        frame_list = self.params['frame_list']
-
-        for neuron in range(n_neuron):
-            curr_neuron = list(np.zeros(n_trials))  # initialize neuron-list
-            curr_neuron_spike = list(np.zeros(n_trials))  # initialize neuron-list
-            session_trace = data[neuron]            # temp-save session trace of this neuron
-            session_spike = spikes[neuron]  # temp-save session trace of this neuron
-
-            for trial in range(n_trials):
-                # extract trace of the current trial from the whole session
-                if len(session_trace) > frame_list[trial]:
-                    trial_trace, session_trace = session_trace[:frame_list[trial]], session_trace[frame_list[trial]:]
-                    curr_neuron[trial] = trial_trace  # save trial trace in this neuron's list
-                    trial_spike, session_spike = session_spike[:frame_list[trial]], session_spike[frame_list[trial]:]
-                    curr_neuron_spike[trial] = trial_spike  # save trial trace in this neuron's list
-                elif len(session_trace) == frame_list[trial]:
-                    curr_neuron[trial] = session_trace
-                    curr_neuron_spike[trial] = session_spike
-                else:
-                    print('Error in PlaceCellFinder.split_traces()')
-            session[neuron] = curr_neuron  # save data from this neuron to the big session list
-            session_spikes[neuron] = curr_neuron_spike  # save data from this neuron to the big session list
-
-        self.session = session
-        self.session_spikes = session_spikes
-        self.params['n_neuron'] = n_neuron
+        n_frames = int(np.sum(self.params['frame_list']))
+        if data.shape[1] < n_frames:
+            raise ValueError(f'Error in PlaceCellFinder.split_traces(): frame list has {n_frames} frames, '
+                             f'but the traces only have {data.shape[1]} frames.')
+
+        # frames beyond the last trial are ignored, the trial borders are stored in the SessionData objects
+        self.session = SessionData(np.asarray(data[:, :n_frames]), self.params['frame_list'])
+        self.session_spikes = SessionData(np.asarray(spikes[:, :n_frames]), self.params['frame_list'])
+        self.params['n_neuron'] = data.shape[0]
         self.params['n_trial'] = n_trials
 
         print('\nSuccessfully separated traces into trials and sorted them by neurons.'
               '\nResults are stored in pcf.session and pcf.session_spikes.\n')
 
-    def create_transient_only_traces(self):
+    def create_transient_only_traces(self, noise_method='kde'):
         """
         Takes the traces ordered by neuron and trial and modifies them into transient-only traces.
         Significant transients are detected using the full-width-half-maximum measurement of standard deviation (see
         Koay et al., 2019). The traces itself are left untouched, but all values outside of transients are set to 0.
         This is mainly useful for the place field criterion 3 (20% of time inside place field has to be transients).
-        The structure of the resulting list is the same as PCF.session (see split_traces_into_trials()).
+        The transient-only traces are stored as a TransientData object (a mask of significant transients on top of
+        PCF.session), which can be indexed like PCF.session (see split_traces_into_trials()).
         Additionally, the noise level sigma is saved for every neuron for each trial in params[sigma] as an array with
         the shape [n_neurons X n_trials] and can be indexed as such to retrieve noise levels for every trial.
-        :return: Updated PCF object with the significant-transient-only session_trans list
+        :param noise_method: str, estimator of the noise level, see standard_pipeline.noise_estimation.get_noise_level()
+        :return: Updated PCF object with the significant-transient-only session_trans TransientData
         """
-        session_trans = copy.deepcopy(self.session)
+        self.convert_session_data()
         self.params['sigma'] = np.zeros((self.params['n_neuron'], self.params['n_trial']))
         self.params['sigma'].fill(np.nan)
-        for neuron in range(self.params['n_neuron']):
-            curr_neuron = self.session[neuron]
-            for i in range(len(curr_neuron)):
-                trial = curr_neuron[i]
-                # get noise level of the data via FWHM
-                try:
-                    sigma = self.get_noise_fwhm(trial)
-                except ValueError:
-                    raise ValueError(f'No data for neuron {neuron}, trial {i}.')
-                self.params['sigma'][neuron][i] = sigma     # save noise level of current trial in the params dict
-                # get time points where the signal is more than 4x sigma (Koay et al., 2019)
-                if sigma == 0:
-                    idx = np.array([])
-                else:
-                    thresh = self.params['trans_thresh']
-                    if type(thresh) == int:    # use one threshold for borders of transient (Koay)
-                        idx = np.where(trial >= thresh * sigma)[0]
-                    elif type(thresh) == tuple:  # use different thresholds for on and offset of transients
-                        idx = np.where(trial >= thresh[0] * sigma)[0]
-                    else:
-                        raise Exception(f'Parameter "trans_thresh" has to be int or tuple, but was {type(thresh)}!')
-
-                if idx.size > 0:
-                    # split indices into consecutive blocks
-                    blocks = np.split(idx, np.where(np.diff(idx) != 1)[0] + 1)
-
-                    # if Dombecks criterion of 2-0.5 sigma should be used, the transient has to be extended
-                    if type(thresh) == tuple:
-                        for j in range(len(blocks)-1):
-                            # test if the transient comes back down to 0.5sigma at all until the end
-                            if np.all(trial[blocks[j][0]:] >= thresh[1] * sigma):
-                                # if this transient goes until the end, the last stop is the last index of the trial
-                                new_stop = len(trial)-1
-                            else:
-                                # otherwise find the index where it crosses the 2nd threshold
-                                new_stop = np.where(trial[blocks[j][0]:] <= thresh[1] * sigma)[0][0]
-                            blocks[j] = np.arange(blocks[j][0], blocks[j][0]+new_stop)
-
-                    # find blocks of >500 ms length (use frame rate in cnmf object) and merge them in one array
-                    duration = int(self.params['trans_length'] / (1 / self.cnmf.params.data['fr']))
-                    try:
-                        transient_idx = np.concatenate([x for x in blocks if x.size >= duration])
-                    except ValueError:
-                        transient_idx = []
-                else:
-                    transient_idx = []
-                # create a transient-only trace of the raw calcium trace
-                trans_only = trial.copy()
-                select = np.in1d(range(trans_only.shape[0]), transient_idx)  # create mask for trans-only indices
-                trans_only[~select] = 0     # set everything outside of this mask to 0
-                # add the transient only trace to the list
-                session_trans[neuron][i] = trans_only
-
-        # add the final data structure to the PCF object
-        self.session_trans = session_trans
+        # get noise level of the data via FWHM, for all neurons of a trial at once
+        for i in range(self.params['n_trial']):
+            try:
+                self.params['sigma'][:, i] = noise.get_noise_level(self.session.trial(i), noise_method)
+            except ValueError:
+                raise ValueError(f'No data for trial {i}.')
+
+        # find blocks of >500 ms length (use frame rate in cnmf object) above 4x sigma (Koay et al., 2019) in all
+        # neurons and trials at once, and store them as a mask on top of the dF/F data
+        duration = int(self.params['trans_length'] / (1 / self.cnmf.params.data['fr']))
+        trans_mask = detect_transients(self.session.traces, self.session.trial_offsets, self.params['sigma'],
+                                       self.params['trans_thresh'], duration)
+        self.session_trans = TransientData(self.session, trans_mask)
         print('\nSuccessfully created transient-only traces.\nThey are stored in pcf.session_trans.')
 
+    def convert_session_data(self):
+        """
+        Converts session, session_spikes and session_trans from the nested lists of older PCF objects into SessionData
+        objects. Objects that already hold SessionData are not changed.
+        """
+        for attr in ['session', 'session_spikes', 'session_trans']:
+            data = getattr(self, attr)
+            if data is not None and not isinstance(data, SessionData):
+                setattr(self, attr, SessionData.from_trial_lists(data, self.params.get('resting_mask')))
+
     def get_noise_fwhm(self, data):
         """
         Returns noise level as standard deviation (sigma) from a dataset using full-width-half-maximum
         (Koay et al. 2019). This method is less sensitive to long tails in the distribution (useful?).
-        :param data: dataset in a 1D array that you need the noise level from
+        :param data: dataset in a 1D array (or 2D array [n_traces x n_frames]) that you need the noise level from
         :return: noise: float, sigma of given dataset
         """
-        if np.all(data == 0): # catch trials without data
-            sigma = 0
-        else:
-            plt.figure()
-            x_data, y_data = sns.distplot(data).get_lines()[0].get_data()
-            y_max = y_data.argmax()  # get idx of half maximum
-            # get points above/below y_max that is closest to max_y/2 by subtracting it from the data and
-            # looking for the minimum absolute value
-            nearest_above = (np.abs(y_data[y_max:] - max(y_data) / 2)).argmin()
-            nearest_below = (np.abs(y_data[:y_max] - max(y_data) / 2)).argmin()
-            # get FWHM by subtracting the x-values of the two points
-            fwhm = x_data[nearest_above + y_max] - x_data[nearest_below]
-            # return noise level as FWHM/2.3548
-            sigma = fwhm/2.3548
-            plt.close()
-        return sigma
+        # the kernel density estimate is computed directly, without plotting it via seaborn
+        return noise.kde_fwhm(data)
 
     def import_behavior_and_align_traces(self, encoder_unit='raw'):
         """
@@ -424,7 +707,7 @@ class PlaceCellFinder:
             universal time stamp -- VR position -- lick sensor -- 2p trigger -- encoder (speed)
         Frames per bin are saved in bin_frame_count, an array of shape [n_bins x n_trials] showing the number of frames
         that have to be averaged for each bin in every trial (stored in params).
-        :param encoder_unit
+        :param encoder_unit: str, 'speed' or 'raw', unit of the encoder data used to detect resting frames
         :return: Updated PCF object with behavior and binned data
         """
         self.params['n_bins'] = int(self.params['track_length'] / self.params['bin_length'])
@@ -437,7 +720,7 @@ class PlaceCellFinder:
                 if len(path) >= 1:
                     # if there are more than 1 behavior file, load the latest
                     mod_times = [os.path.getmtime(file) for file in path]
-                    behavior.append(np.loadtxt(path[np.argmax(mod_times)], delimiter='\t'))
+                    behavior.append(behavior_store.load_behavior(path[np.argmax(mod_times)]))
                     count_list = int(self.params['frame_list'][count])
                     count_imp = int(np.nansum(behavior[-1][:, 3]))
                     if count_imp != count_list:
@@ -454,112 +737,16 @@ class PlaceCellFinder:
 
         self.behavior = behavior.copy()
 
-        # Get frame counts for each bin for complete dataset (moving and resting frames)
-        bin_frame_count_all = np.zeros((self.params['n_bins'], self.params['n_trial']), 'int')
-        for trial in range(len(behavior)):  # go through vr data of every trial and prepare it for analysis
-
-            # bin data in distance chunks
-            bin_borders = np.linspace(-10, 110, self.params['n_bins'])
-            idx = np.digitize(behavior[trial][:, 1], bin_borders)  # get indices of bins
-
-            # check how many frames are in each bin
-            for i in range(self.params['n_bins']):
-                bin_frame_count_all[i, trial] = np.nansum(behavior[trial][np.where(idx == i + 1), 3])
-
-        # double check if number of frames are correct
-        for i in range(len(self.params['frame_list'])):
-            frame_list_count = self.params['frame_list'][i]
-            if frame_list_count != np.sum(bin_frame_count_all[:, i]):
-                raise ValueError(f'Frame count not matching in trial {i + 1}: Frame list says {frame_list_count}, '
-                                 f'import says {np.sum(bin_frame_count_all[:, i])}')
-
-            # check that every bin has at least one frame in it
-        if np.any(bin_frame_count_all == 0):
-            all_zero_idx = np.where(bin_frame_count_all == 0)
-            # if not, take a frame of the next bin (or the previous bin in case its the last bin
-            for i in range(len(all_zero_idx[0])):
-                zero_idx = (all_zero_idx[0][i], all_zero_idx[1][i])
-                if zero_idx[0] == 79 and bin_frame_count_all[78, zero_idx[1]] > 1:
-                    bin_frame_count_all[78, zero_idx[1]] -= 1
-                    bin_frame_count_all[79, zero_idx[1]] += 1
-                elif zero_idx[0] < 79 and bin_frame_count_all[zero_idx[0]+1, zero_idx[1]] > 1:
-                    bin_frame_count_all[zero_idx[0]+1, zero_idx[1]] -= 1
-                    bin_frame_count_all[zero_idx[0], zero_idx[1]] += 1
-                else:
-                    raise ValueError('No frame in these bins (#bin, #trial): {}'.format(*zip(zero_idx[0], zero_idx[1])))
-
-        ##########################################################################################################
-        ##################### Get frame counts for each bin for only moving frames ###############################
-        # How to remove resting frames
-        # - for every trial, make a mask with length n_frames (one entry per frame) that is True for frames where
-        #   the mouse ran and False where the mouse was stationary
-        # - temporarily save the new frame list with new frame counts (check binned frames with this list)
-        # - update self.session
-
-        # create a bool mask for every trial that tells if a frame should be included or not
-        behavior_masks = []
-        for trial in range(len(behavior)):
-            # bool list for every frame of that trial (used to later filter out dff samples)
-            behavior_masks.append(np.ones(int(np.nansum(behavior[trial][:, 3])), dtype=bool))
-            frame_idx = np.where(behavior[trial][:, 3] == 1)[0]  # find sample_idx of all frames
-            for i in range(len(frame_idx)):
-                if i != 0:
-                    # TODO: implement smoothing speed (2 s window) before removing (after Harvey 2009)
-                    if encoder_unit == 'speed':
-                        if np.mean(behavior[trial][frame_idx[i - 1]:frame_idx[i], 5]) <= 2.5:
-                            # set index of mask to False (excluded in later analysis)
-                            behavior_masks[-1][i] = False
-                            # set the bad frame in the behavior array to 0 to skip it during bin_frame_counting
-                            behavior[trial][frame_idx[i], 3] = np.nan
-                    elif encoder_unit == 'raw':
-                        if abs(np.sum(behavior[trial][frame_idx[i - 1]:frame_idx[i], 4])) < 30:
-                            # set index of mask to False (excluded in later analysis)
-                            behavior_masks[-1][i] = False
-                            # set the bad frame in the behavior array to 0 to skip it during bin_frame_counting
-                            behavior[trial][frame_idx[i], 3] = np.nan
-                    else:
-                        pass
-                        #return print('Encoder unit not recognized, behavior could not be aligned.')
-                else:
-                    if behavior[trial][0, 4] > -30:
-                        behavior_masks[-1][i] = False
-                        behavior[trial][frame_idx[i], 3] = np.nan
-        self.params['resting_mask'] = behavior_masks
+        # Get running masks and frame counts per bin for all frames and only moving frames. Resting frames are
+        # removed from the behavior arrays (frame trigger set to NaN).
+        behavior_masks, bin_frame_count, bin_frame_count_all = align.align_behavior_to_bins(
+            behavior, self.params['n_bins'], self.params['frame_list'], encoder_unit)
 
-        # get new bin_frame_count
-        bin_frame_count = np.zeros((self.params['n_bins'], self.params['n_trial']), 'int')
-        for trial in range(len(behavior)):  # go through vr data of every trial and prepare it for analysis
-
-            # bin data in distance chunks
-            bin_borders = np.linspace(-10, 110, self.params['n_bins'])
-            idx = np.digitize(behavior[trial][:, 1], bin_borders)  # get indices of bins
-
-            # check how many frames are in each bin
-            for i in range(self.params['n_bins']):
-                bin_frame_count[i, trial] = np.nansum(behavior[trial][np.where(idx == i + 1), 3])
-
-        # check that every bin has at least one frame in it
-        if np.any(bin_frame_count == 0):
-            all_zero_idx = np.where(bin_frame_count == 0)
-            # create temporary copy that keeps frame count changes
-            bfc_copy = bin_frame_count.copy()
-            # if not, take a frame from the nearest non-zero bin
-            for i in range(len(all_zero_idx[0])):
-                zero_idx = (all_zero_idx[0][i], all_zero_idx[1][i])
-                # Get all non-zero indices of the current trial
-                non_zero_idx = np.nonzero(bin_frame_count[:, zero_idx[1]])[0]
-                # Find nearest non-zero index to the current zero idx of the current trial
-                nearest = non_zero_idx[np.argmin(abs(non_zero_idx - zero_idx[0]))]
-                # Take one frame from the nearest non-zero index and add it to the current zero bin (in the copy array)
-                bfc_copy[zero_idx] += 1
-                bfc_copy[nearest, zero_idx[1]] -= 1
-            # apply changes to the main array
-            bin_frame_count = bfc_copy
-            # Test again if bin count adjustment worked
-            if np.any(bin_frame_count == 0):
-                raise ValueError('Bins without any frames even after adjustment.')
-
-        ############################################################################################################
+        self.params['resting_mask'] = behavior_masks
+        self.convert_session_data()
+        for data in [self.session, self.session_spikes, self.session_trans]:
+            if data is not None:
+                data.set_resting_mask(behavior_masks)
 
         # if everything worked fine, we can save the frame count parameters
         self.params['bin_frame_count'] = bin_frame_count
@@ -585,27 +772,22 @@ class PlaceCellFinder:
                 remove_resting = True
                 print('Remove resting not provided. Default to True.')
 
-        # bin the activity for every neuron to the VR position, construct bin_activity and bin_avg_activity
-        self.bin_activity = []
-        self.bin_spike_rate = []
-        self.bin_avg_activity = np.zeros((self.params['n_neuron'], self.params['n_bins']))
-        self.bin_avg_spike_rate = np.zeros((self.params['n_neuron'], self.params['n_bins']))
-        for neuron in range(self.params['n_neuron']):
-            if remove_resting:
-                # if resting frames should be removed, mask data before binning (trial-wise)
-                self.params['resting_removed'] = remove_resting
-                n_bin_act, n_bin_avg_act, n_bin_spikes, n_bin_avg_spikes = \
-                    self.bin_neuron_activity_to_vr(self.session[neuron], self.session_spikes[neuron],
-                                                   bf_count=self.params['bin_frame_count'])
-            else:
-                self.params['resting_removed'] = remove_resting
-                n_bin_act, n_bin_avg_act, n_bin_spikes, n_bin_avg_spikes = \
-                    self.bin_neuron_activity_to_vr(self.session[neuron], self.session_spikes[neuron],
-                                                   bf_count=self.params['bin_frame_count_all'])
-            self.bin_activity.append(n_bin_act)
-            self.bin_spike_rate.append(n_bin_spikes)
-            self.bin_avg_activity[neuron, :] = n_bin_avg_act
-            self.bin_avg_spike_rate[neuron, :] = n_bin_avg_spikes
+        self.convert_session_data()
+        self.params['resting_removed'] = remove_resting
+        if remove_resting:
+            # if resting frames should be removed, mask data before binning (trial-wise)
+            bf_count = self.params['bin_frame_count']
+            resting_mask = np.concatenate(self.params['resting_mask'])
+        else:
+            bf_count = self.params['bin_frame_count_all']
+            resting_mask = None
+
+        # bin the activity of all neurons to the VR position at once, construct bin_activity and bin_avg_activity
+        bin_act, self.bin_avg_activity, bin_spikes, self.bin_avg_spike_rate = \
+            bin_session_activity(self.session.traces, self.session_spikes.traces, self.session.trial_offsets,
+                                 bf_count, self.cnmf.params.data['fr'], resting_mask)
+        self.bin_activity = list(bin_act)
+        self.bin_spike_rate = list(bin_spikes)
         print('\nSuccessfully aligned calcium data to the VR position bins.'
               '\nResults are stored in pcf.bin_activity and pcf.bin_avg_activity,\nbinned spike rates in '
               'pcf.bin_spike_rate and pcf.bin_avg_spike_rate.')
@@ -616,7 +798,8 @@ class PlaceCellFinder:
         for place cell analysis. Procedure for every trial: Algorithm goes through every bin and extracts the
         corresponding frames according to bin_frame_count.
         :param neuron_traces: list of arrays that contain the dF/F traces of a neuron. From self.session[n_neuron]
-        :param spikes: list of arrays that contain spike probabilities of a neuron. From self.session_spike[n_neuron]
+                              (list of trial views into the SessionData array)
+        :param spikes: list of arrays that contain spike probabilities of a neuron. From self.session_spikes[n_neuron]
         :param n_bins: int, number of bins the trace should be split into
         :param bf_count: np.array containing the number of frames in each bin
         :return: bin_activity (list of trials), bin_avg_activity (1D array) for this neuron
@@ -675,21 +858,98 @@ class PlaceCellFinder:
 
         return bin_activity, bin_avg_activity, bin_spike_rate, bin_avg_spike_rate
 
-    def find_place_cells(self, show_prog_bar=False):
+    def find_place_cells(self, show_prog_bar=False, n_jobs=1, dview=None, seed=None):
         """
         Wrapper function that checks every neuron for place fields by calling find_place_field_neuron().
         Also initializes params['place_results'], where results from place cell checks are stored for each neuron.
         Order of 'place_results': pre_screening -- is_large_enough -- is_strong_enough -- has_transients -- p<0.05
+        Neurons can be processed in parallel by a process pool (n_jobs > 1) or a CaImAn cluster (dview). The workers
+        only receive the data arrays they need through memory-mapped files (see find_place_cells_parallel()).
+        If a seed is given, the bootstrapping of every neuron gets its own random stream derived from the seed and the
+        neuron ID, so results do not depend on the number of workers.
+        :param show_prog_bar: bool flag whether a progress bar should be displayed
+        :param n_jobs: int, number of worker processes. Ignored if dview is provided.
+        :param dview: CaImAn cluster (from cm.cluster.setup_cluster()) that should be used for parallel processing
+        :param seed: int, seed of the per-neuron random streams. If None, no seeding happens for serial processing,
+                     and a random seed is drawn for parallel processing.
         :return: updated PCF object with place cell results
         """
+        self.convert_session_data()
         self.params['place_results'] = np.zeros((self.params['n_neuron'], 5), dtype='bool')
         self.place_cells = []
-        for i in range(self.bin_avg_activity.shape[0]):
-            self.find_place_field_neuron(self.bin_avg_activity[i, :], i)
-            if show_prog_bar:
-                progress(i+1, self.bin_avg_activity.shape[0], status='Processing neurons...', percent=False)
+        self.place_cells_reject = []
+        if n_jobs > 1 or dview is not None:
+            self.find_place_cells_parallel(n_jobs=n_jobs, dview=dview, seed=seed, show_prog_bar=show_prog_bar)
+        else:
+            for i in range(self.bin_avg_activity.shape[0]):
+                if seed is not None:
+                    random.seed(neuron_seed(seed, i))
+                self.find_place_field_neuron(self.bin_avg_activity[i, :], i)
+                if show_prog_bar:
+                    progress(i+1, self.bin_avg_activity.shape[0], status='Processing neurons...', percent=False)
         print(f'Done! {len(self.place_cells)} place cells found in total!')
 
+    def find_place_cells_parallel(self, n_jobs=None, dview=None, seed=None, show_prog_bar=False):
+        """
+        Parallel backend of find_place_cells(). Neurons are split into chunks that are processed by
+        find_place_cells_chunk() in separate processes. Session traces, transient-only traces and resting masks are
+        stored once as .npy files in a temporary directory and memory-mapped by the workers, so the PCF object (and its
+        CNMF object) is never pickled. Results are merged back in neuron order.
+        The workers do not have the CNMF object, so only the vectorized bootstrapping can be used.
+        :param n_jobs: int, number of worker processes of the process pool. None uses all CPUs. Ignored if dview is
+                        provided, then the number of workers of the cluster is used.
+        :param dview: CaImAn cluster that should be used instead of a new process pool.
+        :param seed: int, seed of the per-neuron random streams. A random seed is drawn if None.
+        :param show_prog_bar: bool flag whether a progress bar should be displayed
+        """
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.params['random_seed'] = seed
+
+        # parameters are sent to every chunk, so the large entries are left out (the mask is shared separately)
+        worker_params = {key: value for key, value in self.params.items()
+                         if key not in ['mean_intensity_image', 'resting_mask', 'place_results']}
+
+        temp_dir = tempfile.mkdtemp(prefix='pcf_')
+        try:
+            shared = {'session': os.path.join(temp_dir, 'session.npy'),
+                      'session_trans': os.path.join(temp_dir, 'session_trans.npy'),
+                      'resting_mask': os.path.join(temp_dir, 'resting_mask.npy')}
+            np.save(shared['session'], self.session.traces)
+            if isinstance(self.session_trans, TransientData):
+                np.save(shared['session_trans'], self.session_trans.mask)
+            else:
+                np.save(shared['session_trans'], self.session_trans.traces)
+            np.save(shared['resting_mask'], np.concatenate(self.params['resting_mask']))
+
+            if dview is not None:
+                n_jobs = get_n_workers(dview)
+            elif n_jobs is None:
+                n_jobs = os.cpu_count()
+            chunks = np.array_split(np.arange(self.params['n_neuron']), min(self.params['n_neuron'], 4 * n_jobs))
+            args = [(chunk, self.bin_avg_activity[chunk], shared, worker_params, seed) for chunk in chunks]
+
+            if dview is not None:
+                if 'multiprocessing' in str(type(dview)):
+                    results = dview.map_async(find_place_cells_chunk, args).get(4294967)
+                else:
+                    results = dview.map_sync(find_place_cells_chunk, args)
+            else:
+                results = []
+                with multiprocessing.Pool(n_jobs) as pool:
+                    for result in pool.imap(find_place_cells_chunk, args):
+                        results.append(result)
+                        if show_prog_bar:
+                            progress(len(results), len(args), status='Processing neuron chunks...', percent=False)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # merge results of all chunks back in neuron order
+        for chunk, (place_results, place_cells, place_cells_reject) in zip(chunks, results):
+            self.params['place_results'][chunk] = place_results
+            self.place_cells.extend(place_cells)
+            self.place_cells_reject.extend(place_cells_reject)
+
     def find_place_field_neuron(self, data, neuron_id):
         """
         Performs place field analysis (smoothing, pre-screening and criteria application) on a single neuron data set.
@@ -844,7 +1104,7 @@ class PlaceCellFinder:
                 curr_place_frames = (np.sum(self.params['bin_frame_count'][:place_field[0], trial]),
                                      np.sum(self.params['bin_frame_count'][:place_field[-1] + 1, trial]))
                 # use masked session_trans data to remove resting frames
-                sess_trans_masked = self.session_trans[neuron_id][trial][self.params['resting_mask'][trial]]
+                sess_trans_masked = self.session_trans.trace(neuron_id, trial)[self.params['resting_mask'][trial]]
                 # attach the transient-only trace in the place field during this trial to the array
                 place_frames_trace.append(sess_trans_masked[curr_place_frames[0]:curr_place_frames[1] + 1])
             else:
@@ -852,7 +1112,7 @@ class PlaceCellFinder:
                                      np.sum(self.params['bin_frame_count_all'][:place_field[-1] + 1, trial]))
                 # attach the transient-only trace in the place field during this trial to the array
                 place_frames_trace.append(
-                    self.session_trans[neuron_id][trial][curr_place_frames[0]:curr_place_frames[1] + 1])
+                    self.session_trans.trace(neuron_id, trial)[curr_place_frames[0]:curr_place_frames[1] + 1])
 
         # create one big 1D array that includes all frames where the mouse was located in the place field
         # as this is the transient-only trace, we make it boolean, with False = no transient and True = transient
@@ -860,19 +1120,29 @@ class PlaceCellFinder:
         # check if at least 'trans_time' percent of the frames are part of a significant transient
         return np.sum(place_frames_trace) >= self.params['trans_time'] * place_frames_trace.shape[0]
 
-    def bootstrapping(self, neuron_id):
+    def bootstrapping(self, neuron_id, n_shuffle=1000, vectorized=True):
         """
         Performs bootstrapping on a unbinned dF/F trace and returns p-value for a place cell in this trace.
         The trace is divided in parts with 'split_size' length which are randomly shuffled 1000 times. Then, place cell
         detection is performed on each shuffled trace. The p-value is defined as the ratio of place cells detected in
         the shuffled traces versus number of shuffles (1000; see Dombeck et al., 2010). If this neuron's trace gets a
         p-value of p < 0.05 (place fields detected in less than 50 shuffles), the place field is accepted.
+        By default, all shuffles are created, binned and checked at once (see bootstrapping_vectorized()). Both modes
+        draw the shuffles from the same random stream and thus give the same p-value for the same random.seed().
 
         :param neuron_id: 1D array of index of the checked neuron in the session list
+        :param n_shuffle: int, number of shuffles that are performed
+        :param vectorized: bool flag whether all shuffles should be processed in one array, or one after the other
         :return: p-value of place fields in this neuron
         """
+        if vectorized:
+            return self.bootstrapping_vectorized(neuron_id, n_shuffle)
+        if self.cnmf is None:
+            raise ValueError('The bootstrapping loop needs the frame rate of the CNMF object, which is not available in '
+                             'the workers of find_place_cells_parallel(). Use vectorized=True instead.')
+
         p_counter = 0
-        for i in range(1000):
+        for i in range(n_shuffle):
             # create shuffled neuron data by shuffling every trial
             shuffle = []
             for trial in self.session[neuron_id]:
@@ -904,7 +1174,161 @@ class PlaceCellFinder:
                 if len(place_fields_passed) > 0:
                     p_counter += 1
 
-        return p_counter/1000   # return p-value of this neuron (number of place fields after 1000 shuffles)
+        return p_counter/n_shuffle   # return p-value of this neuron (number of place fields after 1000 shuffles)
+
+    def bootstrapping_vectorized(self, neuron_id, n_shuffle=1000):
+        """
+        Vectorized version of bootstrapping(). All shuffles are represented as one permutation-index array with shape
+        [n_shuffle x n_frames], binned together through a segment reduction over bin_frame_count, and the three place
+        field criteria are evaluated on the whole [n_shuffle x n_bins] block at once.
+
+        :param neuron_id: 1D array of index of the checked neuron in the session list
+        :param n_shuffle: int, number of shuffles that are performed
+        :return: p-value of place fields in this neuron
+        """
+        shuffle_idx = self.get_shuffle_indices(self.session.frame_list, n_shuffle)
+        bin_avg_act = self.bin_shuffled_activity(self.session.neuron(neuron_id), shuffle_idx)
+
+        # perform place cell analysis on binned and trial-averaged activity of all shuffled traces
+        smooth_traces = self.smooth_traces(bin_avg_act)
+        passed = self.apply_pf_criteria_block(smooth_traces, neuron_id)
+
+        return np.sum(passed)/n_shuffle
+
+    def get_shuffle_indices(self, trial_lengths, n_shuffle):
+        """
+        Creates the frame order of n_shuffle shuffled traces for bootstrapping. Every trial is divided into parts with
+        'split_size' length (plus the remainder), and the parts are randomly reordered within the trial.
+        The permutations are drawn with random.sample() in the same order as in the serial bootstrapping() loop, so
+        the same random.seed() results in the same shuffles.
+
+        :param trial_lengths: list of int, number of frames in every trial of the neuron
+        :param n_shuffle: int, number of shuffles that are created
+        :return: int array with shape [n_shuffle x n_frames] holding the session-wide frame index for every frame of
+                 every shuffled trace (trials concatenated)
+        """
+        split_size = self.params['split_size']
+        trial_offsets = np.concatenate(([0], np.cumsum(trial_lengths)))
+
+        # get start and length of all splits of every trial (last split holds the remainder and can be empty)
+        split_starts, split_lengths = [], []
+        for length in trial_lengths:
+            div_length = length - length % split_size
+            split_starts.append(np.arange(0, div_length + 1, split_size))
+            split_lengths.append(np.append(np.full(div_length // split_size, split_size), length - div_length))
+
+        # draw the split order of every trial in every shuffle
+        orders = [np.zeros((n_shuffle, len(starts)), dtype=int) for starts in split_starts]
+        for i in range(n_shuffle):
+            for trial, starts in enumerate(split_starts):
+                orders[trial][i] = random.sample(range(len(starts)), len(starts))
+
+        shuffle_idx = np.zeros((n_shuffle, trial_offsets[-1]), dtype=int)
+        for trial, (starts, lengths, order) in enumerate(zip(split_starts, split_lengths, orders)):
+            # expand the reordered splits into frame indices, relative to the start of the trial
+            order_lengths = lengths[order].ravel()
+            rel_idx = np.arange(n_shuffle * trial_lengths[trial]) - np.repeat(np.cumsum(order_lengths) - order_lengths,
+                                                                              order_lengths)
+            rel_idx += np.repeat(starts[order].ravel(), order_lengths)
+            shuffle_idx[:, trial_offsets[trial]:trial_offsets[trial+1]] = \
+                rel_idx.reshape(n_shuffle, trial_lengths[trial]) + trial_offsets[trial]
+
+        return shuffle_idx
+
+    def bin_shuffled_activity(self, trace, shuffle_idx):
+        """
+        Bins many shuffled versions of a neuron's trace to the VR position at once, using bin_frame_count as segment
+        borders (same procedure as bin_neuron_activity_to_vr()).
+
+        :param trace: 1D array, trace of all trials of one neuron concatenated, e.g. self.session.neuron(n)
+        :param shuffle_idx: int array with shape [n_shuffle x n_frames], from get_shuffle_indices()
+        :return: array with shape [n_shuffle x n_bins], binned activity of every shuffle averaged across trials
+        """
+        if self.params['resting_removed']:
+            bin_frame_count = self.params['bin_frame_count']
+        else:
+            bin_frame_count = self.params['bin_frame_count_all']
+        n_bins = bin_frame_count.shape[0]
+        trial_offsets = np.concatenate(([0], np.cumsum(self.params['frame_list'])))
+
+        bin_activity = np.zeros((shuffle_idx.shape[0], self.params['n_trial'], n_bins))
+        for trial in range(self.params['n_trial']):
+            curr_idx = shuffle_idx[:, trial_offsets[trial]:trial_offsets[trial+1]]
+            if self.params['resting_removed']:
+                curr_idx = curr_idx[:, self.params['resting_mask'][trial]]
+            curr_bins = bin_frame_count[:, trial]
+            if curr_idx.shape[1] < np.sum(curr_bins):
+                raise Exception('Something went wrong during binning...')
+
+            # sum up the frames of each bin in one reduction (empty bins stay 0), then divide by the frame count
+            has_frames = curr_bins > 0
+            bin_starts = np.cumsum(curr_bins) - curr_bins
+            bin_sums = np.zeros((shuffle_idx.shape[0], n_bins))
+            if np.any(has_frames):
+                bin_sums[:, has_frames] = np.add.reduceat(trace[curr_idx[:, :np.sum(curr_bins)]],
+                                                          bin_starts[has_frames], axis=1)
+            bin_activity[:, trial, has_frames] = bin_sums[:, has_frames] / curr_bins[has_frames]
+
+        # Get average activity across trials for every bin of every shuffle
+        return np.mean(bin_activity, axis=1)
+
+    def smooth_traces(self, traces):
+        """
+        Same as smooth_trace(), but for many traces at once.
+
+        :param traces: 2D array with shape [n_traces x n_points]
+        :return: array of the same shape as input traces, but smoothed along axis 1
+        """
+        n_points = traces.shape[1]
+        window = self.params['bin_window_avg']
+        left = np.maximum(np.arange(n_points) - window, 0)
+        right = np.minimum(np.arange(n_points) + window, n_points)
+        cum_traces = np.concatenate((np.zeros((traces.shape[0], 1)), np.cumsum(traces, axis=1)), axis=1)
+        return (cum_traces[:, right] - cum_traces[:, left]) / (right - left)
+
+    def apply_pf_criteria_block(self, traces, neuron_id):
+        """
+        Pre-screens many traces and applies the three place field criteria (see apply_pf_criteria()) to all potential
+        place fields at once. Used for the shuffled traces during bootstrapping, so results are not saved.
+
+        :param traces: 2D array with shape [n_traces x n_bins], smoothed binned traces (from smooth_traces())
+        :param neuron_id: Index of current neuron in the session_trans list. Needed for criterion 3.
+        :return: 1D bool array with shape [n_traces], True if the trace has at least one place field that passed
+        """
+        # pre-screening (see pre_screen_place_fields())
+        f_max = np.max(traces, axis=1)
+        f_base = np.mean(np.sort(traces, axis=1)[:, :int(traces.shape[1] * self.params['bin_base'])], axis=1)
+        f_thresh = ((f_max - f_base) * self.params['place_thresh']) + f_base
+        above = traces >= f_thresh[:, None]
+
+        # split above-threshold bins into consecutive blocks (stop index is exclusive)
+        edges = np.diff(np.pad(above.astype(int), ((0, 0), (1, 1))), axis=1)
+        field_trace, field_start = np.where(edges == 1)
+        field_stop = np.where(edges == -1)[1]
+
+        # criterion 1: size of the place field
+        bin_size = (field_stop - field_start) >= self.params['min_bin_size']
+
+        # criterion 2: mean activity inside the field vs. outside all fields of the trace
+        cum_traces = np.concatenate((np.zeros((traces.shape[0], 1)), np.cumsum(traces, axis=1)), axis=1)
+        mean_inside = (cum_traces[field_trace, field_stop] - cum_traces[field_trace, field_start]) / \
+                      (field_stop - field_start)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_outside = np.sum(np.where(above, 0, traces), axis=1) / np.sum(~above, axis=1)
+        intensity = mean_inside >= self.params['fluo_infield'] * mean_outside[field_trace]
+
+        # criterion 3: transients only depend on the field location, so each unique field is only checked once
+        transients = np.zeros(field_start.shape, dtype=bool)
+        checked_fields = {}
+        for i in np.where(bin_size & intensity)[0]:
+            field = (field_start[i], field_stop[i])
+            if field not in checked_fields:
+                checked_fields[field] = self.has_enough_transients(neuron_id, np.arange(*field))
+            transients[i] = checked_fields[field]
+
+        passed = np.zeros(traces.shape[0], dtype=bool)
+        passed[field_trace[bin_size & intensity & transients]] = True
+        return passed
 
     def reject_place_cells(self, rej):
         """
@@ -966,10 +1390,7 @@ class PlaceCellFinder:
         """
         # get activity and position data
         data_all = getattr(self.cnmf.estimates, trace).T
-        position_all = []
-        for trial in range(len(self.behavior)):
-            position_all.append(self.behavior[trial][np.where(self.behavior[trial][:, 3] == 1), 1])
-        position_all = np.hstack(position_all).T
+        position_all = np.hstack([trial[np.where(trial[:, 3] == 1)[0], 1] for trial in self.behavior])
 
         # calculate number of bins
         if bin_width is None and n_bins is None:
@@ -990,21 +1411,8 @@ class PlaceCellFinder:
                 raise Exception('Bin_width and n_bins result in contradicting bin numbers!')
 
         if remove_stationary:
-        # remove samples where the mouse was stationary (less than 30 movement per frame)
-            behavior_masks = []
-            for trial in self.behavior:
-                behavior_masks.append(
-                    np.ones(int(np.nansum(trial[:, 3])), dtype=bool))  # bool list for every frame of that trial
-                frame_idx = np.where(trial[:, 3] == 1)[0]  # find sample_idx of all frames
-                for i in range(len(frame_idx)):
-                    if i != 0:
-                        # make index of the current frame False if the mouse didnt move much during the frame
-                        if np.nansum(trial[frame_idx[i - 1]:frame_idx[i], 4]) > -30:
-                            behavior_masks[-1][i] = False
-                    else:
-                        if trial[0, 4] > -30:
-                            behavior_masks[-1][i] = False
-            behavior_mask = np.hstack(behavior_masks)
+            # remove samples where the mouse was stationary (less than 30 movement per frame)
+            behavior_mask = np.hstack([align.get_forward_running_mask(trial) for trial in self.behavior])
             data = data_all[behavior_mask]
             position = position_all[behavior_mask]
         else:
@@ -1020,33 +1428,14 @@ class PlaceCellFinder:
         bin_borders = np.linspace(-10, 110, n_bins)
         idx = np.digitize(position, bin_borders)  # get indices of bins
 
-        # get fraction of bin occupancy
-        unique_elements, counts_elements = np.unique(idx, return_counts=True)
-        bin_freq = np.array([x / np.sum(counts_elements) for x in counts_elements])
-
-        # get mean spikes/s for each bin
-        bin_mean_act = np.zeros((n_bins, data.shape[1]))
-        for bin_nr in range(n_bins):
-            curr_bin_idx = np.where(idx == bin_nr + 1)[0]
-            bin_act = data[curr_bin_idx]
-            # bin_mean_act[bin_nr, :] = np.sum(bin_act, axis=0) / (bin_act.shape[0] / 30)
-            bin_mean_act[bin_nr, :] = np.mean(bin_act, axis=0)
-        # total_firing_rate = np.sum(data, axis=0) / (data.shape[0] / 30)
-        total_firing_rate = np.mean(data, axis=0)
-
-        # calculate spatial information content
-        spatial_info = np.zeros(len(total_firing_rate))
-        for cell in range(len(total_firing_rate)):
-            curr_trace = bin_mean_act[:, cell]
-            tot_act = total_firing_rate[cell]  # this is the total dF/F averaged across all bins
-            bin_si = np.zeros(n_bins)  # initialize array that holds SI value for each bin
-            for i in range(n_bins):
-                # apply the SI formula to every bin
-                if curr_trace[i] <= 0 or tot_act <= 0:
-                    bin_si[i] = 0
-                else:
-                    bin_si[i] = curr_trace[i] / tot_act * np.log(curr_trace[i] / tot_act) * bin_freq[i]
-            spatial_info[cell] = np.sum(bin_si)
+        # get fraction of bin occupancy and mean dF/F of every cell in each bin
+        bin_freq = si_kernel.bin_occupancy(idx, n_bins, rank_order=True)
+        bin_mean_act = si_kernel.bin_activity(data, idx, n_bins)
+        total_firing_rate = np.mean(data, axis=0)  # this is the total dF/F averaged across all bins
+
+        # calculate spatial information content (in nats, silent bins contribute 0)
+        spatial_info = si_kernel.skaggs_si(bin_mean_act, bin_freq, mean_act=total_firing_rate, log_base=np.e,
+                                           normalize=True, invalid='zero')
 
         if save:
             self.spatial_info = spatial_info
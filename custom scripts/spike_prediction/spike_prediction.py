@@ -8,6 +8,34 @@ from keras.models import load_model
 from keras import backend as K
 
 
+# Loaded models, with the path of their .h5 file as key. Models are loaded once and reused by every call of
+# predict_spikes(), use clear_model_cache() to remove them from memory.
+_model_cache = {}
+
+
+def get_model(model_path, verbose=False):
+    """
+    Returns the Keras model stored at model_path. Models are only loaded from disk at the first call and then kept in
+    the module-level model cache.
+    :param model_path: str, path of the .h5 file of the model
+    :param verbose: bool flag whether to print out when a model is loaded from disk
+    :return: Keras model
+    """
+    if model_path not in _model_cache:
+        if verbose:
+            print('Loading model ' + model_path)
+        _model_cache[model_path] = load_model(model_path)
+    return _model_cache[model_path]
+
+
+def clear_model_cache():
+    """
+    Removes all cached models and clears the Keras session to free their memory.
+    """
+    _model_cache.clear()
+    K.clear_session()
+
+
 def get_noise_levels(traces, framerate):
     """
     Calculates noise level for each neuron of an array of dF/F calcium traces (one recording session).
@@ -15,20 +43,28 @@ def get_noise_levels(traces, framerate):
     :param framerate: int, frame rate of recording
     :return: np.array with shape (#neurons, ) containing one noise level value of this session for each neuron
     """
+    return np.nanmedian(np.abs(np.diff(traces, axis=0)), axis=0) / np.sqrt(framerate)
 
-    nb_neurons = traces.shape[1]
-
-    noise_levels = np.nan * np.zeros((nb_neurons,))
-    for neuron in range(nb_neurons):
-        noise_levels[neuron] = np.nanmedian(np.abs(np.diff(traces[:, neuron]))) / np.sqrt(framerate)
 
-    return noise_levels
+def get_window_view(dF_traces, windowsize):
+    """
+    Returns all windows of length 'windowsize' of the calcium traces as a read-only view (no data is copied). Window i
+    of a neuron holds timepoints i to i + windowsize - 1. As in the original preprocessing, the last possible window
+    is not used.
+    :param dF_traces: np.array with shape (#timepoints, #neurons) containing dF/F traces
+    :param windowsize: int, number of timepoints in one window
+    :return: np.array view with shape (#neurons, #timepoints - windowsize, windowsize)
+    """
+    n_windows = max(dF_traces.shape[0] - windowsize, 0)
+    return np.lib.stride_tricks.as_strided(dF_traces, shape=(dF_traces.shape[1], n_windows, windowsize),
+                                           strides=(dF_traces.strides[1], dF_traces.strides[0], dF_traces.strides[0]),
+                                           writeable=False)
 
 
 def preprocess_test_dataset(dF_traces, before_frac, windowsize, after_frac):
     """
     Creates a large matrix X that contains for each timepoint of each calcium trace a vector of
-    length 'windowsize' around the timepoint.
+    length 'windowsize' around the timepoint. Use get_window_view() to avoid creating the whole matrix in memory.
     :param dF_traces: np.array with shape (#timepoints, #neurons) containing dF/F traces of one or more sessions
     :return: np.array with shape (#neurons, #timepoints, #windowsize)
     """
@@ -40,14 +76,13 @@ def preprocess_test_dataset(dF_traces, before_frac, windowsize, after_frac):
 
     X = np.nan * np.zeros((nb_neurons, nb_timepoints, windowsize,))
 
-    for neuron in range(nb_neurons):
-        for timepoint in range(nb_timepoints - windowsize):
-            X[neuron, timepoint + before, :] = dF_traces[timepoint:(timepoint + before + after), neuron]
+    windows = get_window_view(dF_traces, before + after)
+    X[:, before:before + windows.shape[1], :] = windows
 
     return X
 
 
-def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verbose=False):
+def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verbose=False, max_memory=2**28):
     """
     Perform Peters spike prediction on a single session of dF/F traces.
     :param data: np.array, shape (#neurons, #timestamps) of dF/F traces, e.g. directly from cnmf.estimates.F_dff
@@ -55,6 +90,8 @@ def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verb
     :param thresh: bool flag whether prediction should be thresholded (avoids spike overestimation of noise)
     :param plot_noise_levels: bool flag whether noise levels of the data should be plotted as a histogram
     :param verbose: bool flag whether to print out progress messages during analysis
+    :param max_memory: int, maximum size in bytes of the windows that are passed to the models at once. Neurons are
+                       processed in chunks that fit into this limit.
     :return: np.array with shape (#neurons, #timestamps) containing summable spike predictions for every neuron
     """
 
@@ -103,22 +140,13 @@ def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verb
         noise_levels_model = np.arange(2, 3 + 1)
     nb_noise_levels = len(noise_levels_model)
 
-    ## Load pretrained model
-    set_of_models = [[None] * params['ensemble_size'] for _ in range(nb_noise_levels)]
-
-    # Load every pre-trained ensemble model for every noise level present in the dataset
-    for noise_level_index, noise_level in enumerate(noise_levels_model):
-        for ensemble in range(params['ensemble_size']):
-            if verbose:
-                print('Loading model ' + str(ensemble + 1) + ' with noise level ' + str(noise_level))
-            model_directory = os.path.join(params['pretrained_model_folder'],
-                                           'Model_noise_' + str(int(noise_level)) + '_' + str(ensemble) + '.h5')
-            set_of_models[noise_level_index][ensemble] = load_model(model_directory)
-
     ## Process test data and predict spikes
-    XX = preprocess_test_dataset(data, params['before_frac'], params['windowsize'], params['after_frac'])
+    before = int(params['before_frac'] * params['windowsize'])
+    windows = get_window_view(np.asarray(data, dtype=np.float32),
+                              before + int(params['after_frac'] * params['windowsize']))
+    neurons_per_chunk = max(1, int(max_memory // max(windows.shape[1] * windows.shape[2] * 4, 1)))
 
-    Y_predict = np.zeros((XX.shape[0], XX.shape[1]))
+    Y_predict = np.zeros((data.shape[1], data.shape[0]))
 
     for model_noise_index, model_noise in enumerate(noise_levels_model):
 
@@ -133,15 +161,22 @@ def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verb
         else:
             neurons_ixs = np.where((noise_levels_all < model_noise) & (noise_levels_all >= model_noise - 1))[0]
 
-        calcium_this_noise = XX[neurons_ixs, :, :]  # / 100  (division by 100 if dF/F input was in %)
-        calcium_this_noise = np.reshape(calcium_this_noise, (calcium_this_noise.shape[0] * calcium_this_noise.shape[1],
-                                                             calcium_this_noise.shape[2]))
+        # Load every pre-trained ensemble model for this noise level (only once, then they are cached)
+        models = [get_model(os.path.join(params['pretrained_model_folder'],
+                                         'Model_noise_' + str(int(model_noise)) + '_' + str(ensemble) + '.h5'),
+                            verbose=verbose)
+                  for ensemble in range(params['ensemble_size'])]
+
+        for chunk_start in range(0, len(neurons_ixs), neurons_per_chunk):
+            chunk_ixs = neurons_ixs[chunk_start:chunk_start + neurons_per_chunk]
+
+            # Copy windows of the chunk and merge neurons and timepoints into one dimension
+            calcium_this_noise = windows[chunk_ixs].reshape(-1, windows.shape[2])  # / 100  (if dF/F input was in %)
 
-        for ensemble in range(params['ensemble_size']):
-            prediction = set_of_models[model_noise_index][ensemble].predict(np.expand_dims(calcium_this_noise, axis=2),
-                                                                            batch_size=4096)
-            prediction = np.reshape(prediction, (len(neurons_ixs), XX.shape[1]))
-            Y_predict[neurons_ixs, :] += prediction / params['ensemble_size']
+            for model in models:
+                prediction = model.predict(np.expand_dims(calcium_this_noise, axis=2), batch_size=4096)
+                prediction = np.reshape(prediction, (len(chunk_ixs), windows.shape[1]))
+                Y_predict[chunk_ixs, before:before + windows.shape[1]] += prediction / params['ensemble_size']
 
     # NaN for first and last datapoints, for which no predictions can be made
     Y_predict[:, 0:int(params['before_frac'] * params['windowsize'])] = np.nan
@@ -163,7 +198,4 @@ def predict_spikes(data, params=None, thresh=True, plot_noise_levels=False, verb
         params['thresh'] = np.max(gauss)/np.exp(1)          # Threshold is the peak of one spike div. by exponential factor
         Y_predict[Y_predict < params['thresh']] = 0
 
-    # Clear Keras models from memory (otherwise, they accumulate and slow down things)
-    K.clear_session()
-
     return Y_predict
@@ -73,7 +73,7 @@ def quick_screen_session(path):
     for step in os.walk(path):
         if len(step[2]) > 0:
             for file in step[2]:
-                if 'merged_behavior' in file and os.path.join(step[0], file) not in file_list:
+                if 'merged_behavior' in file and file.endswith('.txt') and os.path.join(step[0], file) not in file_list:
                     file_list.append(os.path.join(step[0], file))
     file_list.sort(key=natural_keys)       # order files according to trial number (otherwise 11 is before 2)
 
@@ -0,0 +1,186 @@
+import numpy as np
+
+# Column indices of the merged_behavior.txt arrays
+POSITION_COL = 1
+TRIGGER_COL = 3
+ENCODER_COL = 4
+SPEED_COL = 5
+
+
+def get_frame_samples(behavior):
+    """
+    Finds the samples of a behavior array at which a frame trigger was recorded.
+    :param behavior: 2D array of one trial (merged_behavior.txt)
+    :return: 1D array with the sample indices of all frame triggers
+    """
+    return np.where(behavior[:, TRIGGER_COL] == 1)[0]
+
+
+def get_resting_frames(behavior, encoder_unit='raw', speed_thresh=2.5, raw_thresh=30):
+    """
+    Finds frames during which the mouse was stationary. Encoder data of all samples between the previous and the
+    current frame trigger are reduced at once with np.add.reduceat instead of slicing the behavior array for every frame.
+    The first frame is resting if the first encoder sample is larger than -raw_thresh (behavior of the original loop).
+    :param behavior: 2D array of one trial (merged_behavior.txt)
+    :param encoder_unit: str, 'speed' (average speed in cm/s of column 5 is compared to speed_thresh) or 'raw' (summed
+                         encoder ticks of column 4 are compared to raw_thresh). Other units only check the first frame.
+    :param speed_thresh: float, frames with a mean speed at or below this value are resting
+    :param raw_thresh: float, frames with less absolute encoder ticks than this value are resting
+    :return: 1D bool array with one entry per frame trigger, True if the frame is resting
+    """
+    frame_idx = get_frame_samples(behavior)
+    resting = np.zeros(len(frame_idx), dtype=bool)
+    if len(frame_idx) == 0:
+        return resting
+
+    if len(frame_idx) > 1 and encoder_unit in ('speed', 'raw'):
+        col = SPEED_COL if encoder_unit == 'speed' else ENCODER_COL
+        # sums of samples [frame_idx[i-1], frame_idx[i]) for every frame i > 0
+        seg_sums = np.add.reduceat(behavior[:frame_idx[-1], col], frame_idx[:-1])
+        if encoder_unit == 'speed':
+            resting[1:] = seg_sums / np.diff(frame_idx) <= speed_thresh
+        else:
+            resting[1:] = np.abs(seg_sums) < raw_thresh
+
+    resting[0] = behavior[0, ENCODER_COL] > -raw_thresh
+    return resting
+
+
+def remove_resting_frames(behavior, encoder_unit='raw'):
+    """
+    Creates the running mask of one trial and removes the frame trigger of resting frames (set to NaN) in the behavior
+    array, so that they are skipped during bin frame counting. The behavior array is changed in-place.
+    :param behavior: 2D array of one trial (merged_behavior.txt)
+    :param encoder_unit: str, 'speed' or 'raw', see get_resting_frames()
+    :return: 1D bool array with one entry per frame, True for frames where the mouse was running
+    """
+    frame_idx = get_frame_samples(behavior)
+    resting = get_resting_frames(behavior, encoder_unit)
+    mask = np.ones(int(np.nansum(behavior[:, TRIGGER_COL])), dtype=bool)
+    mask[:len(resting)] = ~resting
+    behavior[frame_idx[resting], TRIGGER_COL] = np.nan
+    return mask
+
+
+def get_forward_running_mask(behavior, thresh=30):
+    """
+    Creates the running mask used for spatial information: a frame counts as running if the encoder registered at
+    least thresh ticks of forward movement (negative encoder values) since the previous frame. NaNs are ignored.
+    The first frame is running if the first encoder sample is at or below -thresh.
+    :param behavior: 2D array of one trial (merged_behavior.txt)
+    :param thresh: float, number of forward encoder ticks per frame above which the mouse is running
+    :return: 1D bool array with one entry per frame, True for frames where the mouse was running
+    """
+    frame_idx = get_frame_samples(behavior)
+    mask = np.ones(int(np.nansum(behavior[:, TRIGGER_COL])), dtype=bool)
+    if len(frame_idx) > 1:
+        enc_sums = np.add.reduceat(np.nan_to_num(behavior[:frame_idx[-1], ENCODER_COL]), frame_idx[:-1])
+        mask[1:len(frame_idx)] = enc_sums <= -thresh
+    if len(frame_idx) > 0 and behavior[0, ENCODER_COL] > -thresh:
+        mask[0] = False
+    return mask
+
+
+def get_bin_frame_count(behavior, n_bins):
+    """
+    Counts the frames of each trial that fall into every VR position bin. All trials are counted with one np.bincount
+    call instead of searching the bin index array once per bin. Bins span [-10, 110] like in the original alignment;
+    samples before the first border are ignored, samples behind the last border are counted into the last bin.
+    :param behavior: list of 2D arrays (one per trial, merged_behavior.txt)
+    :param n_bins: int, number of position bins
+    :return: 2D int array [n_bins x n_trials] with the number of frames per bin
+    """
+    bin_borders = np.linspace(-10, 110, n_bins)
+    idx = [np.digitize(trial[:, POSITION_COL], bin_borders) + t * (n_bins + 1) for t, trial in enumerate(behavior)]
+    weights = [np.nan_to_num(trial[:, TRIGGER_COL]) for trial in behavior]
+    counts = np.bincount(np.concatenate(idx), weights=np.concatenate(weights), minlength=len(behavior) * (n_bins + 1))
+    counts = np.round(counts).astype(int).reshape(len(behavior), n_bins + 1)
+    return counts[:, 1:].T
+
+
+def fill_empty_bins_next(bin_frame_count):
+    """
+    Makes sure that every bin has at least one frame by taking a frame from the next bin (or from the previous bin if
+    the empty bin is the last bin). Bins are processed in order, changes are applied immediately. Used for the frame
+    counts of the complete dataset (moving and resting frames).
+    :param bin_frame_count: 2D int array [n_bins x n_trials], changed in-place
+    :return: bin_frame_count without empty bins
+    """
+    if np.any(bin_frame_count == 0):
+        all_zero_idx = np.where(bin_frame_count == 0)
+        # if not, take a frame of the next bin (or the previous bin in case its the last bin
+        for i in range(len(all_zero_idx[0])):
+            zero_idx = (all_zero_idx[0][i], all_zero_idx[1][i])
+            if zero_idx[0] == 79 and bin_frame_count[78, zero_idx[1]] > 1:
+                bin_frame_count[78, zero_idx[1]] -= 1
+                bin_frame_count[79, zero_idx[1]] += 1
+            elif zero_idx[0] < 79 and bin_frame_count[zero_idx[0]+1, zero_idx[1]] > 1:
+                bin_frame_count[zero_idx[0]+1, zero_idx[1]] -= 1
+                bin_frame_count[zero_idx[0], zero_idx[1]] += 1
+            else:
+                raise ValueError('No frame in these bins (#bin, #trial): {}'.format(zero_idx))
+    return bin_frame_count
+
+
+def fill_empty_bins_nearest(bin_frame_count):
+    """
+    Makes sure that every bin has at least one frame by taking a frame from the nearest non-empty bin of the same trial.
+    Nearest bins are searched in the unchanged frame counts. Used for the frame counts of moving frames only.
+    :param bin_frame_count: 2D int array [n_bins x n_trials]
+    :return: copy of bin_frame_count without empty bins
+    """
+    if np.any(bin_frame_count == 0):
+        all_zero_idx = np.where(bin_frame_count == 0)
+        # create temporary copy that keeps frame count changes
+        bfc_copy = bin_frame_count.copy()
+        # if not, take a frame from the nearest non-zero bin
+        for i in range(len(all_zero_idx[0])):
+            zero_idx = (all_zero_idx[0][i], all_zero_idx[1][i])
+            # Get all non-zero indices of the current trial
+            non_zero_idx = np.nonzero(bin_frame_count[:, zero_idx[1]])[0]
+            # Find nearest non-zero index to the current zero idx of the current trial
+            nearest = non_zero_idx[np.argmin(abs(non_zero_idx - zero_idx[0]))]
+            # Take one frame from the nearest non-zero index and add it to the current zero bin (in the copy array)
+            bfc_copy[zero_idx] += 1
+            bfc_copy[nearest, zero_idx[1]] -= 1
+        # apply changes to the main array
+        bin_frame_count = bfc_copy
+        # Test again if bin count adjustment worked
+        if np.any(bin_frame_count == 0):
+            raise ValueError('Bins without any frames even after adjustment.')
+    return bin_frame_count
+
+
+def align_behavior_to_bins(behavior, n_bins, frame_list, encoder_unit='raw'):
+    """
+    Computes the running masks and the frame counts per VR position bin of a whole session. Resting frames are removed
+    from the behavior arrays (frame trigger set to NaN, in-place).
+    :param behavior: list of 2D arrays (one per trial, merged_behavior.txt)
+    :param n_bins: int, number of position bins
+    :param frame_list: list of int, expected number of frames in each trial
+    :param encoder_unit: str, 'speed' or 'raw', see get_resting_frames()
+    :return: list of running masks (one 1D bool array per trial),
+             bin_frame_count (2D int array [n_bins x n_trials], only moving frames),
+             bin_frame_count_all (2D int array [n_bins x n_trials], moving and resting frames)
+    """
+    # Get frame counts for each bin for complete dataset (moving and resting frames)
+    bin_frame_count_all = get_bin_frame_count(behavior, n_bins)
+
+    # double check if number of frames are correct
+    for i in range(len(frame_list)):
+        frame_list_count = frame_list[i]
+        if frame_list_count != np.sum(bin_frame_count_all[:, i]):
+            raise ValueError(f'Frame count not matching in trial {i + 1}: Frame list says {frame_list_count}, '
+                             f'import says {np.sum(bin_frame_count_all[:, i])}')
+
+    # check that every bin has at least one frame in it
+    bin_frame_count_all = fill_empty_bins_next(bin_frame_count_all)
+
+    # create a bool mask for every trial that tells if a frame should be included or not, and remove resting frames
+    # from the behavior arrays so that they are skipped during bin frame counting
+    behavior_masks = [remove_resting_frames(trial, encoder_unit) for trial in behavior]
+
+    # get new bin_frame_count of only moving frames
+    bin_frame_count = fill_empty_bins_nearest(get_bin_frame_count(behavior, n_bins))
+
+    return behavior_masks, bin_frame_count, bin_frame_count_all
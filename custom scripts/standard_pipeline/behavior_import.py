@@ -3,10 +3,14 @@ from glob import glob
 from math import ceil, floor
 import sys
 import os
+import fnmatch
+import multiprocessing
+import traceback
 from timeit import default_timer as timer
 from ScanImageTiffReader import ScanImageTiffReader
-from datetime import datetime, timedelta
+from datetime import datetime
 from standard_pipeline import performance_check as performance
+from standard_pipeline import behavior_store
 from pathlib import Path
 import pandas as pd
 
@@ -46,13 +50,105 @@ def progress(count, total, status='', percent=True):
     sys.stdout.flush()
 
 
-def align_behavior(root, performance_check=True, overwrite=False, verbose=False, enc_unit='speed', skip_sessions=None):
+def get_alignment_manifest(root, overwrite=False, skip_sessions=None):
+    """
+    Finds all sessions below root that have to be aligned. The directory tree is scanned only once, and file names
+    are matched in memory instead of calling glob for every folder.
+    If the LOG file is in the same folder as the behavioral files, its a non-imaging session. If the LOG file is in
+    the parent directory, its an imaging session (behavioral files in trial subfolders). If there is no LOG file
+    (first Batch2 sessions), the session is assumed to be a non-imaging session.
+    :param root:            str, path of the folder where files are searched
+    :param overwrite:       bool flag whether sessions that already have merged_behavior files should be included
+    :param skip_sessions:   optional, list of session folders that should not be included
+    :return: list of dicts with keys 'session' (str, path of the session folder), 'imaging' (bool) and 'n_trials'
+             (int, number of encoder files of that session)
+    """
+    # one pass through the directory tree, keep the file names of every folder
+    folders = {dirpath: filenames for dirpath, dirnames, filenames in os.walk(root)}
+
+    def has_file(filenames, pattern):
+        return any(fnmatch.fnmatch(file, pattern) for file in filenames)
+
+    def get_files(folder):
+        if folder not in folders:
+            # parent folders above root are not part of the scan
+            folders[folder] = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
+        return folders[folder]
+
+    skip_sessions = set(skip_sessions) if skip_sessions is not None else set()
+    manifest = {}
+    for folder, filenames in list(folders.items()):
+        n_enc = len(fnmatch.filter(filenames, 'Encoder*.txt'))
+        if n_enc == 0:
+            continue
+        if has_file(filenames, 'TDT LOG*.txt'):
+            session, imaging = folder, False
+        else:
+            parent = str(Path(folder).parents[0])
+            if os.path.isdir(parent) and has_file(get_files(parent), 'TDT LOG*.txt'):
+                session, imaging = parent, True
+            else:
+                session, imaging = folder, False
+
+        if session in skip_sessions:
+            continue
+        if session not in manifest:
+            manifest[session] = {'session': session, 'imaging': imaging, 'n_trials': 0, 'aligned': True}
+        manifest[session]['n_trials'] += n_enc
+        # a session has to be aligned if at least one of its trials has no merged file yet
+        if not has_file(filenames, 'merged*.txt'):
+            manifest[session]['aligned'] = False
+
+    return [{key: val for key, val in sess.items() if key != 'aligned'}
+            for sess in manifest.values() if overwrite or not sess['aligned']]
+
+
+def align_session(session, imaging, performance_check=True, verbose=False, enc_unit='speed'):
+    """
+    Aligns all trials of one session and calculates its licking and stopping performance. Errors are caught and
+    reported, so that one faulty session does not stop a batch alignment. Called by align_behavior() in worker
+    processes.
+    :param session:             str, path of the session folder
+    :param imaging:             bool flag whether this is an imaging session (behavioral files in trial subfolders)
+    :param performance_check:   bool flag whether performance should be saved after alignment
+    :param verbose:             bool flag whether unnecessary status updates should be printed to the console
+    :param enc_unit:            str, unit of the encoder data, see align_files()
+    :return: dict with the session report (session, imaging, status, n_aligned, duration in seconds, error)
+    """
+    report = {'session': session, 'imaging': imaging, 'status': 'done', 'n_aligned': 0, 'duration': 0.0, 'error': ''}
+    start = timer()
+    try:
+        report['n_aligned'] = len(align_files(session, imaging=imaging, verbose=verbose, enc_unit=enc_unit))
+        if performance_check:
+            if verbose:
+                print(f'Saving performance for {session}')
+            performance.save_performance_data(session)
+    except Exception as ex:
+        report['status'] = 'failed'
+        report['error'] = f'{type(ex).__name__}: {ex}'
+        print(f'Alignment of session {session} failed:\n{traceback.format_exc()}')
+    report['duration'] = timer() - start
+    return report
+
+
+def _align_session_worker(args):
+    """
+    Unpacks the arguments of align_session() for multiprocessing.Pool.imap_unordered().
+    """
+    return align_session(*args)
+
+
+def align_behavior(root, performance_check=True, overwrite=False, verbose=False, enc_unit='speed', skip_sessions=None,
+                   n_jobs=1, report_path=None):
     """
     This function is the main function called by pipelines!
     Wrapper for aligning multiple behavioral files. Looks through all subfolders of root for behavioral files.
     If it finds a folder with behavioral files but without merged_behavior.txt, it aligns them.
     If the folder does not contain a .tif file (training without imaging), frame trigger is ignored.
-    Calls either align_nonfolder_files in case of training data or align_folder_files for combined imaging data
+    All sessions that have to be aligned are collected first (get_alignment_manifest()) and then aligned in parallel.
+    If a journal file (skip_sessions) is given, completed sessions are appended to it immediately, so an interrupted
+    batch can be resumed. Failed sessions and incomplete sessions (fewer trials aligned than encoder files found) are not journaled
+    and are aligned again in the next run.
     :param root:                string, path of the folder where files are searched
     :param performance_check:   boolean flag whether performance should be checked during alignment
     :param overwrite:           bool flag whether trials that have been already processed should be aligned again
@@ -60,64 +156,70 @@ def align_behavior(root, performance_check=True, overwrite=False, verbose=False,
     :param verbose:             bool flag whether unnecessary status updates should be printed to the console
     :param enc_unit:            str, if 'speed', encoder data is translated into cm/s; otherwise raw encoder data in
                                 rotation [degrees] / sample window (8 ms) is saved
-    :param skip_sessions:       optional, str path to .txt file where processed sessions are saved and sessions in this
-                                file are skipped. Useful when the whole dataset should be processed once in batches.
-    :return:                    saves merged_behavior.txt for each aligned trial
+    :param skip_sessions:       optional, str path to .txt file where completely aligned sessions are saved and sessions
+                                in this file are skipped. Useful when the whole dataset should be processed once in
+                                batches. If None, no journal is read or written.
+    :param n_jobs:              int, number of sessions that are aligned in parallel. None uses all CPU cores.
+    :param report_path:         optional, str path of a .csv file where the timing and status of every session is saved
+    :return:                    saves merged_behavior.txt for each aligned trial, returns pd.DataFrame with the report
     """
-    # list that includes session that have been processed to avoid processing a session multiple times
-    processed_sessions = []
-    for step in os.walk(root):
-        if len(step[2]) > 0:   # check if there are files in the current folder
-            if len(glob(step[0] + r'\\Encoder*.txt')) > 0:  # check if the folder has behavioral files
-                if len(glob(step[0] + r'\\merged*.txt')) == 0 or overwrite:
-                    # If necessary, read the sessions that should be skipped from the provided file
-                    if skip_sessions is not None:
-                        with open(skip_sessions, 'r') as skip_file:
-                            sess_to_skip = skip_file.read().splitlines()
-                    # If the log file is in the same folder as the behavioral files, its a non-imaging session
-                    if len(glob(step[0] + r'\\TDT LOG*.txt')) > 0:
-                        sess_folder = step[0]
-                        if sess_folder not in processed_sessions:        # check if session folder has been processed
-                            if (skip_sessions is not None and sess_folder not in sess_to_skip) or skip_sessions is None:
-                                align_files(sess_folder, imaging=False, verbose=verbose, enc_unit=enc_unit)
-                    # If the LOG file is in the parent directory, its an imaging session
-                    elif len(glob(str(Path(step[0]).parents[0]) + r'\\TDT LOG*.txt')) > 0:
-                        sess_folder = str(Path(step[0]).parents[0])
-                        if sess_folder not in processed_sessions:
-                            if (skip_sessions is not None and sess_folder not in sess_to_skip) or skip_sessions is None:
-                                align_files(sess_folder, imaging=True, verbose=verbose, enc_unit=enc_unit)
-                    # If there is no LOG file (first Batch2 sessions), assume that its a non-imaging session
-                    else:
-                        sess_folder = step[0]
-                        if sess_folder not in processed_sessions:
-                            if skip_sessions and sess_folder not in sess_to_skip:
-                                align_files(sess_folder, imaging=False, verbose=verbose, enc_unit=enc_unit)
-
-                    # calculate licking and stopping performance
-                    if skip_sessions is not None:
-                        if performance_check and sess_folder not in sess_to_skip:
-                            if verbose:
-                                print(f'Saving performance for {sess_folder}')
-                            performance.save_performance_data(sess_folder)
-                    else:
-                        if performance_check and sess_folder not in processed_sessions:
-                            if verbose:
-                                print(f'Saving performance for {sess_folder}')
-                            performance.save_performance_data(sess_folder)
-                    processed_sessions.append(sess_folder)
-
-                    # Write the session folder in the file to avoid processing it again
-                    if skip_sessions is not None and sess_folder not in sess_to_skip:
-                        with open(skip_sessions, 'a') as skip_file:
-                            out = skip_file.write(f'{sess_folder}\n')
-
-                else:
-                    if verbose:
-                        print(f'\nSession {step[0]} already processed.')
-            else:
-                if verbose:
-                    print(f'No behavioral files in {step[0]}.')
-    print('\nEverything processed!')
+    # Read the sessions that should be skipped from the provided file
+    sess_to_skip = []
+    if skip_sessions is not None and os.path.isfile(skip_sessions):
+        with open(skip_sessions, 'r') as skip_file:
+            sess_to_skip = skip_file.read().splitlines()
+
+    manifest = get_alignment_manifest(root, overwrite=overwrite, skip_sessions=sess_to_skip)
+    print(f'Found {len(manifest)} sessions to align in {root}.')
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    jobs = [(sess['session'], sess['imaging'], performance_check, verbose, enc_unit) for sess in manifest]
+    n_trials = {sess['session']: sess['n_trials'] for sess in manifest}
+
+    reports = []
+    pool = None
+    if n_jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+        results = pool.imap_unordered(_align_session_worker, jobs)
+    else:
+        results = map(_align_session_worker, jobs)
+    try:
+        for report in results:
+            report['n_trials'] = n_trials[report['session']]
+            if report['status'] == 'done' and report['n_aligned'] < report['n_trials']:
+                report['status'] = 'incomplete'
+            reports.append(report)
+            # Write completely aligned session folders in the journal to avoid processing them again
+            if skip_sessions is not None and report['status'] == 'done' and report['session'] not in sess_to_skip:
+                sess_to_skip.append(report['session'])
+                with open(skip_sessions, 'a') as skip_file:
+                    skip_file.write(f'{report["session"]}\n')
+                    skip_file.flush()
+                    os.fsync(skip_file.fileno())
+            progress(len(reports), len(jobs), status=f'{report["status"]}: {report["session"]}', percent=False)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report = pd.DataFrame(reports, columns=['session', 'imaging', 'status', 'n_trials', 'n_aligned', 'duration',
+                                            'error'])
+    if report_path is not None:
+        report.to_csv(report_path, index=False)
+
+    n_done = np.sum(report['status'] == 'done')
+    incomplete = report['status'] == 'incomplete'
+    failed = report['status'] == 'failed'
+    print(f'\nEverything processed! {n_done} sessions aligned, {np.sum(incomplete)} incomplete, '
+          f'{np.sum(failed)} failed.')
+    if np.any(incomplete):
+        print('Incomplete sessions (not all trials aligned, will be aligned again in the next run):')
+        print(report.loc[incomplete, ['session', 'n_trials', 'n_aligned']])
+    if np.any(failed):
+        print('Failed sessions:')
+        print(report.loc[failed, ['session', 'error']])
+    return report
 
 
 def align_files(root, imaging, verbose=False, enc_unit='speed'):
@@ -129,7 +231,7 @@ def align_files(root, imaging, verbose=False, enc_unit='speed'):
     :param verbose:         boolean flag whether unnecessary status updates should be printed to the console
     :param enc_unit:        str, if 'speed', encoder data is translated into cm/s; otherwise raw encoder data in
                             rotation [degrees] / sample window (8 ms) is saved
-    :return: saves merged_behavior_timestamp.txt for each aligned trial
+    :return: saves merged_behavior_timestamp.txt for each aligned trial, returns list of paths of the saved files
     """
     def find_file(tstamp, file_list):
         """
@@ -165,16 +267,17 @@ def align_files(root, imaging, verbose=False, enc_unit='speed'):
 
     if not len(enc_files) == len(pos_files) & len(enc_files) == len(trig_files):
         print(f'Uneven numbers of encoder, position and trigger files in folder {root}!')
-        return
+        return []
 
     counter = 1
+    saved_files = []
 
     for file in enc_files:
         timestamp = os.path.basename(file).split('_')[1][:-4]
         pos_file = find_file(timestamp, pos_files)
         trig_file = find_file(timestamp, trig_files)
         if pos_file is None or trig_file is None:
-            return
+            return saved_files
         if verbose:
             print(f'\nNow processing trial {counter} of {len(enc_files)}, time stamp {timestamp}...')
         frame_count = None
@@ -182,7 +285,7 @@ def align_files(root, imaging, verbose=False, enc_unit='speed'):
             old_file = glob(os.path.dirname(file) + r'\\merged_behavior*.txt')
             if len(old_file) == 1:
                 # use the sum of frame triggers from previous merged behavior file (loads faster than raw movie)
-                frame_count = int(np.sum(np.loadtxt(old_file[0])[:, 3]))
+                frame_count = behavior_store.get_frame_count(old_file[0])
             else:
                 # if trial has not been aligned yet, get frame count from raw file (either one has to be present)
                 movie_path = glob(str(Path(file).parents[0]) + r'\\*.tif')
@@ -218,6 +321,9 @@ def align_files(root, imaging, verbose=False, enc_unit='speed'):
             np.savetxt(file_path, merge, delimiter='\t',
                        fmt=['%.5f', '%.3f', '%1i', '%1i', '%1i', '%.2f', '%1i'],
                        header='Time\tVR pos\tlicks\tframe\tencoder\tcm/s\treward')
+            # binary copy of the saved file for fast loading
+            behavior_store.write_cache(file_path)
+            saved_files.append(file_path)
             if verbose:
                 print(f'Done! \nSaving merged file to {file_path}...\n')
 
@@ -226,6 +332,7 @@ def align_files(root, imaging, verbose=False, enc_unit='speed'):
 
         counter += 1
     print('Done!\n')
+    return saved_files
 
 
 def align_behavior_files_old(enc_path, pos_path, trig_path, imaging=False, frame_count=None, enc_unit='speed', verbose=False):
@@ -541,11 +648,9 @@ def align_behavior_files(enc_path, pos_path, trig_path, log_path, imaging=False,
     :param enc_unit: str, if 'speed', encoder data is translated into cm/s; otherwise raw encoder data in
                      rotation [degrees] / sample window (8 ms) is saved
     :param verbose: bool flag whether status updates should be printed into the console (progress bar not affected)
-    :return: merge, np.array with columns [time stamp - position - licks - frame - encoder]
+    :return: merge, np.array with columns [time stamp - position - licks - frame - encoder - speed - water]
     """
 
-    pd.options.mode.chained_assignment = None   # Disable false positive SettingWithCopyWarning
-
     # Load behavioral files
     encoder = load_file(enc_path)
     position = load_file(pos_path)
@@ -685,23 +790,17 @@ def align_behavior_files(enc_path, pos_path, trig_path, log_path, imaging=False,
     position[position[:, 1] > 110, 1] = 110
     data[3] = position                                # Put preprocessed positions back into data list
 
-    # Transform relative time to absolute time for all measurements
-    fixed_times = []
-    for idx, dataset in enumerate(data):
-        timesteps = np.array([start_times[idx] + timedelta(seconds=x) for x in dataset[1:, 0]])
-        fixed_times.append(np.array([timesteps, dataset[1:, 1]]).T)
-
-    # Transform data to pandas dataframes with timestamps indices
-    datasets = ['trigger', 'licking', 'encoder', 'position']
-    df_list = []
-    for name, dataset in zip(datasets, fixed_times):
-        df = pd.DataFrame(dataset[:, 1], index=dataset[:, 0], columns=[name])
-        df_list.append(df)
+    # Transform relative time to absolute time stamps (int64 nanoseconds) for all measurements
+    times = [datetime_to_ns(start_times[idx]) + seconds_to_us(dataset[1:, 0]) * 1000 for idx, dataset in enumerate(data)]
+    values = [dataset[1:, 1] for dataset in data]
+    for name, time_stamps in zip(['trigger', 'licking', 'encoder', 'position'], times):
+        if np.any(np.diff(time_stamps) < 0):
+            raise ValueError(f'Time stamps of {name} data are not sorted, alignment not possible.')
 
-    # Serially merge dataframes by the time stamp of the trigger (highest sampling rate)
-    merge = pd.merge_asof(df_list[0], df_list[1], left_index=True, right_index=True)
-    merge = pd.merge_asof(merge, df_list[2], left_index=True, right_index=True)
-    merge = pd.merge_asof(merge, df_list[3], left_index=True, right_index=True)
+    # Serially merge datasets by the time stamp of the trigger (highest sampling rate)
+    merge_time = times[0]
+    trigger = values[0]
+    licking, encoder, position = [asof_values(merge_time, t, v) for t, v in zip(times[1:], values[1:])]
 
     # Load LOG file TODO maybe make another boolean column with "being in reward zone"
     if log_path is not None:
@@ -710,33 +809,31 @@ def align_behavior_files(enc_path, pos_path, trig_path, log_path, imaging=False,
         if log['Date_Time'].dtype == 'object':
             log = log.loc[~np.isnan(log['Trial'])]
             log['Date_Time'] = pd.to_datetime(log['Date_Time'])
+        log_times = log['Date_Time'].values.astype('datetime64[ns]').astype(np.int64)
         # Extract data for the current trial based on the first and last times of the trigger timestamps
-        trial_log = log.loc[(log['Date_Time'] > merge.index[0]) & (log['Date_Time'] < merge.index[-1])]
+        trial_log = log.loc[(log_times > merge_time[0]) & (log_times < merge_time[-1])]
         # Get times when the valve opened
         water_times = trial_log.loc[trial_log['Event'].str.contains('Dev1/port0/line0-B'), 'Date_Time']
         # Initialize empty water column and set to '1' for every water valve opening timestamp
-        merge['water'] = 0
-        for water_time in water_times:
-            merge.loc[merge.index[merge.index.get_loc(water_time, method='nearest')], 'water'] = 1
+        water = np.zeros(len(merge_time))
+        water[nearest_index(merge_time, water_times.values.astype('datetime64[ns]').astype(np.int64))] = 1
     else:
-        merge['water'] = -1
+        water = np.full(len(merge_time), -1.)
 
     # Delete rows before the first frame (dont delete anything if no frame trigger)
-    if merge['trigger'].sum() > 0:
-        first_frame = merge.index[np.where(merge['trigger'] == 1)[0][0]]
+    if np.nansum(trigger) > 0:
+        first_frame = merge_time[np.where(trigger == 1)[0][0]]
     else:
-        first_frame = merge.index[0]
-    merge_filt = merge[merge.index >= first_frame]
+        first_frame = merge_time[0]
+    keep = merge_time >= first_frame
+    merge_time = merge_time[keep]
 
-    # Fill in NaN values
-    merge_filt['position'].fillna(-10, inplace=True)
-    merge_filt['encoder'].fillna(0, inplace=True)
-    merge_filt['licking'].fillna(0, inplace=True)
-
-    # Set proper data types (float for position, int for the rest)
-    merge_filt['trigger'] = merge_filt['trigger'].astype(int)
-    merge_filt['licking'] = merge_filt['licking'].astype(int)
-    merge_filt['encoder'] = merge_filt['encoder'].astype(int)
+    # Fill in NaN values and set proper data types (float for position, int for the rest)
+    position = np.where(np.isnan(position[keep]), -10, position[keep])
+    encoder = np.where(np.isnan(encoder[keep]), 0, encoder[keep]).astype(int)
+    licking = np.where(np.isnan(licking[keep]), 0, licking[keep]).astype(int)
+    trigger = trigger[keep].astype(int)
+    water = water[keep]
 
     # translate encoder data into velocity [cm/s] if enc_unit = 'speed'
     if enc_unit == 'speed':
@@ -744,20 +841,75 @@ def align_behavior_files(enc_path, pos_path, trig_path, log_path, imaging=False,
         d_wheel = 10.5                                           # wheel diameter in cm (default 10.5 cm)
         n_ticks = 1436                                           # number of ticks in a full wheel rotation
         deg_dist = (d_wheel*np.pi)/n_ticks                       # distance in cm the band moves for each encoder tick
-        speed = -merge_filt.loc[:, 'encoder'] * deg_dist/sample_rate               # speed in cm/s for each sample
+        speed = -encoder * deg_dist/sample_rate                  # speed in cm/s for each sample
         speed[speed == -0] = 0
-        merge_filt['speed'] = speed
+    else:
+        speed = np.full(len(encoder), np.nan)
 
     # check frame count again
-    merge_trig = np.sum(merge_filt['trigger'])
+    merge_trig = np.sum(trigger)
     if imaging and merge_trig != frame_count:
         print(f'Frame count matching unsuccessful: \n{merge_trig} frames in merge, should be {frame_count} frames.')
         return None
 
-    # transform back to numpy array for saving
-    time_passed = merge_filt.index - merge_filt.index[0]                                        # transfer timestamps to
-    seconds = np.array(time_passed.total_seconds())                                             # time change in seconds
-    array_df = merge_filt[['position', 'licking', 'trigger', 'encoder', 'speed', 'water']]      # change column order
-    array = np.hstack((seconds[..., np.newaxis], np.array(array_df)))                           # combine both arrays
+    # transform time stamps to time change in seconds and combine all columns
+    seconds = np.asarray(pd.to_timedelta(merge_time - merge_time[0], unit='ns').total_seconds())
+    array = np.vstack((seconds, position, licking, trigger, encoder, speed, water)).T
 
     return array
+
+
+def datetime_to_ns(time_stamp):
+    """
+    Transforms a datetime object into an int64 time stamp in nanoseconds (same as in a pandas DatetimeIndex).
+    :param time_stamp: datetime.datetime object
+    :return: int, nanoseconds since the epoch
+    """
+    return int(np.datetime64(time_stamp, 'us').astype('datetime64[ns]').astype(np.int64))
+
+
+def seconds_to_us(seconds):
+    """
+    Transforms time differences in seconds into integer microseconds with the same rounding as datetime.timedelta
+    (round half to even at microsecond resolution), so that time stamps are identical to start + timedelta(seconds=x).
+    :param seconds: 1D array of float time differences in seconds
+    :return: 1D int64 array of time differences in microseconds
+    """
+    frac_s, whole_s = np.modf(np.asarray(seconds, dtype=float))
+    frac_us, whole_us = np.modf(frac_s * 1e6)
+    base = whole_s.astype(np.int64) * 1000000 + whole_us.astype(np.int64)
+    # round the remaining fraction of a microsecond, ties are rounded to the even total
+    rounded = np.round(frac_us)
+    tie = np.abs(frac_us) == 0.5
+    rounded[tie] = np.where(base[tie] % 2 == 1, np.sign(frac_us[tie]), 0)
+    return base + rounded.astype(np.int64)
+
+
+def asof_values(left_times, right_times, right_values):
+    """
+    As-of join of one data stream onto the time stamps of another (same as pd.merge_asof with default arguments): every
+    left time stamp gets the value of the last right sample that was recorded at the same time or before.
+    :param left_times: 1D int64 array of sorted time stamps onto which the data is aligned
+    :param right_times: 1D int64 array of sorted time stamps of the aligned data stream
+    :param right_values: 1D array of values of the aligned data stream
+    :return: 1D float array with the aligned values, NaN for left time stamps before the first right sample
+    """
+    idx = np.searchsorted(right_times, left_times, side='right') - 1
+    aligned = np.asarray(right_values, dtype=float)[np.maximum(idx, 0)]
+    aligned[idx < 0] = np.nan
+    return aligned
+
+
+def nearest_index(times, query_times):
+    """
+    Finds the sample with the nearest time stamp for many events at once (same as Index.get_loc(method='nearest'),
+    ties are assigned to the later sample).
+    :param times: 1D int64 array of sorted, unique time stamps
+    :param query_times: 1D int64 array of event time stamps
+    :return: 1D int array with the index of the nearest sample for every event
+    """
+    query_times = np.asarray(query_times, dtype=np.int64)
+    right = np.minimum(np.searchsorted(times, query_times, side='left'), len(times) - 1)
+    left = np.maximum(np.searchsorted(times, query_times, side='right') - 1, 0)
+    use_left = np.abs(times[left] - query_times) < np.abs(times[right] - query_times)
+    return np.where(use_left, left, right)
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+
+# Frame counts of files that have been read in this session, with the modification time of their text file
+_frame_count_cache = {}
+
+
+def get_cache_path(file_path):
+    """
+    Returns the path of the binary sidecar file of a merged_behavior.txt file (same name, .npy extension).
+    :param file_path: str, path of the merged_behavior*.txt file
+    :return: str, path of the sidecar file
+    """
+    return os.path.splitext(file_path)[0] + '.npy'
+
+
+def is_cache_valid(file_path):
+    """
+    Checks whether the sidecar file of a merged_behavior.txt file exists and is newer than the text file.
+    :param file_path: str, path of the merged_behavior*.txt file
+    :return: bool flag whether the sidecar file can be used instead of the text file
+    """
+    cache_path = get_cache_path(file_path)
+    if not os.path.isfile(cache_path):
+        return False
+    return os.path.getmtime(cache_path) >= os.path.getmtime(file_path)
+
+
+def write_cache(file_path, data=None):
+    """
+    Writes the binary sidecar file of a merged_behavior.txt file. The array is stored column-major (Fortran order),
+    so that single columns (e.g. frame triggers) are stored contiguously and can be read from a memory map without
+    touching the rest of the table.
+    :param file_path: str, path of the merged_behavior*.txt file
+    :param data: optional, 2D array with the content of the text file. If None, the text file is parsed.
+                 Should be the data as it is read back from the text file (savetxt rounds values).
+    :return: 2D array with the behavior data
+    """
+    if data is None:
+        data = np.loadtxt(file_path, delimiter='\t')
+    data = np.asfortranarray(data, dtype=float)
+    try:
+        np.save(get_cache_path(file_path), data)
+    except OSError as ex:
+        print(f'Could not write behavior cache for {file_path}: {ex}')
+    return data
+
+
+def load_behavior(file_path, mmap=False):
+    """
+    Loads a merged_behavior.txt file from its binary sidecar file instead of parsing the text. Missing or outdated
+    sidecar files (older than the text file) are (re)written, so the text file stays the reference.
+    :param file_path: str, path of the merged_behavior*.txt file
+    :param mmap: bool flag whether a read-only memory map of the sidecar file should be returned instead of loading
+                 the whole array into memory
+    :return: 2D array [n_samples x n_columns] with the behavior data, same as np.loadtxt(file_path, delimiter='\t')
+    """
+    if not is_cache_valid(file_path):
+        data = write_cache(file_path)
+        if not mmap or not is_cache_valid(file_path):
+            return data
+    return np.load(get_cache_path(file_path), mmap_mode='r' if mmap else None)
+
+
+def get_frame_count(file_path):
+    """
+    Returns the number of imaging frames (sum of frame triggers) of a merged_behavior.txt file. Only the trigger column
+    of the sidecar file is read.
+    :param file_path: str, path of the merged_behavior*.txt file
+    :return: int, number of frames in this trial
+    """
+    file_path = os.path.abspath(file_path)
+    mtime = os.path.getmtime(file_path)
+    cached = _frame_count_cache.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    data = load_behavior(file_path, mmap=True)
+    frame_count = int(np.nansum(data[:, 3]))
+    _frame_count_cache[file_path] = (mtime, frame_count)
+    return frame_count
+
+
+def get_frame_counts(file_list):
+    """
+    Returns the frame counts of several merged_behavior.txt files, e.g. all trials of one session.
+    :param file_list: list of str, paths of merged_behavior*.txt files
+    :return: list of int, number of frames in each trial
+    """
+    return [get_frame_count(file) for file in file_list]
+
+
+def clear_cache():
+    """
+    Removes all frame counts that are kept in memory. Sidecar files are not deleted.
+    """
+    _frame_count_cache.clear()
@@ -0,0 +1,138 @@
+import numpy as np
+from scipy.special import ndtri
+
+
+def _as_rows(data):
+    """
+    Brings 1D traces into the 2D [n_traces x n_frames] shape used by the estimators.
+    :param data: 1D or 2D array
+    :return: 2D float array, bool flag whether the input was 1D
+    """
+    data = np.asarray(data, dtype=float)
+    is_1d = data.ndim == 1
+    return np.atleast_2d(data), is_1d
+
+
+def _fwhm_sigma(x_data, y_data):
+    """
+    Reads the full-width-half-maximum from density curves and transforms it into a standard deviation (FWHM/2.3548).
+    Same procedure as the original seaborn-based PlaceCellFinder.get_noise_fwhm(): the nearest grid points to the half
+    maximum are searched above and below the peak.
+    :param x_data: 2D array [n_traces x n_points], support points of each density curve
+    :param y_data: 2D array [n_traces x n_points], density values at x_data
+    :return: 1D array with sigma for every trace
+    """
+    y_max = np.argmax(y_data, axis=1)
+    half_dist = np.abs(y_data - np.max(y_data, axis=1)[:, None] / 2)
+    point_idx = np.arange(y_data.shape[1])[None, :]
+    # get points above/below y_max that are closest to max_y/2
+    nearest_above = np.argmin(np.where(point_idx >= y_max[:, None], half_dist, np.inf), axis=1)
+    nearest_below = np.argmin(np.where(point_idx < y_max[:, None], half_dist, np.inf), axis=1)
+    rows = np.arange(y_data.shape[0])
+    return (x_data[rows, nearest_above] - x_data[rows, nearest_below]) / 2.3548
+
+
+def kde_fwhm(data, gridsize=200, cut=3, chunk_size=10):
+    """
+    Estimates noise levels via the FWHM of a Gaussian kernel density estimate (Koay et al. 2019). The KDE is the same
+    as the one drawn by seaborn's distplot (scipy's gaussian_kde with Scott's bandwidth, evaluated on 'gridsize' points
+    that stretch 'cut' bandwidths beyond the data range), but computed without creating any figures.
+    :param data: 1D array or 2D array [n_traces x n_frames] of traces (e.g. one trial of all neurons). NaNs are ignored.
+    :param gridsize: int, number of points on which the density is evaluated
+    :param cut: float, number of bandwidths that the grid extends past the extreme data points
+    :param chunk_size: int, number of traces for which the densities are computed at once (limits memory usage)
+    :return: float or 1D array of sigma for every trace. Traces without data (all 0) get sigma = 0.
+    """
+    data, is_1d = _as_rows(data)
+    sigma = np.zeros(data.shape[0])
+
+    valid = ~np.isnan(data)
+    n_valid = np.sum(valid, axis=1)
+    has_data = ~np.all((data == 0) | ~valid, axis=1)
+    if np.any(has_data & (n_valid < 2)):
+        raise ValueError('At least two data points are needed to estimate the noise level.')
+
+    for start in np.arange(0, data.shape[0], chunk_size):
+        rows = np.where(has_data[start:start+chunk_size])[0] + start
+        if rows.size == 0:
+            continue
+        curr_data = data[rows]
+        curr_valid = valid[rows]
+        curr_n = n_valid[rows]
+
+        # Scott's rule: bandwidth = std * n^(-1/5)
+        bw = np.nanstd(curr_data, axis=1, ddof=1) * curr_n ** (-1 / 5)
+        grid_min = np.nanmin(curr_data, axis=1) - bw * cut
+        grid_max = np.nanmax(curr_data, axis=1) + bw * cut
+        x_data = np.linspace(grid_min, grid_max, gridsize, axis=1)
+
+        # Gaussian kernels of all data points, summed on the grid (NaNs get zero weight)
+        z = (x_data[:, :, None] - np.nan_to_num(curr_data)[:, None, :]) / bw[:, None, None]
+        kernels = np.exp(-0.5 * z ** 2) * curr_valid[:, None, :]
+        y_data = np.sum(kernels, axis=2) / (curr_n * bw * np.sqrt(2 * np.pi))[:, None]
+
+        sigma[rows] = _fwhm_sigma(x_data, y_data)
+
+    return sigma[0] if is_1d else sigma
+
+
+def hist_fwhm(data, n_bins=100):
+    """
+    Estimates noise levels via the FWHM of a histogram of each trace. Faster, but coarser than kde_fwhm().
+    :param data: 1D array or 2D array [n_traces x n_frames] of traces. NaNs are ignored.
+    :param n_bins: int, number of histogram bins between the minimum and maximum of each trace
+    :return: float or 1D array of sigma for every trace. Traces without data (all 0) get sigma = 0.
+    """
+    data, is_1d = _as_rows(data)
+    sigma = np.zeros(data.shape[0])
+    has_data = ~np.all((data == 0) | np.isnan(data), axis=1)
+    if not np.any(has_data):
+        return sigma[0] if is_1d else sigma
+
+    curr_data = data[has_data]
+    data_min = np.nanmin(curr_data, axis=1)
+    bin_width = (np.nanmax(curr_data, axis=1) - data_min) / n_bins
+    bin_width[bin_width == 0] = 1
+
+    # histograms of all traces at once: bin label of every sample, offset by the trace index
+    labels = np.clip(((curr_data - data_min[:, None]) / bin_width[:, None]), 0, n_bins - 1)
+    labels = np.where(np.isnan(labels), -1, labels).astype(int)
+    flat_labels = labels + (np.arange(curr_data.shape[0]) * n_bins)[:, None]
+    counts = np.bincount(flat_labels[labels >= 0], minlength=curr_data.shape[0] * n_bins)
+    y_data = counts.reshape(curr_data.shape[0], n_bins).astype(float)
+    x_data = data_min[:, None] + (np.arange(n_bins)[None, :] + 0.5) * bin_width[:, None]
+
+    sigma[has_data] = _fwhm_sigma(x_data, y_data)
+    return sigma[0] if is_1d else sigma
+
+
+def mad_sigma(data):
+    """
+    Estimates noise levels from the median absolute deviation (MAD), scaled to the standard deviation of a normal
+    distribution. Cheapest estimator, robust against the long positive tail caused by transients.
+    :param data: 1D array or 2D array [n_traces x n_frames] of traces. NaNs are ignored.
+    :return: float or 1D array of sigma for every trace. Traces without data (all 0) get sigma = 0.
+    """
+    data, is_1d = _as_rows(data)
+    mad = np.nanmedian(np.abs(data - np.nanmedian(data, axis=1)[:, None]), axis=1)
+    sigma = mad / ndtri(0.75)
+    sigma[np.all((data == 0) | np.isnan(data), axis=1)] = 0
+    return sigma[0] if is_1d else sigma
+
+
+def get_noise_level(data, method='kde'):
+    """
+    Estimates the noise level (sigma) of one or many traces without any plotting.
+    :param data: 1D array or 2D array [n_traces x n_frames] of traces
+    :param method: str, 'kde' (FWHM of kernel density estimate, same as the former seaborn-based estimate),
+                   'hist' (FWHM of a histogram) or 'mad' (median absolute deviation)
+    :return: float or 1D array of sigma for every trace
+    """
+    if method == 'kde':
+        return kde_fwhm(data)
+    elif method == 'hist':
+        return hist_fwhm(data)
+    elif method == 'mad':
+        return mad_sigma(data)
+    else:
+        raise ValueError(f'Noise estimation method {method} not recognized. Use "kde", "hist" or "mad".')
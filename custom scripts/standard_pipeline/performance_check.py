@@ -11,6 +11,7 @@ from glob import glob
 from math import ceil
 from copy import deepcopy
 import re
+from standard_pipeline import behavior_store
 
 
 def multi_mouse_performance(mouse_dir_list, novel, precise_duration=False, separate_zones=False, date_0='0'):
@@ -808,14 +809,14 @@ def quick_screen_session(path, valid=False, bin_size=1):
     for step in os.walk(path):
         if len(step[2]) > 0:
             for file in step[2]:
-                if 'merged_behavior' in file and os.path.join(step[0], file) not in file_list:
+                if 'merged_behavior' in file and file.endswith('.txt') and os.path.join(step[0], file) not in file_list:
                     file_list.append(os.path.join(step[0], file))
     file_list.sort(key=natural_keys)       # order files according to trial number (otherwise 11 is before 2)
 
     data_list = []
     binned_data = np.zeros((len(file_list), int(120 / bin_size)))
     for idx, file in enumerate(file_list):
-        data_list.append(np.loadtxt(file))
+        data_list.append(behavior_store.load_behavior(file))
         binned_data[idx] = get_binned_licking(data_list[-1], bin_size=bin_size, normalized=False)
 
     if len(data_list) == 0:
@@ -1119,7 +1120,7 @@ def plot_validation_performance(path, change_trial=5, bin_size=1, normalized=Tru
 
     data = np.zeros((len(file_list), int(120/bin_size)))
     for idx, file in enumerate(file_list):
-        data[idx] = get_binned_licking(np.loadtxt(file), bin_size=bin_size, normalized=normalized)
+        data[idx] = get_binned_licking(behavior_store.load_behavior(file), bin_size=bin_size, normalized=normalized)
 
     #### Plot individually counted binned licks
     fig = plt.figure(figsize=(12, 7))
@@ -1250,7 +1251,7 @@ def plot_lick_histogram_in_figure(path, ax, bin_size=1, label_axes=True, rz_colo
         avg_performance_old = np.mean(perf[0])*100
     data = np.zeros((len(file_list), int(120 / bin_size)))
     for idx, file in enumerate(file_list):
-        data[idx] = get_binned_licking(np.loadtxt(file), bin_size=bin_size, normalized=False)
+        data[idx] = get_binned_licking(behavior_store.load_behavior(file), bin_size=bin_size, normalized=False)
     data[data > 0] = 1
 
     track_len = get_track_length(path)
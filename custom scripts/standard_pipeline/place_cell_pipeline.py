@@ -13,10 +13,13 @@ from caiman.source_extraction.cnmf import cnmf
 import re
 import pickle
 import numpy as np
+from scipy import sparse
 import matplotlib.pyplot as plt
 from standard_pipeline import preprocess as pre
 import place_cell_class as pc
 from standard_pipeline.behavior_import import progress
+from standard_pipeline import behavior_alignment as align
+from standard_pipeline import si_kernel
 from skimage import io
 import tifffile as tif
 from datetime import datetime
@@ -1276,6 +1279,25 @@ def motion_correction(root, params, dview, basename="file", percentile=0.01, tem
 
 #%% Spatial information
 
+def get_si_bins(position, n_bins=60):
+    """
+    Bins position data for the spatial information calculation and computes the bin occupancy. Bins are evenly spaced
+    between the (integer) minimum and maximum position.
+    Note: Occupancy fractions are assigned to the bins in the order of the occupied bin labels (as in the original
+    si_formula()), so bins are only matched with their own occupancy if every bin label is occupied.
+    :param position: np.array containing position data for every sample; shape (#samples) or (#samples x 1)
+    :param n_bins: number of bins the data should be binned into. Default is 60.
+    :return: idx, 1D int array with the bin label (0 - n_bins) of every sample, labels 1 - n_bins are used for SI
+             bin_freq, 1D array with shape (n_bins) with the occupancy fraction used for every bin (NaN if missing)
+    """
+    position = np.ravel(position)
+    bin_borders = np.linspace(int(min(position)), int(max(position)), n_bins)
+    idx = np.digitize(position, bin_borders)  # get indices of bins
+
+    # get fraction of bin occupancy
+    return idx, si_kernel.bin_occupancy(idx, n_bins, rank_order=True)
+
+
 def si_formula(data, position, n_bins=60):
     """
     True function that actually calculates spatial information. Data and position should be preprocessed.
@@ -1285,60 +1307,78 @@ def si_formula(data, position, n_bins=60):
     :return spatial_info: 1D np.array with shape (#neurons) containing SI value for every neuron
     """
     # bin data into n_bins, get mean event rate per bin
-    bin_borders = np.linspace(int(min(position)), int(max(position)), n_bins)
-    idx = np.digitize(position, bin_borders)  # get indices of bins
-
-    # get fraction of bin occupancy
-    unique_elements, counts_elements = np.unique(idx, return_counts=True)
-    bin_freq = np.array([x / np.sum(counts_elements) for x in counts_elements])
+    idx, bin_freq = get_si_bins(position, n_bins)
 
     # get mean spikes/s for each bin
-    bin_mean_act = np.zeros((n_bins, data.shape[1]))
-    for bin_nr in range(n_bins):
-        curr_bin_idx = np.where(idx == bin_nr + 1)[0]
-        bin_act = data[curr_bin_idx]
-        bin_mean_act[bin_nr, :] = np.sum(bin_act, axis=0) / (bin_act.shape[0] / 30)  # firing rate per second
-        # bin_mean_act[bin_nr, :] = np.mean(bin_act, axis=0)    # firing rate per frame
+    bin_mean_act = si_kernel.bin_activity(data, idx, n_bins) * 30  # firing rate per second
     total_firing_rate = np.sum(data, axis=0) / (data.shape[0] / 30)
-    # total_firing_rate = np.mean(data, axis=0)
 
     # calculate spatial information content
-    spatial_info = np.zeros(len(total_firing_rate))
-    for cell in range(len(total_firing_rate)):
-        curr_trace = bin_mean_act[:, cell]
-        tot_act = total_firing_rate[cell]  # this is the total dF/F averaged across all bins
-        bin_si = np.zeros(n_bins)  # initialize array that holds SI value for each bin
-        for i in range(n_bins):
-            # apply the SI formula to every bin
-            if curr_trace[i] <= 0 or tot_act <= 0:
-                bin_si[i] = np.nan
-            else:
-                bin_si[i] = curr_trace[i] * np.log2(curr_trace[i] / tot_act) * bin_freq[i]
-        if np.all(np.isnan(bin_si)):
-            spatial_info[cell] = np.nan
-        else:
-            spatial_info[cell] = np.nansum(bin_si)
+    return si_kernel.skaggs_si(bin_mean_act, bin_freq, mean_act=total_firing_rate, log_base=2, normalize=False,
+                               invalid='nan')
 
-    return spatial_info
 
+def bootstrap_si(data, position, n_bootstrap=2000, n_bins=60, max_memory=2**28, seed=None, verbose=True):
+    """
+    Computes the spatial information of bootstrapped traces for all neurons. Every bootstrapped trace is created by
+    drawing samples of the original trace with replacement (the last sample is never drawn, as in the original
+    implementation). Random indices are shared by all neurons and drawn with one Generator.integers() call per chunk.
+    Binned activity of all neurons is computed with one sparse matrix product per chunk: every row of the resampling
+    matrix is the one-hot encoding of the samples that were drawn into one bin of one bootstrap.
+    :param data: np.array containing neural data (spike probabilities); shape (#samples x #neurons)
+    :param position: np.array containing position data for every sample; shape (#samples x 1)
+    :param n_bootstrap: int, number of bootstrapped traces per neuron
+    :param n_bins: number of bins the data should be binned into. Default is 60.
+    :param max_memory: int, approximate number of bytes used for the random indices and binned activity of one chunk
+    :param seed: optional, int seed of the random number generator for reproducible results
+    :param verbose: bool flag whether a progress bar should be displayed
+    :return si_boot: np.array with shape (n_bootstrap x #neurons) with the SI of every bootstrapped trace
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=float)
+    n_samples, n_neurons = data.shape
+    idx, bin_freq = get_si_bins(position, n_bins)
+
+    # Resampled values are independent of position, so the first bin_counts[0] drawn samples are assigned to the
+    # first label, the next ones to the second label, etc. Every label is one row of the resampling matrix.
+    label_counts = np.bincount(idx, minlength=n_bins + 1)
+    present = np.where(label_counts > 0)[0]
+    row_starts = np.concatenate(([0], np.cumsum(label_counts[present])[:-1]))
+    is_bin = present > 0
+    bin_counts = label_counts[present[is_bin]]
+
+    bytes_per_boot = n_samples * 16 + len(present) * n_neurons * 8 * 3
+    chunk_size = int(max(1, min(n_bootstrap, max_memory // bytes_per_boot)))
+    si_boot = np.zeros((n_bootstrap, n_neurons))
+    for start in range(0, n_bootstrap, chunk_size):
+        if verbose:
+            progress(start, n_bootstrap, status=f'Performing bootstrapping ({start}/{n_bootstrap})')
+        n_curr = min(chunk_size, n_bootstrap - start)
+        rand_idx = rng.integers(0, n_samples - 1, size=(n_curr, n_samples))
+
+        # sums of resampled activity for every label of every bootstrap, shape (n_curr, #labels, #neurons)
+        indptr = np.append((np.arange(n_curr)[:, np.newaxis] * n_samples + row_starts).ravel(), n_curr * n_samples)
+        resample = sparse.csr_matrix((np.ones(rand_idx.size), rand_idx.ravel(), indptr),
+                                     shape=(n_curr * len(present), n_samples))
+        label_sums = (resample @ data).reshape(n_curr, len(present), n_neurons)
+
+        bin_mean_act = np.full((n_curr, n_neurons, n_bins), np.nan)
+        bin_mean_act[:, :, present[is_bin] - 1] = np.swapaxes(label_sums[:, is_bin] / (bin_counts[:, np.newaxis] / 30),
+                                                              1, 2)
+        total_firing_rate = np.sum(label_sums, axis=1) / (n_samples / 30)
+        si_boot[start:start + n_curr] = si_kernel.skaggs_si(bin_mean_act, bin_freq, mean_act=total_firing_rate,
+                                                            log_base=2, normalize=False, invalid='nan')
+    if verbose:
+        progress(n_bootstrap, n_bootstrap, status=f'Performing bootstrapping ({n_bootstrap}/{n_bootstrap})')
 
-def get_spatial_info(all_data, behavior, n_bootstrap=2000):
+    return si_boot
+
+
+def get_spatial_info(all_data, behavior, n_bootstrap=2000, seed=None):
 
     # %% remove samples where the mouse was stationary (less than 30 movement per frame)
-    all_position = []
-    behavior_masks = []
-    for trial in behavior:
-        all_position.append(trial[np.where(trial[:, 3] == 1), 1])  # get position of mouse during every frame
-        behavior_masks.append(np.ones(int(np.nansum(trial[:, 3])), dtype=bool))  # bool list for every frame of that trial
-        frame_idx = np.where(trial[:, 3] == 1)[0]  # find sample_idx of all frames
-        for i in range(len(frame_idx)):
-            if i != 0:
-                if np.nansum(trial[frame_idx[i - 1]:frame_idx[i], 4]) > -30:  # make index of the current frame False if
-                    behavior_masks[-1][i] = False  # the mouse didn't move much during the frame
-            else:
-                if trial[0, 4] > -30:
-                    behavior_masks[-1][i] = False
-    all_position = np.hstack(all_position).T
+    all_position = np.hstack([trial[np.where(trial[:, 3] == 1)[0], 1] for trial in behavior])[:, np.newaxis]
+    behavior_masks = [align.get_forward_running_mask(trial) for trial in behavior]
     # trial_lengths = [int(np.sum(trial)) for trial in behavior_masks]
 
     behavior_mask = np.hstack(behavior_masks)
@@ -1358,28 +1398,14 @@ def get_spatial_info(all_data, behavior, n_bootstrap=2000):
 
     if n_bootstrap > 0:
         # Bootstrapping:
-        # Create new data trace by taking a random value of original data and adding it to a random idx of a new array.
+        # Create new data traces by randomly selecting data points of the original trace for every index.
         # Do this X times for every neuron. Normalize raw SI by the average bootstrapped SI for every neuron.
+        si_boot = bootstrap_si(data, position, n_bootstrap=n_bootstrap, seed=seed)
         si_norm = np.zeros((len(si_raw), 2))
-        for cell in range(len(si_norm)):
-            progress(cell + 1, len(si_norm), status=f'Performing bootstrapping (cell {cell + 1}/{len(si_norm)})')
-            orig_data = data[:, cell]
-            cell_boot = np.zeros((len(orig_data), n_bootstrap))
-            for j in range(n_bootstrap):
-                # get a new trace from the original one by randomly selecting data points for every index
-                new_trace = np.zeros(len(orig_data))  # initialize empty array for new trace
-                for idx in range(len(orig_data)):  # go through entries in new_trace
-                    rand_idx = np.random.randint(0, len(orig_data) - 1)  # get a random idx to fill in the current entry
-                    new_trace[idx] = orig_data[
-                        rand_idx]  # fill the current entry with the random entry of the orig data
-                # get spatial information of the newly constructed trace and add it to the cell-wide array
-                cell_boot[:, j] = new_trace
-            # perform bootstrapping (pretend that every random trace is a different cell)
-            si_boot = si_formula(cell_boot, position)
-            # after bootstrapping, normalize the SI of the current cell by the average bootstrapped SI
-            si_norm[cell, 0] = si_raw[cell] / np.mean(si_boot)
-            # add percentage of higher bootstrap SI than original SI
-            si_norm[cell, 1] = sum(si > si_raw[cell] for si in si_boot) / n_bootstrap
+        # after bootstrapping, normalize the SI of the current cell by the average bootstrapped SI
+        si_norm[:, 0] = si_raw / np.mean(si_boot, axis=0)
+        # add percentage of higher bootstrap SI than original SI
+        si_norm[:, 1] = np.sum(si_boot > si_raw, axis=0) / n_bootstrap
         return si_norm
 
     else:
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def pvc_matrix(act_x, act_y=None, ignore_nan=False):
+    """
+    Population vector correlation (PVC) between all pairs of position bins, computed as the cosine similarity of the
+    population vectors with one normalized matrix product:
+        PVC(x, y) = sum_n a_xn * b_yn / sqrt(sum_n a_xn^2 * sum_n b_yn^2)
+    :param act_x: np.array with shape (..., n_bins_x, n_neurons) with the binned activity of every neuron. Leading
+                  axes (e.g. sessions or shuffles) are processed in one batch.
+    :param act_y: optional, np.array with shape (..., n_bins_y, n_neurons), e.g. activity in a second context. If None,
+                  the bins of act_x are correlated with each other.
+    :param ignore_nan: bool flag whether NaN entries should be ignored. If True, a neuron only contributes to the PVC of
+                       a bin pair if it has valid values in both bins. Otherwise, NaNs propagate to the PVC.
+    :return: np.array with shape (..., n_bins_x, n_bins_y) with the PVC of every bin pair
+    """
+    act_x = np.asarray(act_x, dtype=float)
+    act_y = act_x if act_y is None else np.asarray(act_y, dtype=float)
+
+    if ignore_nan:
+        valid_x = (~np.isnan(act_x)).astype(float)
+        valid_y = (~np.isnan(act_y)).astype(float)
+        act_x = np.where(np.isnan(act_x), 0, act_x)
+        act_y = np.where(np.isnan(act_y), 0, act_y)
+        # Squared norms of the population vectors, only including neurons that are valid in the paired bin
+        norm_x = (act_x ** 2) @ np.swapaxes(valid_y, -1, -2)
+        norm_y = valid_x @ np.swapaxes(act_y ** 2, -1, -2)
+    else:
+        norm_x = np.sum(act_x ** 2, axis=-1)[..., :, np.newaxis]
+        norm_y = np.sum(act_y ** 2, axis=-1)[..., np.newaxis, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (act_x @ np.swapaxes(act_y, -1, -2)) / np.sqrt(norm_x * norm_y)
+
+
+def pvc_offset_curve(pvc_mat, max_delta_bins=None):
+    """
+    Derives the PVC curve across position offsets from a PVC matrix: the PVC of all bin pairs that are delta bins apart
+    (the delta-th diagonal of the matrix) are averaged.
+    :param pvc_mat: np.array with shape (..., n_bins, n_bins), from pvc_matrix()
+    :param max_delta_bins: int, largest offset in bins. If None, all offsets (n_bins - 1) are used. Offsets without any
+                           bin pair get NaN.
+    :return: mean and standard deviation of the PVC across bin pairs for every offset, both with shape
+             (..., max_delta_bins + 1)
+    """
+    n_bins = pvc_mat.shape[-1]
+    if max_delta_bins is None:
+        max_delta_bins = n_bins - 1
+
+    curve_mean = np.full(pvc_mat.shape[:-2] + (max_delta_bins + 1,), np.nan)
+    curve_std = np.full(pvc_mat.shape[:-2] + (max_delta_bins + 1,), np.nan)
+    for delta_bin in range(min(max_delta_bins + 1, n_bins)):
+        pvc_vals = np.diagonal(pvc_mat, offset=delta_bin, axis1=-2, axis2=-1)
+        curve_mean[..., delta_bin] = np.mean(pvc_vals, axis=-1)
+        curve_std[..., delta_bin] = np.std(pvc_vals, axis=-1)
+    return curve_mean, curve_std
+
+
+def pvc_curve(act, max_delta_bins=None, ignore_nan=False):
+    """
+    PVC curve across position offsets of binned population activity. Shortcut for pvc_offset_curve(pvc_matrix(act)).
+    :param act: np.array with shape (..., n_bins, n_neurons) with the binned activity of every neuron
+    :param max_delta_bins: int, largest offset in bins, see pvc_offset_curve()
+    :param ignore_nan: bool flag whether NaN entries should be ignored, see pvc_matrix()
+    :return: mean and standard deviation of the PVC for every offset, both with shape (..., max_delta_bins + 1)
+    """
+    return pvc_offset_curve(pvc_matrix(act, ignore_nan=ignore_nan), max_delta_bins)
@@ -0,0 +1,90 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+
+def bin_occupancy(labels, n_bins, rank_order=False):
+    """
+    Computes the fraction of samples in every spatial bin.
+    :param labels: 1D int array with the bin label of every sample. Labels 1 - n_bins are spatial bins, label 0 holds
+                   samples outside of the binned range.
+    :param n_bins: int, number of spatial bins
+    :param rank_order: bool flag whether occupancy fractions of all occupied labels (including label 0) should be
+                       assigned to the bins in the order of the labels, as done by the np.unique()-based occupancy of
+                       the original SI functions. Bins are then only matched with their own occupancy if every label
+                       is occupied. Bins without a matching occupancy get NaN.
+    :return: 1D array with shape (n_bins) with the occupancy fraction of every bin
+    """
+    counts = np.bincount(labels, minlength=n_bins + 1)
+    if not rank_order:
+        return counts[1:n_bins + 1] / np.sum(counts)
+    counts = counts[counts > 0]
+    p_occ = np.full(n_bins, np.nan)
+    p_occ[:min(n_bins, len(counts))] = (counts / np.sum(counts))[:n_bins]
+    return p_occ
+
+
+def bin_activity(data, labels, n_bins):
+    """
+    Averages the activity of all traces in every spatial bin with one matrix product against a one-hot encoding of
+    the bin labels.
+    :param data: np.array with shape (n_samples x n_traces) containing the activity of every sample
+    :param labels: 1D int array with shape (n_samples) with the bin label (1 - n_bins) of every sample, other labels
+                   are ignored
+    :param n_bins: int, number of spatial bins
+    :return: np.array with shape (n_traces x n_bins) with the mean activity per bin (NaN for empty bins)
+    """
+    one_hot = (np.asarray(labels)[:, np.newaxis] == np.arange(1, n_bins + 1)).astype(float)
+    counts = np.sum(one_hot, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (one_hot.T @ data).T / counts
+
+
+def skaggs_si(bin_act, p_occ, mean_act=None, log_base=2, normalize=True, invalid='propagate', sigma=None):
+    """
+    Skaggs spatial information (Skaggs et al., 1993) of any number of traces in one vectorized call:
+        SI = sum_i p_i * lambda_i * log(lambda_i / lambda)          (bits/s, normalize=False)
+        SI = sum_i p_i * lambda_i/lambda * log(lambda_i / lambda)   (bits/spike, normalize=True)
+    where p_i is the occupancy and lambda_i the mean activity of bin i, and lambda the mean activity of the trace.
+    :param bin_act: np.array with shape (..., n_bins) with the mean activity per bin of every trace, e.g. (n_cells x
+                    n_bins) or (n_shuffles x n_cells x n_bins)
+    :param p_occ: np.array broadcastable to bin_act, occupancy fraction of every bin
+    :param mean_act: optional, np.array with shape (...) with the mean activity of every trace. If None, the
+                     occupancy-weighted average of bin_act is used.
+    :param log_base: base of the logarithm, 2 (bits) or np.e (nats)
+    :param normalize: bool flag whether the SI should be normalized by the mean activity (information per spike)
+    :param invalid: str, how bins with lambda_i <= 0 (or traces with lambda <= 0) are treated:
+                    'nan': bins are ignored, traces without any valid bin get NaN
+                    'zero': bins contribute 0 (empty bins with NaN activity still make the SI NaN)
+                    'propagate': the formula is applied to all bins (NaN SI if any bin is silent)
+    :param sigma: optional, standard deviation (in bins) of a Gaussian kernel that smoothes bin_act along the bins
+    :return: np.array with shape (...) with the spatial information of every trace
+    """
+    bin_act = np.asarray(bin_act, dtype=float)
+    if sigma is not None:
+        bin_act = gaussian_filter1d(bin_act, sigma, axis=-1)
+    if mean_act is None:
+        mean_act = np.sum(p_occ * bin_act, axis=-1)
+    mean_act = np.asarray(mean_act, dtype=float)[..., np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        act_rel = bin_act / mean_act
+        if log_base == 2:
+            log_rel = np.log2(act_rel)
+        elif log_base == np.e:
+            log_rel = np.log(act_rel)
+        else:
+            log_rel = np.log(act_rel) / np.log(log_base)
+        bin_si = p_occ * (act_rel if normalize else bin_act) * log_rel
+
+    if invalid == 'propagate':
+        return np.sum(bin_si, axis=-1)
+
+    is_invalid = (bin_act <= 0) | (mean_act <= 0)
+    if invalid == 'zero':
+        bin_si[is_invalid] = 0
+        return np.sum(bin_si, axis=-1)
+    elif invalid == 'nan':
+        bin_si[is_invalid] = np.nan
+        return np.where(np.all(np.isnan(bin_si), axis=-1), np.nan, np.nansum(bin_si, axis=-1))
+    else:
+        raise ValueError(f'Invalid bin handling {invalid} not recognized. Use "nan", "zero" or "propagate".')
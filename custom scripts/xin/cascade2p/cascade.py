@@ -34,7 +34,8 @@ import os
 import time
 import numpy as np
 import warnings
-from typing import Union, Tuple
+from collections import OrderedDict
+from typing import Union, Tuple, List
 from . import config, utils
 
 
@@ -225,7 +226,7 @@ def train_model(
 
 
 def predict(model_name: str, traces: np.ndarray, model_folder: str = "Pretrained_models", threshold: int = 0,
-            padding: Union[float, int] = np.nan) -> Tuple[np.ndarray, np.ndarray]:
+            padding: Union[float, int] = np.nan, max_memory: int = 2**28) -> Tuple[np.ndarray, np.ndarray]:
 
     """Use a specific trained neural network ('model_name') to predict spiking activity for calcium traces ('traces')
 
@@ -264,6 +265,14 @@ def predict(model_name: str, traces: np.ndarray, model_folder: str = "Pretrained
         Value which is inserted for datapoints, where no prediction can be made (because of window around timepoint of prediction)
         Default value: np.nan, another recommended value would be 0 which circumvents some problems with following analysis.
 
+    max_memory : int
+        Maximum size in bytes of the input windows that are passed to the models at once. Windows are created as a
+        view of the traces and copied (as float32) in chunks of neurons and timepoints that fit into this limit,
+        so memory usage does not grow with the length of the recording.
+
+    This function loads the models for every call and removes them afterwards. To predict many recordings, use a
+    CascadePredictor object, which keeps the loaded models between calls.
+
     Returns
     --------
     predicted_activity: 2d numpy array (neurons x nr_timepoints)
@@ -271,147 +280,302 @@ def predict(model_name: str, traces: np.ndarray, model_folder: str = "Pretrained
         This array can contain NaNs if the value 'padding' was np.nan as input argument
 
     """
-    import tensorflow.keras
-    from tensorflow.keras.models import load_model
-
-    model_path = os.path.join(model_folder, model_name)
-    cfg_file = os.path.join(model_path, "config.yaml")
-
-    # check if configuration file can be found
-    if not os.path.isfile(cfg_file):
-        m = (
-            'The configuration file "config.yaml" can not be found at the location "{}".\n'.format(
-                os.path.abspath(cfg_file)
-            )
-            + 'You have provided the model "{}" at the absolute or relative path "{}".\n'.format(
-                model_name, model_folder
-            )
-            + 'Please check if there is a folder for model "{}" at the location "{}".'.format(
-                model_name, os.path.abspath(model_folder)
-            )
-        )
-        print(m)
-        raise Exception(m)
+    predictor = CascadePredictor(model_folder=model_folder)
+    try:
+        return predictor.predict(model_name, traces, threshold=threshold, padding=padding, max_memory=max_memory)
+    finally:
+        # remove models from memory
+        predictor.clear()
 
-    # Load config file
-    cfg = config.read_config(cfg_file)
 
-    # extract values from config file into variables
-    verbose = cfg["verbose"]
-    training_data = cfg["training_datasets"]
-    ensemble_size = cfg["ensemble_size"]
-    batch_size = cfg["batch_size"]
-    sampling_rate = cfg["sampling_rate"]
-    before_frac = cfg["before_frac"]
-    window_size = cfg["windowsize"]
-    noise_levels_model = cfg["noise_levels"]
-    smoothing = cfg["smoothing"]
-    causal_kernel = cfg["causal_kernel"]
-
-    model_description = (
-        "\n \nThe selected model was trained on "
-        + str(len(training_data))
-        + " datasets, with "
-        + str(ensemble_size)
-        + " ensembles for each noise level, at a sampling rate of "
-        + str(sampling_rate)
-        + "Hz,"
-    )
-    if causal_kernel:
-        model_description += (
-            " with a resampled ground truth that was smoothed with a causal kernel"
-        )
-    else:
-        model_description += (
-            " with a resampled ground truth that was smoothed with a Gaussian kernel"
-        )
-    model_description += (
-        " of a standard deviation of "
-        + str(int(1000 * smoothing))
-        + " milliseconds. \n \n"
-    )
-    print(model_description)
-
-    if verbose:
-        print("Loaded model was trained at frame rate {} Hz".format(sampling_rate))
-    if verbose:
-        print(
-            "Given argument traces contains {} neurons and {} frames.".format(
-                traces.shape[0], traces.shape[1]
-            )
-        )
+class CascadePredictor:
 
-    # calculate noise levels for each trace
-    trace_noise_levels = utils.calculate_noise_levels(traces, sampling_rate)
+    """Persistent CASCADE predictor that keeps loaded models in memory between predictions
 
-    print(
-        "Noise levels (mean, std; in standard units): "
-        + str(int(np.nanmean(trace_noise_levels * 100)) / 100)
-        + ", "
-        + str(int(np.nanstd(trace_noise_levels * 100)) / 100)
-    )
+    Loading the ensemble of models of a noise level takes several seconds. A predictor keeps the ensembles of the
+    most recently used (model name, noise level) pairs in a least-recently-used cache, so that batch pipelines only
+    load every model once. With 'predict_many', neurons of many recordings are grouped by their noise level and
+    each ensemble is run once over the windows of all recordings.
 
-    # Get model paths as dictionary (key: noise_level) with lists of model
-    # paths for the different ensembles
-    model_dict = get_model_paths(model_path)  # function defined below
-    if verbose > 2:
-        print("Loaded models:", str(model_dict))
+    Parameters
+    ------------
+    model_folder: str
+        Absolute or relative path, which defines the location of the model folders (see predict())
 
-    # XX has shape: (neurons, timepoints, windowsize)
-    XX = utils.preprocess_traces(
-        traces, before_frac=before_frac, window_size=window_size
-    )
-    Y_predict = np.zeros((XX.shape[0], XX.shape[1]))
+    max_ensembles: int
+        Maximum number of ensembles (one per model name and noise level) that are kept in memory. When an ensemble is
+        evicted, the keras session is cleared and the other cached ensembles are loaded again, so frequent evictions
+        are slow; choose max_ensembles at least as large as the number of noise levels used in a batch
 
-    # Use for each noise level the matching model
-    for i, model_noise in enumerate(noise_levels_model):
+    """
 
-        if verbose:
-            print("\nPredictions for noise level {}:".format(model_noise))
+    def __init__(self, model_folder: str = "Pretrained_models", max_ensembles: int = 10):
+        self.model_folder = model_folder
+        self.max_ensembles = max_ensembles
+        self._configs = dict()
+        self._model_paths = dict()
+        self._ensembles = OrderedDict()
+
+    def get_config(self, model_name: str) -> dict:
+        """Read (once) and return the configuration of a model"""
+        if model_name not in self._configs:
+            model_path = os.path.join(self.model_folder, model_name)
+            cfg_file = os.path.join(model_path, "config.yaml")
+
+            # check if configuration file can be found
+            if not os.path.isfile(cfg_file):
+                m = (
+                    'The configuration file "config.yaml" can not be found at the location "{}".\n'.format(
+                        os.path.abspath(cfg_file)
+                    )
+                    + 'You have provided the model "{}" at the absolute or relative path "{}".\n'.format(
+                        model_name, self.model_folder
+                    )
+                    + 'Please check if there is a folder for model "{}" at the location "{}".'.format(
+                        model_name, os.path.abspath(self.model_folder)
+                    )
+                )
+                print(m)
+                raise Exception(m)
+
+            # Load config file and get model paths as dictionary (key: noise_level) with lists of model paths for
+            # the different ensembles
+            self._configs[model_name] = config.read_config(cfg_file)
+            self._model_paths[model_name] = get_model_paths(model_path)  # function defined below
+        return self._configs[model_name]
+
+    def get_ensemble(self, model_name: str, noise_level: int) -> list:
+        """Return the loaded keras models of a noise level, loading them only if they are not cached"""
+        key = (model_name, noise_level)
+        if key in self._ensembles:
+            self._ensembles.move_to_end(key)
+            return self._ensembles[key]
+
+        import tensorflow.keras
+        from tensorflow.keras.models import load_model
+
+        self.get_config(model_name)
+        if len(self._ensembles) >= max(self.max_ensembles, 1):
+            # remove least recently used ensembles. Keras keeps every loaded model in its global state, so the session
+            # is cleared and the remaining ensembles are loaded again to actually release the memory
+            while len(self._ensembles) >= max(self.max_ensembles, 1):
+                self._ensembles.popitem(last=False)
+            tensorflow.keras.backend.clear_session()
+            for cached_name, cached_level in self._ensembles:
+                self._ensembles[(cached_name, cached_level)] = [
+                    load_model(model_path) for model_path in self._model_paths[cached_name][cached_level]]
+
+        models = [load_model(model_path) for model_path in self._model_paths[model_name][noise_level]]
+        self._ensembles[key] = models
+        return models
+
+    def clear(self):
+        """Remove all loaded models from memory"""
+        import tensorflow.keras
+
+        self._ensembles.clear()
+        tensorflow.keras.backend.clear_session()
 
-        # select neurons which have this noise level:
-        if i == 0:  # lowest noise
-            neuron_idx = np.where(trace_noise_levels < model_noise + 0.5)[0]
-        elif i == len(noise_levels_model) - 1:  # highest noise
-            neuron_idx = np.where(trace_noise_levels >= model_noise - 0.5)[0]
+    def predict(self, model_name: str, traces: np.ndarray, threshold: int = 0, padding: Union[float, int] = np.nan,
+                max_memory: int = 2**28) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict spiking activity of one recording, see the function predict() for the parameters"""
+        return self.predict_many(model_name, [traces], threshold=threshold, padding=padding,
+                                 max_memory=max_memory)[0]
+
+    def predict_many(self, model_name: str, traces_list: List[np.ndarray], threshold: int = 0,
+                     padding: Union[float, int] = np.nan, max_memory: int = 2**28) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Predict spiking activity of many recordings (e.g. sessions) with the same model
+
+        Neurons of all recordings are assigned to the noise levels of the model. Each ensemble is loaded (or taken from
+        the cache) once and run over the windows of all its neurons. Windows of different recordings are concatenated
+        into batches of at most 'max_memory' bytes. The result for every recording is the same as from predict().
+
+        Parameters
+        ------------
+        model_name : str
+            Name of the model, see predict()
+
+        traces_list : list of 2d numpy arrays (neurons x nr_timepoints)
+            Df/f traces of every recording, see predict(). Recordings can have different numbers of neurons and
+            timepoints, but should have the frame rate of the model.
+
+        threshold, padding, max_memory :
+            see predict()
+
+        Returns
+        --------
+        List with one tuple (predicted_activity, noise_levels) per recording, see predict()
+
+        """
+        cfg = self.get_config(model_name)
+
+        # extract values from config file into variables
+        verbose = cfg["verbose"]
+        training_data = cfg["training_datasets"]
+        ensemble_size = cfg["ensemble_size"]
+        batch_size = cfg["batch_size"]
+        sampling_rate = cfg["sampling_rate"]
+        before_frac = cfg["before_frac"]
+        window_size = cfg["windowsize"]
+        noise_levels_model = cfg["noise_levels"]
+        smoothing = cfg["smoothing"]
+        causal_kernel = cfg["causal_kernel"]
+
+        model_description = (
+            "\n \nThe selected model was trained on "
+            + str(len(training_data))
+            + " datasets, with "
+            + str(ensemble_size)
+            + " ensembles for each noise level, at a sampling rate of "
+            + str(sampling_rate)
+            + "Hz,"
+        )
+        if causal_kernel:
+            model_description += (
+                " with a resampled ground truth that was smoothed with a causal kernel"
+            )
         else:
-            neuron_idx = np.where(
-                (trace_noise_levels >= model_noise - 0.5)
-                & (trace_noise_levels < model_noise + 0.5)
-            )[0]
+            model_description += (
+                " with a resampled ground truth that was smoothed with a Gaussian kernel"
+            )
+        model_description += (
+            " of a standard deviation of "
+            + str(int(1000 * smoothing))
+            + " milliseconds. \n \n"
+        )
+        print(model_description)
 
-        if len(neuron_idx) == 0:  # no neurons were selected
+        if verbose:
+            print("Loaded model was trained at frame rate {} Hz".format(sampling_rate))
+        if verbose > 2:
+            print("Loaded models:", str(self._model_paths[model_name]))
+
+        # Windows are only created as a view with shape (neurons, windows, windowsize) and copied chunk by chunk.
+        # The window of index i is the input for the prediction at timepoint i + start (see utils.preprocess_traces()).
+        # The models compute in float32, so the traces are converted once here.
+        start = int(before_frac * window_size - 1)
+        max_windows = max(1, int(max_memory // (window_size * 4)))
+
+        windows, noise_levels, predictions = [], [], []
+        for traces in traces_list:
             if verbose:
-                print("\tNo neurons for this noise level")
-            continue  # jump to next noise level
-
-        # load keras models for the given noise level
-        models = list()
-        for model_path in model_dict[model_noise]:
-            models.append(load_model(model_path))
+                print(
+                    "Given argument traces contains {} neurons and {} frames.".format(
+                        traces.shape[0], traces.shape[1]
+                    )
+                )
 
-        # select neurons and merge neurons and timepoints into one dimension
-        XX_sel = XX[neuron_idx, :, :]
+            # calculate noise levels for each trace
+            trace_noise_levels = utils.calculate_noise_levels(traces, sampling_rate)
 
-        XX_sel = np.reshape(
-            XX_sel, (XX_sel.shape[0] * XX_sel.shape[1], XX_sel.shape[2])
-        )
-        XX_sel = np.expand_dims(
-            XX_sel, axis=2
-        )  # add empty third dimension to match training shape
+            print(
+                "Noise levels (mean, std; in standard units): "
+                + str(int(np.nanmean(trace_noise_levels * 100)) / 100)
+                + ", "
+                + str(int(np.nanstd(trace_noise_levels * 100)) / 100)
+            )
 
-        for j, model in enumerate(models):
-            if verbose:
-                print("\t... ensemble", j)
+            windows.append(utils.get_window_view(np.asarray(traces, dtype=np.float32), window_size))
+            noise_levels.append(trace_noise_levels)
+            predictions.append(np.zeros(traces.shape))
 
-            prediction_flat = model.predict(XX_sel, batch_size, verbose=verbose)
-            prediction = np.reshape(prediction_flat, (len(neuron_idx), XX.shape[1]))
+        # Use for each noise level the matching model
+        for i, model_noise in enumerate(noise_levels_model):
 
-            Y_predict[neuron_idx, :] += prediction / len(models)  # average predictions
+            if verbose:
+                print("\nPredictions for noise level {}:".format(model_noise))
+
+            # Split the windows of the neurons with this noise level into chunks (recording, neurons, first and last
+            # window). Chunks contain whole neurons if possible, otherwise neurons are split into time segments.
+            chunks = []
+            for rec, (rec_windows, trace_noise_levels) in enumerate(zip(windows, noise_levels)):
+                # select neurons which have this noise level:
+                if i == 0:  # lowest noise
+                    neuron_idx = np.where(trace_noise_levels < model_noise + 0.5)[0]
+                elif i == len(noise_levels_model) - 1:  # highest noise
+                    neuron_idx = np.where(trace_noise_levels >= model_noise - 0.5)[0]
+                else:
+                    neuron_idx = np.where(
+                        (trace_noise_levels >= model_noise - 0.5)
+                        & (trace_noise_levels < model_noise + 0.5)
+                    )[0]
+
+                # No prediction can be made for timepoints without a complete window
+                n_windows = rec_windows.shape[1]
+                predictions[rec][neuron_idx, :start] = np.nan
+                predictions[rec][neuron_idx, start + n_windows:] = np.nan
+
+                neurons_per_chunk = max(1, max_windows // max(n_windows, 1))
+                windows_per_chunk = max(1, min(n_windows, max_windows))
+                for n_start in range(0, len(neuron_idx), neurons_per_chunk):
+                    for t_start in range(0, n_windows, windows_per_chunk):
+                        chunks.append((rec, neuron_idx[n_start:n_start + neurons_per_chunk], t_start,
+                                       min(t_start + windows_per_chunk, n_windows)))
+
+            if len(chunks) == 0:  # no neurons were selected
+                if verbose:
+                    print("\tNo neurons for this noise level")
+                continue  # jump to next noise level
+
+            # Concatenate consecutive chunks (also across recordings) into batches of at most max_windows windows
+            batches = [[]]
+            batch_windows = 0
+            for chunk in chunks:
+                chunk_windows = len(chunk[1]) * (chunk[3] - chunk[2])
+                if batch_windows + chunk_windows > max_windows and len(batches[-1]) > 0:
+                    batches.append([])
+                    batch_windows = 0
+                batches[-1].append(chunk)
+                batch_windows += chunk_windows
+
+            # load keras models for the given noise level (or take them from the cache)
+            models = self.get_ensemble(model_name, model_noise)
+
+            for j, model in enumerate(models):
+                if verbose:
+                    print("\t... ensemble", j)
+
+                for batch in batches:
+                    # copy windows of the batch, merge neurons and timepoints into one dimension and add empty third
+                    # dimension to match training shape
+                    sizes = [len(neuron_idx) * (t_end - t_start) for _, neuron_idx, t_start, t_end in batch]
+                    offsets = np.concatenate(([0], np.cumsum(sizes)))
+                    XX_sel = np.empty((offsets[-1], window_size, 1), dtype=np.float32)
+                    for (rec, neuron_idx, t_start, t_end), offset, n_chunk in zip(batch, offsets, sizes):
+                        XX_sel[offset:offset + n_chunk, :, 0] = \
+                            windows[rec][neuron_idx, t_start:t_end].reshape(n_chunk, window_size)
+
+                    prediction_flat = model.predict(XX_sel, batch_size, verbose=verbose)
+
+                    # average predictions
+                    for (rec, neuron_idx, t_start, t_end), offset, n_chunk in zip(batch, offsets, sizes):
+                        prediction = np.reshape(prediction_flat[offset:offset + n_chunk],
+                                                (len(neuron_idx), t_end - t_start))
+                        predictions[rec][neuron_idx, start + t_start:start + t_end] += prediction / len(models)
+
+        results = []
+        for Y_predict, trace_noise_levels in zip(predictions, noise_levels):
+            threshold_predictions(Y_predict, threshold, smoothing, sampling_rate, verbose)
+
+            # NaN or 0 for first and last datapoints, for which no predictions can be made
+            Y_predict[:, 0 : int(before_frac * window_size)] = padding
+            Y_predict[:, -int((1 - before_frac) * window_size) :] = padding
+
+            results.append((Y_predict, trace_noise_levels))
+
+        print("Done")
+
+        return results
+
+
+def threshold_predictions(Y_predict: np.ndarray, threshold: int, smoothing: float, sampling_rate: float,
+                          verbose: int = 0) -> np.ndarray:
+
+    """Apply the 'threshold' option of predict() to predicted spiking activity (in-place)
 
-        # remove models from memory
-        tensorflow.keras.backend.clear_session()
+    ( Helper function called by predict() )
 
+    """
     if threshold is False:  # only if 'False' is passed as argument
         if verbose:
             print(
@@ -462,13 +626,7 @@ def predict(model_name: str, traces: np.ndarray, model_folder: str = "Pretrained
             )
         )
 
-    # NaN or 0 for first and last datapoints, for which no predictions can be made
-    Y_predict[:, 0 : int(before_frac * window_size)] = padding
-    Y_predict[:, -int((1 - before_frac) * window_size) :] = padding
-
-    print("Done")
-
-    return Y_predict, trace_noise_levels
+    return Y_predict
 
 
 def verify_config_dict(config_dictionary):
@@ -11,6 +11,9 @@ Helper functions for CASCADE:
   calculate_noise_levels():
     computes the noise level for dF/F traces
 
+  get_window_view():
+    moving windows of calcium data as a view, without copying the data
+
   preprocess_traces():
     converts calcium data to a format that can be used by the deep network
 
@@ -119,12 +122,32 @@ def calculate_noise_levels(neurons_x_time, frame_rate):
 
 
 
+def get_window_view(neurons_x_time, window_size):
+
+    """
+    Extract all moving windows of the size 'window_size' from dF/F traces as a read-only view of the traces.
+    No data is copied, so windows of long recordings can be processed chunk by chunk (e.g. in cascade.predict()).
+
+    input:  dF/F traces (matrix with nb_neurons x time_points)
+            window_size (size of the receptive window of the deep network)
+    output: view with shape nb_neurons x (time_points - window_size + 1) x window_size, where the window of index i
+            contains the time points i to i + window_size - 1
+
+    """
+    dF_traces = np.asarray(neurons_x_time)
+    n_windows = max(dF_traces.shape[1] - window_size + 1, 0)
+    return np.lib.stride_tricks.as_strided(dF_traces, shape=(dF_traces.shape[0], n_windows, window_size),
+                                           strides=(dF_traces.strides[0], dF_traces.strides[1], dF_traces.strides[1]),
+                                           writeable=False)
+
+
 def preprocess_traces(neurons_x_time, before_frac, window_size):
 
     """
     Transform dF/F data into a format that can be used by the deep network.
 
     For each time point, a window of the size 'window_size' of the dF/F is extracted.
+    This creates the whole (large) array in memory; use get_window_view() to process windows chunk by chunk.
 
     input:  dF/F traces (matrix with nb_neurons x time_points)
             window_size (size of the receptive window of the deep network)
@@ -136,9 +159,8 @@ def preprocess_traces(neurons_x_time, before_frac, window_size):
     start = int(before_frac * window_size -1)
     end = dF_traces.shape[1] - window_size + start + 1
     # extract a moving window from the calcium trace
-    window_indexes = (np.expand_dims(np.arange(window_size), 0) + np.expand_dims(np.arange(dF_traces.shape[1] - window_size + 1), 0).T)
     X = np.full(shape=(dF_traces.shape[0], dF_traces.shape[1], window_size), fill_value=np.nan)
-    X[:, start:end, :] = dF_traces[:, window_indexes]
+    X[:, start:end, :] = get_window_view(dF_traces, window_size)
     return X
 
 
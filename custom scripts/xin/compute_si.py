@@ -11,9 +11,13 @@ Based on Shuman 2020 (Nat Neurosci).
 
 import tkinter as tk
 from tkinter import filedialog
-from typing import Tuple, Any, Union, List
+from typing import Tuple, Any, Union, List, Optional
 from glob import glob
 import os
+import argparse
+import multiprocessing
+import traceback
+from timeit import default_timer as timer
 import numpy as np
 from copy import deepcopy
 from pathlib import Path
@@ -23,15 +27,24 @@ from caiman.source_extraction.cnmf import cnmf
 from scipy.ndimage import gaussian_filter1d
 from scipy.io import savemat
 
+from standard_pipeline import behavior_store, pvc_kernel, si_kernel
+
 # USER-CHOSEN PARAMETERS
 RUNNING_THR = 5.0  # Number of encoder ticks per frame above which a frame counts as "running"
 BIN_LENGTH = 5  # Spatial bin length to pool dF/F traces, in [cm]
 SIGMA_GAUSS = 1  # Standard deviation of Gaussian kernel when smoothing spatial activity maps for SI computation
 MIN_PF_SIZE = 3  # Minimum number of spatial bins that a place field should have
 N_ITER = 1000  # Number of shufflings during bootstrapping. Larger value produces more reliable result, but computation takes longer
+SHUFFLE_CHUNK_SIZE = 20  # Number of shufflings that are kept in memory at once. Lower value reduces memory usage.
 
 n_bins = 400 // BIN_LENGTH  # Track length of 400 cm is assumed
 
+# CASCADE predictor that keeps the models loaded between sessions, created by run_cascade()
+_cascade_predictor = None
+
+# Result files of the whole session, see save_results()
+SESSION_OUTPUTS = ['decon.npy', 'bin_spikes.npy', 'spatial_info.mat', 'pvc_all.npy', 'pvc_place.npy', 'sparsity.npy']
+
 # CASCADE PARAMETERS
 MODEL_NAME = 'Global_EXC_30Hz_smoothing50ms'  # Name of the model for deconvolution. The default is good for 30Hz recordings.
 THRESHOLD = 0  # Whether deconvoluted trace should be thresholded at the height of 1 spike or not.
@@ -53,6 +66,23 @@ def get_session_dir() -> Path:
                                                    'files.'))
 
 
+def get_behavior_files(sess_dir: Path) -> List[str]:
+    """
+    Find all merged_behavior.txt files of a session in the session directory and up to two subdirectories.
+
+    Args:
+        sess_dir: Absolute path of the session directory.
+
+    Returns:
+        List of file paths, sorted by the timestamp of the trials.
+    """
+    trial_list = glob(sess_dir.as_posix() + '\\merged_behavior*.txt')
+    trial_list.extend(glob(sess_dir.as_posix() + '\\*\\merged_behavior*.txt'))
+    trial_list.extend(glob(sess_dir.as_posix() + '\\*\\*\\merged_behavior*.txt'))
+    trial_list.sort(key=lambda x: int(x.split('.')[-2].split('_')[-1]))  # Sort trials by their timestamp
+    return trial_list
+
+
 def load_data(sess_dir: Path) -> Tuple[Any, list]:
     """
     Load CNM results file (cnm_results.hdf5) as well as all merged_behavior.txt files for the session.
@@ -75,15 +105,11 @@ def load_data(sess_dir: Path) -> Tuple[Any, list]:
         cnm_obj = cnmf.load_CNMF(cnm_file[0])
 
     ### Load behavior files
-    # Get a list of all merged_behavior.txt files in the session directory and one subdirectory
-    trial_list = glob(sess_dir.as_posix() + '\\merged_behavior*.txt')
-    trial_list.extend(glob(sess_dir.as_posix() + '\\*\\merged_behavior*.txt'))
-    trial_list.extend(glob(sess_dir.as_posix() + '\\*\\*\\merged_behavior*.txt'))
-    trial_list.sort(key=lambda x: int(x.split('.')[-2].split('_')[-1]))  # Sort trials by their timestamp
+    trial_list = get_behavior_files(sess_dir)
 
     # Load the behavior data as numpy arrays
     if len(trial_list) > 0:
-        behavior_arrays = [np.loadtxt(trial, delimiter='\t') for trial in trial_list]
+        behavior_arrays = [behavior_store.load_behavior(trial) for trial in trial_list]
     else:
         raise FileNotFoundError(f'Could not find merged_behavior.txt files at {sess_dir}')
     return cnm_obj, behavior_arrays
@@ -199,6 +225,7 @@ def align_frames_with_vr(behavior_list, tr_mask) -> Tuple[list, list]:
 def run_cascade(dff: np.ndarray) -> np.ndarray:
     """
     Wrapper function to run Peter's CASCADE deconvolution algorithm (see https://github.com/HelmchenLabSoftware/Cascade).
+    The loaded models are kept in memory for later calls (e.g. for the next session of run_batch()).
 
     Args:
         dff: dF/F activity traces of all neurons, with shape (n_cells, n_frames)
@@ -206,73 +233,170 @@ def run_cascade(dff: np.ndarray) -> np.ndarray:
     Returns:
         2D np.ndarray with same shape as input, containing deconvolved spike probability per frame.
     """
+    global _cascade_predictor
 
     from xin.cascade2p import checks, cascade
-    # To run deconvolution, tensorflow, keras and ruaml.yaml must be installed
-    checks.check_packages()
 
-    print('Using deconvolution model {}'.format(MODEL_NAME))
+    if _cascade_predictor is None:
+        # To run deconvolution, tensorflow, keras and ruaml.yaml must be installed
+        checks.check_packages()
 
-    # model is saved in subdirectory models of cascade2p
-    import inspect
-    cascade_path = os.path.dirname(inspect.getfile(cascade))
-    model_folder = os.path.join(cascade_path, 'Pretrained_models')
+        # model is saved in subdirectory models of cascade2p
+        import inspect
+        cascade_path = os.path.dirname(inspect.getfile(cascade))
+        _cascade_predictor = cascade.CascadePredictor(model_folder=os.path.join(cascade_path, 'Pretrained_models'))
+
+    print('Using deconvolution model {}'.format(MODEL_NAME))
 
     # Transform traces back to float64 to not confuse CASCADE
-    decon_traces, trace_noise_levels = cascade.predict(MODEL_NAME, np.array(dff, dtype=np.float64),
-                                                       model_folder=model_folder, threshold=THRESHOLD, padding=0)
+    decon_traces, trace_noise_levels = _cascade_predictor.predict(MODEL_NAME, np.array(dff, dtype=np.float64),
+                                                                  threshold=THRESHOLD, padding=0)
     # Store traces in float32 to save disk space
     return np.array(decon_traces, dtype=np.float32)
 
 
-def bin_activity_to_vr(spikes: np.ndarray, tr_mask: np.ndarray, running_masks: list,
-                       bin_frame_counts: Union[np.ndarray, list], fr) -> np.ndarray:
+def get_binning_plan(tr_mask: np.ndarray, running_masks: list, bin_frame_counts: Union[np.ndarray, list]) -> dict:
     """
-    Spatially bins the dF/F and deconvolved traces of many neurons to the VR position. Extracted from
-    BinnedActivity.make() because it is also used to bin the shuffled trace during place cell bootstrapping.
+    Precomputes all frame indices that are needed to spatially bin traces of a session, and to circularly shuffle them
+    during place cell bootstrapping. Binning and shuffling are then done with index arithmetic on whole arrays.
+
+    Running frames of the session are collected trial by trial. Because bin_frame_counts assigns consecutive running
+    frames to consecutive bins, every (trial, bin) pair is a contiguous segment of these frames, which can be summed
+    with np.add.reduceat.
+    For shuffling, every trial gets a pool of frames that is circularly shifted: the running frames of the first and
+    last trial, or the (unfiltered) previous trial, the running frames of the trial and the (unfiltered) next trial
+    for all other trials (see circular_shuffle() in spatial_info()).
 
     Args:
-        spikes: CASCADE spike prediction of the trace, with shape (n_neurons, n_frames_in_session).
         tr_mask: 1D array with length n_frames_in_session, from get_trial_mask().
         running_masks: One element per trial, from align_frames_with_vr().
         bin_frame_counts: Same as running_masks, from align_frames_with_vr().
-        fr: frame rate of the recording, in Hz
 
     Returns:
-        3D np.darray with shape (n_neurons, n_bins, n_trials), spatially binned spikerate.
+        Dictionary with the binning plan:
+        - run_frames: Session frame indices of all running frames, with shape (n_running_frames,).
+        - bin_starts: Index in run_frames of the first frame of every (trial, bin) pair, with shape (n_trials*n_bins,).
+        - bin_frame_counts: Frame counts per bin, with shape (n_bins, n_trials).
+        - pool: Concatenated session frame indices of the shuffle pools of all trials.
+        - pool_start, pool_offset, pool_len: For every running frame, the start of its trial's pool in pool, its
+            position in the pool and the length of the pool, with shape (n_running_frames,) each.
+        - trial_idx: Relative trial index of every running frame, with shape (n_running_frames,).
+    """
+    trial_ids = np.unique(tr_mask)
+    bfc = np.array([np.asarray(count, dtype=int) for count in bin_frame_counts]).T
+
+    # Every bin needs at least one frame, otherwise it cannot be binned
+    if np.any(bfc == 0):
+        raise IndexError("Bin {} returned empty array, could not bin trace.".format(np.where(bfc == 0)[0][0]))
+
+    trial_frames = [np.where(tr_mask == trial_id)[0] for trial_id in trial_ids]
+    run_frames = [frames[mask] for frames, mask in zip(trial_frames, running_masks)]
+    for rel_idx, frames in enumerate(run_frames):
+        if len(frames) != np.sum(bfc[:, rel_idx]):
+            raise IndexError('Trial {} has {} running frames, but {} frames in bin_frame_count.'
+                             .format(rel_idx, len(frames), np.sum(bfc[:, rel_idx])))
+
+    pool, pool_start, pool_offset, pool_len, trial_idx = [], [], [], [], []
+    n_pool = 0
+    for rel_idx, trial_id in enumerate(trial_ids):
+        if trial_id == trial_ids[0] or trial_id == trial_ids[-1]:
+            # The first and last trials are circulated in-trial
+            prev_frames = np.array([], dtype=int)
+            curr_pool = run_frames[rel_idx]
+        else:
+            # All other trials are shifted together with the previous and next trial
+            prev_frames = np.where(tr_mask == trial_id - 1)[0]
+            next_frames = np.where(tr_mask == trial_id + 1)[0]
+            curr_pool = np.concatenate((prev_frames, run_frames[rel_idx], next_frames))
+
+        n_run = len(run_frames[rel_idx])
+        pool.append(curr_pool)
+        pool_start.append(np.full(n_run, n_pool))
+        pool_offset.append(len(prev_frames) + np.arange(n_run))
+        pool_len.append(np.full(n_run, len(curr_pool)))
+        trial_idx.append(np.full(n_run, rel_idx))
+        n_pool += len(curr_pool)
+
+    return dict(run_frames=np.concatenate(run_frames),
+                bin_starts=np.concatenate(([0], np.cumsum(bfc.T.flatten())[:-1])),
+                bin_frame_counts=bfc,
+                pool=np.concatenate(pool), pool_start=np.concatenate(pool_start),
+                pool_offset=np.concatenate(pool_offset), pool_len=np.concatenate(pool_len),
+                trial_idx=np.concatenate(trial_idx))
+
+
+def get_shuffled_frames(plan: dict, shifts: np.ndarray) -> np.ndarray:
+    """
+    Computes the frame indices of circularly shuffled traces. Equivalent to np.roll() of every trial's shuffle pool by
+    the shift of the trial and taking the values at the positions of the trial's running frames.
+
+    Args:
+        plan: Binning plan of the session, from get_binning_plan().
+        shifts: Integer shifts in frames with shape (n_iter, n_trials), one per shuffle and trial.
+
+    Returns:
+        Numpy array with shape (n_iter, n_running_frames) with the session frame index of every shuffled running frame.
     """
+    pos = (plan['pool_offset'][None, :] - shifts[:, plan['trial_idx']]) % plan['pool_len'][None, :]
+    return plan['pool'][plan['pool_start'][None, :] + pos]
 
-    n_trials = len(running_masks)
 
-    binned_spike = np.zeros((spikes.shape[0], n_bins, n_trials))
-    binned_spikerate = np.zeros((spikes.shape[0], n_bins, n_trials))
+def bin_with_plan(spikes: np.ndarray, plan: dict, fr: float, frames: np.ndarray = None,
+                  max_memory: int = 2**28) -> np.ndarray:
+    """
+    Spatially bins spikerates of many neurons with a precomputed binning plan. Spike probabilities of all frames in a
+    bin are summed (NaNs are ignored) and divided by the time occupied by the bin.
 
-    for trial_idx, (run_mask, bin_frame_count) in enumerate(zip(running_masks, bin_frame_counts)):
-        # Create bin mask from frame counts
-        bin_masks = []
-        for idx, n_frames in enumerate(bin_frame_count):
-            bin_masks.append(np.full(n_frames, idx))
-        bin_mask = np.concatenate(bin_masks)
+    Args:
+        spikes: CASCADE spike prediction of the trace, with shape (n_neurons, n_frames_in_session).
+        plan: Binning plan of the session, from get_binning_plan().
+        fr: frame rate of the recording, in Hz
+        frames: Optional, session frame indices of the running frames with shape (n_iter, n_running_frames), e.g. from
+            get_shuffled_frames(). If None, the real (unshuffled) running frames are used.
+        max_memory: Maximum size in bytes of the gathered frames that are binned at once. Iterations are processed in
+            batches that fit into this limit.
 
-        # Get section of current trial from the session-wide trace and filter out non-running frames
-        trial_spike = spikes[:, tr_mask == trial_idx][:, run_mask]
+    Returns:
+        Numpy array with shape (n_neurons, n_bins, n_trials), spatially binned spikerate. If frames are provided, an
+        additional first axis of length n_iter is added.
+    """
+    single = frames is None
+    if single:
+        frames = plan['run_frames'][None, :]
 
-        # Iteratively for all bins, average trace and sum spike probabilities
-        for bin_idx in range(n_bins):
-            bin_spike = trial_spike[:, bin_mask == bin_idx]
+    spikes = np.where(np.isnan(spikes), 0, spikes).astype(float)
+    bfc = plan['bin_frame_counts']
+    bin_times = bfc / fr
 
-            if bin_spike.shape[1]:  # Test if there is data for the current bin, otherwise raise error
-                # sum spike values (CASCADE's spike probability is cumulative)
-                binned_spike[:, bin_idx, trial_idx] = np.nansum(bin_spike, axis=1)
-            else:
-                raise IndexError("Bin {} returned empty array, could not bin trace.".format(bin_idx))
+    binned = np.zeros((len(frames), len(spikes)) + bfc.shape)
+    batch_size = max(1, int(max_memory // (spikes.nbytes / spikes.shape[1] * frames.shape[1])))
+    for start in range(0, len(frames), batch_size):
+        batch = frames[start:start + batch_size]
+        # Sum of every (trial, bin) segment with shape (n_neurons, n_batch, n_trials * n_bins)
+        bin_sum = np.add.reduceat(spikes[:, batch], plan['bin_starts'], axis=2)
+        bin_sum = bin_sum.reshape(bin_sum.shape[:2] + (bfc.shape[1], bfc.shape[0]))
+        binned[start:start + len(batch)] = np.transpose(bin_sum, (1, 0, 3, 2)) / bin_times
 
-        # Transform deconvolved values into mean firing rates by dividing by the time in s occupied by the bin (from
-        # number of samples * sampling rate)
-        bin_times = bin_frame_count / fr
-        binned_spikerate[:, :, trial_idx] = binned_spike[:, :, trial_idx] / bin_times
+    return binned[0] if single else binned
 
-    return binned_spikerate
+
+def bin_activity_to_vr(spikes: np.ndarray, tr_mask: np.ndarray, running_masks: list,
+                       bin_frame_counts: Union[np.ndarray, list], fr) -> np.ndarray:
+    """
+    Spatially bins the dF/F and deconvolved traces of many neurons to the VR position. Extracted from
+    BinnedActivity.make() because it is also used to bin the shuffled trace during place cell bootstrapping.
+
+    Args:
+        spikes: CASCADE spike prediction of the trace, with shape (n_neurons, n_frames_in_session).
+        tr_mask: 1D array with length n_frames_in_session, from get_trial_mask().
+        running_masks: One element per trial, from align_frames_with_vr().
+        bin_frame_counts: Same as running_masks, from align_frames_with_vr().
+        fr: frame rate of the recording, in Hz
+
+    Returns:
+        3D np.darray with shape (n_neurons, n_bins, n_trials), spatially binned spikerate.
+    """
+    return bin_with_plan(spikes, get_binning_plan(tr_mask, running_masks, bin_frame_counts), fr)
 
 
 def compute_pvc_curve(traces: np.ndarray, max_offset: int = 150) -> np.ndarray:
@@ -302,28 +426,30 @@ def compute_pvc_curve(traces: np.ndarray, max_offset: int = 150) -> np.ndarray:
     # Average activity map across trials, and flip axes (function requires bins to be first axis)
     avg_traces = np.mean(traces, axis=2).T
 
-    num_bins = np.size(avg_traces, 0)
-    num_neurons = np.size(traces, 1)
-    curve_yvals = np.empty(max_delta_bins + 1)
-    curve_stdev = np.empty(max_delta_bins + 1)
-    for delta_bin in range(max_delta_bins + 1):  # Loop through all possible offset distances
-        pvc_vals = []
-        for offset in range(num_bins - delta_bin):  # Apply the distance to every position bin
-            idx_x = offset
-            idx_y = offset + delta_bin
-            pvc_xy_num = pvc_xy_den_term1 = pvc_xy_den_term2 = 0
-            for neuron in range(num_neurons):  # Correlate across neurons
-                pvc_xy_num += traces[idx_x][neuron] * traces[idx_y][neuron]
-                pvc_xy_den_term1 += traces[idx_x][neuron] * traces[idx_x][neuron]
-                pvc_xy_den_term2 += traces[idx_y][neuron] * traces[idx_y][neuron]
-            pvc_xy = pvc_xy_num / (np.sqrt(pvc_xy_den_term1 * pvc_xy_den_term2))
-            pvc_vals.append(pvc_xy)
-        mean_pvc_delta_bin = np.mean(pvc_vals)
-        stdev_delta_bin = np.std(pvc_vals)
-        curve_yvals[delta_bin] = mean_pvc_delta_bin
-        curve_stdev[delta_bin] = stdev_delta_bin
-
-    return np.vstack((curve_yvals, curve_stdev))
+    return np.vstack(pvc_kernel.pvc_curve(avg_traces, max_delta_bins=max_delta_bins))
+
+
+def rowwise_corrcoef(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation coefficient between corresponding rows of two arrays, computed for all rows at once from the
+    centered and normalized data. Same as np.corrcoef(x[i], y[i])[0, 1] for every row i (including clipping to
+    [-1, 1] and NaN for constant rows).
+
+    Args:
+        x: Array with shape (..., n_samples). Leading axes (e.g. shuffles and cells) are processed in one batch.
+        y: Array with the same shape as x.
+
+    Returns:
+        Numpy array with shape (...) with the correlation coefficient of every row pair.
+    """
+    x_cent = x - np.mean(x, axis=-1, keepdims=True)
+    y_cent = y - np.mean(y, axis=-1, keepdims=True)
+    fact = 1 / (x.shape[-1] - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.sum(x_cent * y_cent, axis=-1) * fact
+        r = r / np.sqrt(np.sum(x_cent * x_cent, axis=-1) * fact)
+        r = r / np.sqrt(np.sum(y_cent * y_cent, axis=-1) * fact)
+    return np.clip(r, -1, 1)
 
 
 def compute_sparsity(act_map: np.ndarray) -> np.ndarray:
@@ -333,21 +459,19 @@ def compute_sparsity(act_map: np.ndarray) -> np.ndarray:
 
     Args:
         act_map: 3D array of spatially binned spikes in shape (n_neurons, n_bins, n_trials), from bin_activity_to_vr().
+            Additional leading axes (e.g. shuffles) are processed in one batch.
 
     Returns:
-        1D array with shape (n_neurons,) holding sparsity value for each neuron.
+        1D array with shape (n_neurons,) holding sparsity value for each neuron (plus leading axes of act_map).
     """
 
-    num_bins = act_map.shape[1]
-    s = []
-    for neuron in act_map:
-        neuron_spars = []
-        for trial_idx in range(neuron.shape[1]):
-            neuron_spars.append((1 - (np.sum(neuron[:, trial_idx])**2/np.sum(neuron[:, trial_idx]**2)) / num_bins) *
-                                (num_bins/(num_bins-1)))
-        s.append(np.mean(neuron_spars))
-
-    return np.array(s)
+    num_bins = act_map.shape[-2]
+    # Move bins to the last (contiguous) axis, so that sums are computed in the same order as for single trials
+    per_trial = np.ascontiguousarray(np.swapaxes(act_map, -1, -2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trial_spars = ((1 - (np.sum(per_trial, axis=-1)**2 / np.sum(per_trial**2, axis=-1)) / num_bins) *
+                       (num_bins/(num_bins-1)))
+    return np.mean(trial_spars, axis=-1)
 
 
 def spatial_info(traces: np.ndarray, bin_frame_count: List[np.ndarray], deconv: np.ndarray, tr_mask: np.ndarray,
@@ -383,19 +507,19 @@ def spatial_info(traces: np.ndarray, bin_frame_count: List[np.ndarray], deconv:
         and adapted to calcium imaging data by Shuman (2020).
 
         Args:
-            act_map: Spatially binned spikerates with shape (n_cells, n_bins, n_trials).
+            act_map: Spatially binned spikerates with shape (n_cells, n_bins, n_trials). Additional leading axes
+                (e.g. shuffles) are processed in one batch.
             occupancy: Frame numbers per position bin for all trials.
             sigma: Standard deviation of Gaussian kernel for binned spikerate smoothing.
 
         Returns:
-            Numpy array with shape (n_cells) with the spatial information values per cell.
+            Numpy array with shape (n_cells) with the spatial information values per cell (plus leading axes of
+            act_map).
         """
         p_occ = np.sum(occupancy, axis=0) / np.sum(occupancy)  # Occupancy probability per bin p(i)
-        p_occ = p_occ[None, :]
-        act_bin = np.mean(gaussian_filter1d(act_map, sigma, axis=1), axis=2)  # Smoothed activity rate per bin lambda(i)
-        # Normalize SI by activity level (lambda-bar) to make SI value more comparable between cells
-        act_rel = act_bin.T / np.sum(p_occ * act_bin, axis=1)
-        return np.sum(p_occ * act_rel.T * np.log2(act_rel.T), axis=1)
+        # Smoothed activity rate per bin lambda(i), SI is normalized by activity level (lambda-bar) to make SI value
+        # more comparable between cells
+        return si_kernel.skaggs_si(np.mean(act_map, axis=-1), p_occ, log_base=2, normalize=True, sigma=sigma)
 
     def compute_within_session_stability(act_map: np.ndarray, sigma: int) -> np.ndarray:
         """
@@ -405,39 +529,41 @@ def spatial_info(traces: np.ndarray, bin_frame_count: List[np.ndarray], deconv:
         value of the cell.
 
         Args:
-            act_map: Spatially binned spikerates with shape (n_cells, n_bins, n_trials).
+            act_map: Spatially binned spikerates with shape (n_cells, n_bins, n_trials). Additional leading axes
+                (e.g. shuffles) are processed in one batch.
             sigma: Standard deviation of Gaussian kernel for binned spikerate smoothing.
 
         Returns:
-            Numpy array with shape (n_cells) with stability value of each cell.
+            Numpy array with shape (n_cells) with stability value of each cell (plus leading axes of act_map).
         """
-        smoothed = gaussian_filter1d(act_map, sigma, axis=1)
+        smoothed = gaussian_filter1d(act_map, sigma, axis=-2)
         # First, correlate trials in the first vs second half of the session
-        half_point = int(np.round(smoothed.shape[2] / 2))
-        first_half = np.mean(smoothed[:, :, :half_point], axis=2)
-        second_half = np.mean(smoothed[:, :, half_point:], axis=2)
-        r_half = np.vstack([np.corrcoef(first_half[x], second_half[x])[0, 1] for x in range(len(smoothed))])
-        fisher_z_half = np.arctanh(r_half)
+        half_point = int(np.round(smoothed.shape[-1] / 2))
+        first_half = np.mean(smoothed[..., :half_point], axis=-1)
+        second_half = np.mean(smoothed[..., half_point:], axis=-1)
+        fisher_z_half = np.arctanh(rowwise_corrcoef(first_half, second_half))
 
         # Then, correlate even and odd trials
-        even = np.mean(smoothed[:, :, ::2], axis=2)
-        odd = np.mean(smoothed[:, :, 1::2], axis=2)
-        r_even = np.vstack([np.corrcoef(even[x], odd[x])[0, 1] for x in range(len(smoothed))])
-        fisher_z_even = np.arctanh(r_even)
+        even = np.mean(smoothed[..., ::2], axis=-1)
+        odd = np.mean(smoothed[..., 1::2], axis=-1)
+        fisher_z_even = np.arctanh(rowwise_corrcoef(even, odd))
 
         # Within-session stability is the average of the two measures
-        stab = np.mean(np.hstack((fisher_z_half, fisher_z_even)), axis=1)
+        stab = np.mean(np.stack((fisher_z_half, fisher_z_even), axis=-1), axis=-1)
 
         return stab
 
     def circular_shuffle(data: np.ndarray, t_mask: np.ndarray, r_mask: List[np.ndarray], occupancy: List[np.ndarray],
-                         num_bins: int, n_iter: int, fr: float) -> np.ndarray:
+                         num_bins: int, n_iter: int, fr: float, chunk_size: int) -> np.ndarray:
         """
         Performs circular shuffling of activity data to creating surrogate data for significance testing (after
         Shuman 2020). Each trial is circularly shifted by +/- trial length. Traces from adjacent trials shifts in
         and out of view at the ends. For the first and last trial, the trial trace is shifted inside itself.
         The shifted data is binned with the original occupancy data, so that each frame now is associated with a
         different position.
+        Shuffles are generated lazily in chunks of chunk_size iterations, so that only one chunk has to be kept in
+        memory at any time. Shifts of all trials and iterations of a chunk are drawn at once, and the shuffled traces
+        are binned with index arithmetic on the precomputed binning plan of the session (see get_binning_plan()).
 
         Args:
             data: Unbinned deconvolved spikerate with shape (n_cells, n_frames). From run_cascade().
@@ -447,96 +573,90 @@ def spatial_info(traces: np.ndarray, bin_frame_count: List[np.ndarray], deconv:
             num_bins: Number of spatial bins in which the signal should be binned.
             n_iter: Number of iterations of shuffling.
             fr: Frame rate of the recording.
+            chunk_size: Number of shuffling iterations per yielded chunk.
 
-        Returns:
-            Np.array with shape (n_iter, n_cells, num_bins, n_trials) with the shuffled activity data.
+        Yields:
+            Np.array with shape (n_chunk, n_cells, num_bins, n_trials) with the shuffled activity data of the next
+            n_chunk <= chunk_size iterations.
         """
+        plan = get_binning_plan(t_mask, r_mask, occupancy)
+        if plan['bin_frame_counts'].shape[0] != num_bins:
+            raise IndexError(f'Expected {num_bins} bins, but bin_frame_count has {plan["bin_frame_counts"].shape[0]}.')
 
-        # Shuffled traces are stored in this array with shape (n_iter, n_rois, n_bins, n_trials)
-        shuffle_data = np.zeros((n_iter, len(data), num_bins, len(r_mask))) * np.nan
+        for chunk_start in range(0, n_iter, chunk_size):
+            n_chunk = min(chunk_size, n_iter - chunk_start)
 
-        for shuff in range(n_iter):
-            shift = []  # The shifted traces for the current shuffle
-            bin_f_counts = []  # Holds bin frame counts for accepted trials
-            trial_mask_accepted = []  # Holds trial mask for accepted trials
-            dummy_running_masks = []  # Dummy mask that allows all frames (needed for bin_activity_to_vr())
+            # Possible shifts are +/- half of the session length (Aleksejs suggestion), one per shuffle and trial
+            shifts = np.random.randint(-data.shape[1] // 2, data.shape[1] // 2 + 1, size=(n_chunk, len(r_mask)))
 
-            for rel_idx, trial_id in enumerate(np.unique(t_mask)):
-                # Get trace from the current trial and remove resting frames
-                curr_trace = data[:, t_mask == trial_id][:, r_mask[rel_idx]]
+            yield bin_with_plan(data, plan, fr, frames=get_shuffled_frames(plan, shifts))
 
-                # Possible shifts are +/- half of the trial length (Aleksejs suggestion)
-                d = np.random.randint(-data.shape[1] // 2, data.shape[1] // 2 + 1)
-
-                dummy_running_masks.append(np.ones(curr_trace.shape[1], dtype=bool))
-
-                # Circularly shift traces
-                if trial_id == np.unique(t_mask)[0] or trial_id == np.unique(t_mask)[-1]:
-                    # The first and last trials have to be treated differently: traces are circulated in-trial
-                    shift.append(np.roll(curr_trace, d, axis=1))
-                else:
-                    # For all other trials, we shift them together with the previous and next trial
-                    prev_trial = data[:, t_mask == trial_id - 1]
-                    next_trial = data[:, t_mask == trial_id + 1]
-                    # Make the previous, current and next trials into one array
-                    neighbor_trials = np.hstack((prev_trial, curr_trace, next_trial))
-                    # Roll that array and take the values at the indices of the current trial
-                    shift.append(np.roll(neighbor_trials, d, axis=1)[:, prev_trial.shape[1]:-next_trial.shape[1]])
-
-                # Add entries of bin_frame_counts and trial_mask for accepted trials
-                bin_f_counts.append(occupancy[rel_idx])
-                trial_mask_accepted.append(np.array([rel_idx] * curr_trace.shape[1], dtype=int))
-
-            # The binning function requires the whole session in one row, so we stack the single-trial-arrays
-            shift = np.hstack(shift)
-            trial_mask_accepted = np.hstack(trial_mask_accepted)
+    def update_upper_tail(tail: np.ndarray, values: np.ndarray, k: int) -> np.ndarray:
+        """
+        Keeps the k largest values of every row, so that high percentiles of a distribution can be computed exactly
+        without storing all its samples.
 
-            bin_shift = bin_activity_to_vr(shift, trial_mask_accepted, dummy_running_masks, bin_f_counts, fr)
-            shuffle_data[shuff] = bin_shift
+        Args:
+            tail: Largest values found so far, with shape (n_rows, <=k).
+            values: New samples with shape (n_rows, n_samples).
+            k: Number of values that are kept per row.
 
-        return shuffle_data
+        Returns:
+            Numpy array with shape (n_rows, min(k, n_total)) with the (unsorted) k largest values of every row.
+        """
+        merged = np.hstack((tail, values))
+        if merged.shape[1] <= k:
+            return merged
+        return np.partition(merged, merged.shape[1] - k, axis=1)[:, -k:]
 
     n_bin = len(bin_frame_count[0])
+    n_cells = len(traces)
 
-    ### SPATIAL INFORMATION ###
-    # Compute SI of real data
-    print('\tComputing spatial information...(1/3)')
+    # Compute SI and stability of real data
+    print('\tComputing spatial information and within-session stability of real data...')
     real_si = compute_spatial_info(traces, bin_frame_count, SIGMA_GAUSS)
-
-    # Perform circular shuffling and get SI of shuffled data
-    shuffled_data = circular_shuffle(data=deconv, t_mask=tr_mask, r_mask=run_masks, occupancy=bin_frame_count,
-                                     num_bins=n_bin, n_iter=N_ITER, fr=frame_rate)
-    shuffles = np.zeros((shuffled_data.shape[0], shuffled_data.shape[1])) * np.nan
-    for i, shuffle in enumerate(shuffled_data):
-        shuffles[i] = compute_spatial_info(shuffle, bin_frame_count, SIGMA_GAUSS)
-
-    # Find percentile -> SI of how many shuffles were higher than the real SI
-    si_percs = np.sum(shuffles > real_si[None, :], axis=0) / N_ITER
-
-    ### WITHIN-SESSION STABILITY ###
-    # Compute stability of real data
-    print('\tComputing within-session stability...(2/3)')
     real_stab = compute_within_session_stability(act_map=traces, sigma=SIGMA_GAUSS)
 
-    # Perform circular shuffling and get stability of shuffled data
-    shuffled_data = circular_shuffle(data=deconv, t_mask=tr_mask, r_mask=run_masks, occupancy=bin_frame_count,
-                                     num_bins=n_bin, n_iter=N_ITER, fr=frame_rate)
-    shuffle_stab = np.zeros((shuffled_data.shape[0], shuffled_data.shape[1])) * np.nan
-    for i, shuffle in enumerate(shuffled_data):
-        shuffle_stab[i] = compute_within_session_stability(shuffle, SIGMA_GAUSS)
-
-    # Find percentile -> stability of how many shuffles were higher than the real stability
-    stab_perc = np.sum(shuffle_stab > real_stab[None, :], axis=0) / N_ITER
-
-    ### PLACE FIELD ACTIVITY ###
-    # Create shuffled dataset again
-    print('\tCheck for significant place fields...(3/3)')
-    shuffled_data = circular_shuffle(data=deconv, t_mask=tr_mask, r_mask=run_masks, occupancy=bin_frame_count,
-                                     num_bins=n_bin, n_iter=N_ITER, fr=frame_rate)
-    # Average data across trials
-    shuffled_data = np.mean(shuffled_data, axis=3)
-    # Get 95th percentile for each neuron's binned activity across shuffles
-    perc95 = np.percentile(shuffled_data, 95, axis=(0, 2))
+    # The 95th percentile (linear interpolation) of N trial-averaged shuffled values per cell only depends on the
+    # order statistics at and above position floor(0.95 * (N-1)), so only these have to be kept during shuffling.
+    n_samples = N_ITER * n_bin
+    perc_pos = 0.95 * (n_samples - 1)
+    n_tail = n_samples - int(np.floor(perc_pos))
+
+    si_count = np.zeros(n_cells)
+    stab_count = np.zeros(n_cells)
+    shuffle_tail = np.zeros((n_cells, 0))
+    tail_has_nan = np.zeros(n_cells, dtype=bool)
+
+    # One stream of shuffled data is used for all three criteria (SI, stability and place fields)
+    print(f'\tShuffling data ({N_ITER} iterations in chunks of {SHUFFLE_CHUNK_SIZE})...')
+    for shuffled_data in circular_shuffle(data=deconv, t_mask=tr_mask, r_mask=run_masks, occupancy=bin_frame_count,
+                                          num_bins=n_bin, n_iter=N_ITER, fr=frame_rate, chunk_size=SHUFFLE_CHUNK_SIZE):
+        # SPATIAL INFORMATION: count shuffles with a higher SI than the real SI
+        shuffle_si = compute_spatial_info(shuffled_data, bin_frame_count, SIGMA_GAUSS)
+        si_count += np.sum(shuffle_si > real_si[None, :], axis=0)
+
+        # WITHIN-SESSION STABILITY: count shuffles with a higher stability than the real stability
+        shuffle_stab = compute_within_session_stability(shuffled_data, SIGMA_GAUSS)
+        stab_count += np.sum(shuffle_stab > real_stab[None, :], axis=0)
+
+        # PLACE FIELD ACTIVITY: keep upper tail of each neuron's trial-averaged binned activity across shuffles
+        shuffled_mean = np.mean(shuffled_data, axis=3).transpose((1, 0, 2)).reshape(n_cells, -1)
+        tail_has_nan |= np.any(np.isnan(shuffled_mean), axis=1)
+        shuffle_tail = update_upper_tail(shuffle_tail, shuffled_mean, n_tail)
+
+    # Find percentile -> SI/stability of how many shuffles were higher than the real SI/stability
+    si_percs = si_count / N_ITER
+    stab_perc = stab_count / N_ITER
+
+    # Get 95th percentile for each neuron's binned activity across shuffles (same as np.percentile(..., 95))
+    print('\tCheck for significant place fields...')
+    shuffle_tail = np.sort(shuffle_tail, axis=1)
+    if n_tail > 1:
+        perc95 = shuffle_tail[:, 0] + (shuffle_tail[:, 1] - shuffle_tail[:, 0]) * (perc_pos - np.floor(perc_pos))
+    else:
+        perc95 = shuffle_tail[:, 0]
+    perc95[tail_has_nan] = np.nan
     # Find bins with higher activity than perc95
     above_95 = np.mean(traces, axis=2) >= perc95[:, None]
     active_bin_coords = np.where(above_95)
@@ -576,18 +696,7 @@ def compute_pvc_contexts(act_a, act_b):
     mean_act_a = np.mean(act_a, axis=2)
     mean_act_b = np.mean(act_b, axis=2)
 
-    pvc_vals = np.zeros((mean_act_a.shape[1], mean_act_a.shape[1]))
-    for a, pos_a in enumerate(mean_act_a.T):
-        for b, pos_b in enumerate(mean_act_b.T):
-            pvc_xy_num = pvc_xy_den_term1 = pvc_xy_den_term2 = 0
-            for neuron in range(mean_act_a.shape[0]):   # Summarize across neurons
-                pvc_xy_num += pos_a[neuron] * pos_b[neuron]
-                pvc_xy_den_term1 += pos_a[neuron] * pos_a[neuron]
-                pvc_xy_den_term2 += pos_b[neuron] * pos_b[neuron]
-            pvc_xy = pvc_xy_num / (np.sqrt(pvc_xy_den_term1 * pvc_xy_den_term2))
-            pvc_vals[a, b] = pvc_xy
-
-    return pvc_vals
+    return pvc_kernel.pvc_matrix(mean_act_a.T, mean_act_b.T)
 
 
 def run_context_specific(curr_decon: np.ndarray, curr_trial_mask: np.ndarray, curr_running_mask: list,
@@ -657,32 +766,71 @@ def save_results(sess_dir, result_dict, suffix=None):
             np.save(os.path.join(sess_dir, 'pvc_context_place.npy'), result_dict['pvc_context_place'], allow_pickle=False)
 
 
-def run_pipeline() -> None:
+def is_session_processed(sess_dir: Path) -> bool:
     """
-    Main function that runs all functions for the spatial information pipeline in order. This function can be called
-    by other code to incorporate the script into an existing pipeline.
+    Check whether the results of a session are up-to-date, which is the case if all result files of the whole session
+    (see save_results()) exist and are newer than the CNM file and all merged_behavior.txt files.
+
+    Args:
+        sess_dir: Absolute path of the session directory.
+
+    Returns:
+        True if the session does not have to be processed again.
     """
+    out_files = [os.path.join(sess_dir, file) for file in SESSION_OUTPUTS]
+    in_files = [os.path.join(sess_dir, 'cnm_results.hdf5')] + get_behavior_files(sess_dir)
+    if not all(os.path.isfile(file) for file in out_files + in_files[:1]):
+        return False
+    return min(os.path.getmtime(file) for file in out_files) > max(os.path.getmtime(file) for file in in_files)
 
-    # Ask user for location of session to be processed
-    session_dir = get_session_dir()
-    print(f'Starting analysis on {session_dir}...')
 
+def prepare_session(sess_dir: Path) -> dict:
+    """
+    Load the data of a session and perform the deconvolution with CASCADE. This is the first part of the pipeline,
+    which has to run in the process that holds the CASCADE models.
+
+    Args:
+        sess_dir: Absolute path of the session directory.
+
+    Returns:
+        Dictionary with the behavior arrays, trial mask, deconvolved traces and frame rate of the session. Can be
+        passed to analyse_session() as keyword arguments.
+    """
     # Load cnm and behavioral data
-    cnm, behavior = load_data(session_dir)
+    cnm, behavior = load_data(sess_dir)
 
     # Split traces into trials
     trial_mask = get_trial_mask(cnm, behavior)
 
-    # Filter out stationary frames and align imaging frames with VR position
-    running_mask, bf_count = align_frames_with_vr(behavior, trial_mask)
-
     # Perform deconvolution with Peter's CASCADE on the dF/F traces from CaImAn
     decon = run_cascade(cnm.estimates.F_dff)
 
+    return dict(behavior=behavior, trial_mask=trial_mask, decon=decon, framerate=cnm.params.data['fr'])
+
+
+def analyse_session(sess_dir: Path, behavior: list, trial_mask: np.ndarray, decon: np.ndarray,
+                    framerate: float) -> dict:
+    """
+    Bin the deconvolved traces, compute spatial information, place cells and PVCs of all contexts of a session and
+    save the results. This is the second part of the pipeline that does not need CASCADE and can run in any process.
+
+    Args:
+        sess_dir: Absolute path of the session directory.
+        behavior: List of behavior arrays, from load_data().
+        trial_mask: 1D array with length n_frames_in_session, from get_trial_mask().
+        decon: Deconvolved traces with shape (n_neurons, n_frames_in_session), from run_cascade().
+        framerate: Frame rate of the recording, in Hz.
+
+    Returns:
+        Dictionary with results of all contexts together, from run_context_specific().
+    """
+    # Filter out stationary frames and align imaging frames with VR position
+    running_mask, bf_count = align_frames_with_vr(behavior, trial_mask)
+
     bin_act_maps = []  # Binned activity maps have to be stored for PVC cross-context analysis
 
     # Check if there are different contexts in this session
-    subfolders = glob((os.path.join(session_dir.as_posix(), '*\\')))
+    subfolders = glob((os.path.join(sess_dir.as_posix(), '*\\')))
     if len(subfolders) > 1:
         # Count TIFF files
         n_trials = [len(glob(os.path.join(subdir, '*\\*.tif'))) for subdir in subfolders]
@@ -709,7 +857,7 @@ def run_pipeline() -> None:
                                            curr_trial_mask,
                                            list(np.asarray(running_mask)[con_masks == con]),
                                            list(np.asarray(bf_count)[con_masks == con]),
-                                           cnm.params.data['fr'])
+                                           framerate)
             results['decon'] = decon[:, np.isin(trial_mask, np.where(con_masks == con)[0])]
 
             bin_act_maps.append(results['bin_spikes'])  # Store spatial activity map for later cross-context PVC
@@ -719,7 +867,7 @@ def run_pipeline() -> None:
 
     # Afterwards, process all contexts together
     print('Processing all contexts...')
-    results = run_context_specific(decon, trial_mask, running_mask, bf_count, cnm.params.data['fr'])
+    results = run_context_specific(decon, trial_mask, running_mask, bf_count, framerate)
 
     # Compute PVC between contexts
     if len(bin_act_maps) == 2:
@@ -731,11 +879,160 @@ def run_pipeline() -> None:
         print(f'Found {len(bin_act_maps)}, not 2 contexts. PVC across context skipped.')
 
     # Save data in the session directory
-    save_results(sess_dir=session_dir, result_dict=results)
+    save_results(sess_dir=sess_dir, result_dict=results)
+
+    return results
+
+
+def _analyse_session_worker(sess_dir: Path, session_data: dict, seed: Optional[np.random.SeedSequence] = None) -> dict:
+    """
+    Run analyse_session() in a worker process. Errors are caught and reported, so that one faulty session does not
+    stop a batch.
+
+    Args:
+        sess_dir: Absolute path of the session directory.
+        session_data: Output from prepare_session().
+        seed: Optional, seed of the global NumPy random state for the shuffles of this session. Forked worker
+            processes inherit the same random state, so every session processed in a pool gets its own seed.
+
+    Returns:
+        Dictionary with the status, duration and number of (place) cells of the session.
+    """
+    report = dict(status='done', n_cells=len(session_data['decon']), n_place_cells=0, duration_analysis=0.0, error='')
+    start = timer()
+    if seed is not None:
+        np.random.seed(seed.generate_state(4))
+    try:
+        results = analyse_session(sess_dir, **session_data)
+        report['n_place_cells'] = int(np.sum(results['data']['is_pc']))
+    except Exception as ex:
+        report['status'] = 'failed'
+        report['error'] = f'{type(ex).__name__}: {ex}'
+        print(f'Analysis of session {sess_dir} failed:\n{traceback.format_exc()}')
+    report['duration_analysis'] = timer() - start
+    return report
+
+
+def run_batch(sessions: Union[str, List[str]], n_jobs: Optional[int] = 1, overwrite: bool = False,
+              report_path: Optional[str] = None) -> pd.DataFrame:
+    """
+    Headless version of run_pipeline() that processes many sessions. Deconvolution with CASCADE runs in this
+    process, session by session, so that tensorflow and the CASCADE models are loaded in only one process. Deconvolved
+    sessions are then analysed (binning, shuffling, saving) in n_jobs parallel worker processes while the next
+    session is deconvolved.
+
+    Args:
+        sessions: Session directories, either as a list of paths or glob patterns, or a single glob pattern.
+        n_jobs: Number of worker processes for the analysis. None uses all CPU cores, 1 runs everything in this process.
+        overwrite: If False, sessions whose results are newer than their CNM and behavior files are skipped.
+        report_path: Optional, path of a .csv file where the summary table of the batch is saved.
+
+    Returns:
+        Pandas DataFrame with one row per session with the status, runtimes (in seconds) and number of (place) cells.
+    """
+    if isinstance(sessions, str):
+        sessions = [sessions]
+    sess_dirs = []
+    for pattern in sessions:
+        matches = sorted(path for path in glob(str(pattern)) if os.path.isdir(path))
+        if len(matches) == 0:
+            print(f'No session directory found at {pattern}.')
+        sess_dirs.extend(matches)
+    sess_dirs = [Path(sess) for sess in dict.fromkeys(sess_dirs)]
+    print(f'Found {len(sess_dirs)} sessions.')
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    # The pool is started before tensorflow is imported by CASCADE, so that worker processes do not inherit it
+    pool = multiprocessing.Pool(min(n_jobs, len(sess_dirs))) if n_jobs > 1 and len(sess_dirs) > 1 else None
+
+    reports = {}
+    pending = []
+    # Independent random streams for the shuffles of every session analysed in a worker
+    seeds = dict(zip(sess_dirs, np.random.SeedSequence().spawn(len(sess_dirs))))
+    try:
+        for sess_dir in sess_dirs:
+            reports[sess_dir] = dict(session=str(sess_dir), status='skipped', n_cells=0, n_place_cells=0,
+                                     duration_cascade=0.0, duration_analysis=0.0, error='')
+            if not overwrite and is_session_processed(sess_dir):
+                print(f'Results of {sess_dir} are up-to-date, skipping session.')
+                continue
+
+            print(f'Starting analysis on {sess_dir}...')
+            start = timer()
+            try:
+                session_data = prepare_session(sess_dir)
+            except Exception as ex:
+                reports[sess_dir].update(status='failed', error=f'{type(ex).__name__}: {ex}')
+                print(f'Deconvolution of session {sess_dir} failed:\n{traceback.format_exc()}')
+                continue
+            finally:
+                reports[sess_dir]['duration_cascade'] = timer() - start
+
+            if pool is None:
+                reports[sess_dir].update(_analyse_session_worker(sess_dir, session_data))
+            else:
+                # Limit the number of deconvolved sessions that wait for a worker to keep memory usage bounded
+                if len(pending) >= 2 * n_jobs:
+                    done_dir, result = pending.pop(0)
+                    reports[done_dir].update(result.get())
+                pending.append((sess_dir, pool.apply_async(_analyse_session_worker,
+                                                           (sess_dir, session_data, seeds[sess_dir]))))
+
+        for done_dir, result in pending:
+            reports[done_dir].update(result.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report = pd.DataFrame(list(reports.values()), columns=['session', 'status', 'n_cells', 'n_place_cells',
+                                                           'duration_cascade', 'duration_analysis', 'error'])
+    if report_path is not None:
+        report.to_csv(report_path, index=False)
+
+    n_failed = np.sum(report['status'] == 'failed')
+    print(f'\nBatch done! {np.sum(report["status"] == "done")} sessions processed, '
+          f'{np.sum(report["status"] == "skipped")} skipped, {n_failed} failed.')
+    if n_failed > 0:
+        print(report.loc[report['status'] == 'failed', ['session', 'error']])
+    return report
+
+
+def run_pipeline(session_dir: Optional[Path] = None) -> None:
+    """
+    Main function that runs all functions for the spatial information pipeline in order. This function can be called
+    by other code to incorporate the script into an existing pipeline.
+
+    Args:
+        session_dir: Optional, absolute path of the session directory. If None, the user is asked for it in a dialog.
+    """
+
+    # Ask user for location of session to be processed
+    if session_dir is None:
+        session_dir = get_session_dir()
+    session_dir = Path(session_dir)
+    print(f'Starting analysis on {session_dir}...')
+
+    analyse_session(session_dir, **prepare_session(session_dir))
 
     print('Done!')
 
 
 if __name__ == '__main__':
-    # If the script is run from the command line, run the whole pipeline
-    run_pipeline()
+    parser = argparse.ArgumentParser(description='Compute spatial information and place cells of imaging sessions. '
+                                                 'Without sessions, a session directory is chosen in a dialog.')
+    parser.add_argument('sessions', nargs='*', help='Session directories or glob patterns of session directories')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel worker processes for analysis')
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Process sessions with up-to-date results')
+    parser.add_argument('-r', '--report', type=str, default='compute_si_summary.csv',
+                        help='Path of the .csv file where the summary table is saved')
+    args = parser.parse_args()
+
+    if len(args.sessions) > 0:
+        # Headless batch processing of all given sessions
+        run_batch(args.sessions, n_jobs=args.jobs, overwrite=args.overwrite, report_path=args.report)
+    else:
+        # If the script is run without arguments, run the whole pipeline for one session
+        run_pipeline()
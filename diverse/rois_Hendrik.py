@@ -26,6 +26,7 @@ from skimage.morphology import remove_small_objects, remove_small_holes, dilatio
 import scipy
 from scipy import ndimage as ndi
 from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 import shutil
 from skimage.filters import sobel
 from skimage.morphology import watershed
@@ -401,6 +402,64 @@ def nf_match_neurons_in_binary_masks(masks_gt, masks_comp, thresh_cost=.7, min_d
             logging.warning(e)
     return idx_tp_gt, idx_tp_comp, idx_fn_gt, idx_fp_comp, performance
 
+def get_remap_grid(template1, template2, dims, use_opt_flow=True):
+    """
+    Computes the pixel maps that align images of session 2 to the template of session 1 (used with cv2.remap). The
+    templates are normalized in-place.
+
+    Args:
+        template1: ndarray dims
+            template from session 1
+
+        template2: ndarray dims
+            template from session 2
+
+        dims: list or tuple
+            dimensionality of the FOV
+
+        use_opt_flow: bool
+            use dense optical flow to align templates
+
+    Returns:
+        x_remap, y_remap: ndarray dims (float32)
+            for every pixel of session 1, the x and y coordinates of the source pixel in session 2
+
+    """
+    x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
+                np.float32), np.arange(0., dims[0]).astype(np.float32))
+
+    template1 -= template1.min()
+    template1 /= template1.max()
+    template2 -= template2.min()
+    template2 /= template2.max()
+
+    if use_opt_flow:
+        template1_norm = np.uint8(template1*(template1 > 0)*255)
+        template2_norm = np.uint8(template2*(template2 > 0)*255)
+        flow = cv2.calcOpticalFlowFarneback(np.uint8(template1_norm*255),
+                                            np.uint8(template2_norm*255),
+                                            None,0.5,3,128,3,7,1.5,0)
+        x_remap = (flow[:,:,0] + x_grid).astype(np.float32) 
+        y_remap = (flow[:,:,1] + y_grid).astype(np.float32)
+
+    else:
+        template2, shifts, _, xy_grid = tile_and_correct(template2, template1 - template1.min(),
+                                                         [int(
+                                                             dims[0] / 4), int(dims[1] / 4)], [16, 16], [10, 10],
+                                                         add_to_movie=template2.min(), shifts_opencv=True)
+
+        dims_grid = tuple(np.max(np.stack(xy_grid, axis=0), axis=0) -
+                          np.min(np.stack(xy_grid, axis=0), axis=0) + 1)
+        _sh_ = np.stack(shifts, axis=0)
+        shifts_x = np.reshape(_sh_[:, 1], dims_grid,
+                              order='C').astype(np.float32)
+        shifts_y = np.reshape(_sh_[:, 0], dims_grid,
+                              order='C').astype(np.float32)
+
+        x_remap = (-np.resize(shifts_x, dims) + x_grid).astype(np.float32)
+        y_remap = (-np.resize(shifts_y, dims) + y_grid).astype(np.float32)
+    return x_remap, y_remap
+
 def register_ROIs(A1, A2, dims, template1=None, template2=None, align_flag=True, 
                   D=None, max_thr = 0, use_opt_flow = True, thresh_cost=.7, 
                   max_dist=10, enclosed_thr=None, print_assignment=False, 
@@ -493,40 +552,8 @@ def register_ROIs(A1, A2, dims, template1=None, template2=None, align_flag=True,
     if template1 is None or template2 is None:
         align_flag = False
 
-    x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
-                np.float32), np.arange(0., dims[0]).astype(np.float32))
-
     if align_flag:  # first align ROIs from session 2 to the template from session 1
-        template1 -= template1.min()
-        template1 /= template1.max()
-        template2 -= template2.min()
-        template2 /= template2.max()
-
-        if use_opt_flow:
-            template1_norm = np.uint8(template1*(template1 > 0)*255)
-            template2_norm = np.uint8(template2*(template2 > 0)*255)
-            flow = cv2.calcOpticalFlowFarneback(np.uint8(template1_norm*255),
-                                                np.uint8(template2_norm*255),
-                                                None,0.5,3,128,3,7,1.5,0)
-            x_remap = (flow[:,:,0] + x_grid).astype(np.float32) 
-            y_remap = (flow[:,:,1] + y_grid).astype(np.float32)
-
-        else:
-            template2, shifts, _, xy_grid = tile_and_correct(template2, template1 - template1.min(),
-                                                             [int(
-                                                                 dims[0] / 4), int(dims[1] / 4)], [16, 16], [10, 10],
-                                                             add_to_movie=template2.min(), shifts_opencv=True)
-
-            dims_grid = tuple(np.max(np.stack(xy_grid, axis=0), axis=0) -
-                              np.min(np.stack(xy_grid, axis=0), axis=0) + 1)
-            _sh_ = np.stack(shifts, axis=0)
-            shifts_x = np.reshape(_sh_[:, 1], dims_grid,
-                                  order='C').astype(np.float32)
-            shifts_y = np.reshape(_sh_[:, 0], dims_grid,
-                                  order='C').astype(np.float32)
-
-            x_remap = (-np.resize(shifts_x, dims) + x_grid).astype(np.float32)
-            y_remap = (-np.resize(shifts_y, dims) + y_grid).astype(np.float32)
+        x_remap, y_remap = get_remap_grid(template1, template2, dims, use_opt_flow=use_opt_flow)
 
         A_2t = np.reshape(A2, dims + (-1,), order='F').transpose(2, 0, 1)
         A2 = np.stack([cv2.remap(img.astype(np.float32), x_remap,
@@ -631,12 +658,14 @@ def register_ROIs(A1, A2, dims, template1=None, template2=None, align_flag=True,
 
 def register_multisession(A, dims, templates = [None], align_flag=True, 
                           max_thr = 0, use_opt_flow = True, thresh_cost=.7, 
-                          max_dist=10, enclosed_thr=None):
+                          max_dist=10, enclosed_thr=None, mode='sequential', dview=None):
     """
     Register ROIs across multiple sessions using an intersection over union metric
     and the Hungarian algorithm for optimal matching. Registration occurs by 
     aligning session 1 to session 2, keeping the union of the matched and 
     non-matched components to register with session 3 and so on.
+    With mode='pairwise', all pairs of sessions are registered independently
+    and matched globally instead, see register_multisession_pairwise.
 
     Args:
         A: list of ndarray or csc_matrix matrices # pixels x # of components
@@ -667,6 +696,13 @@ def register_multisession(A, dims, templates = [None], align_flag=True,
             if not None set distance to at most the specified value when ground 
             truth is a subset of inferred
 
+        mode: string
+            'sequential' (grow a union of ROIs one session at a time) or 
+            'pairwise' (register all pairs of sessions, see register_multisession_pairwise)
+
+        dview: multiprocessing or ipyparallel object
+            used to register session pairs in parallel (only for mode='pairwise')
+
     Returns:
         A_union: csc_matrix # pixels x # of total distinct components
             union of all kept ROIs 
@@ -681,6 +717,13 @@ def register_multisession(A, dims, templates = [None], align_flag=True,
 
     """
 
+    if mode == 'pairwise':
+        return register_multisession_pairwise(A, dims, templates=templates, align_flag=align_flag, max_thr=max_thr,
+                                              use_opt_flow=use_opt_flow, thresh_cost=thresh_cost, max_dist=max_dist,
+                                              enclosed_thr=enclosed_thr, dview=dview)
+    elif mode != 'sequential':
+        raise Exception('Registration mode {} not recognized. Use "sequential" or "pairwise".'.format(mode))
+
     n_sessions = len(A)
     templates = list(templates)
     if len(templates) == 1:
@@ -719,6 +762,235 @@ def register_multisession(A, dims, templates = [None], align_flag=True,
 
     return A_union, assignments, matchings
 
+def remap_sparse(A, x_remap, y_remap, dims):
+    """
+    Aligns all components of a sparse matrix with the pixel maps from get_remap_grid. Nearest neighbour interpolation
+    only moves pixel values, so the remapping is computed once with cv2.remap on an image of pixel indices and then
+    applied to all components as one sparse pixel selection matrix.
+
+    Args:
+        A: csc_matrix  # pixels x # of components
+            ROIs to align
+
+        x_remap, y_remap: ndarray dims
+            pixel maps, output of get_remap_grid
+
+        dims: list or tuple
+            dimensionality of the FOV
+
+    Returns:
+        A_remap: csc_matrix  # pixels x # of components
+            aligned ROIs (pixels mapped from outside the FOV are 0)
+
+    """
+    n_pixels = int(np.prod(dims))
+    pixel_idx = np.arange(n_pixels, dtype=np.float32).reshape(dims, order='F')
+    source = cv2.remap(pixel_idx, x_remap, y_remap, cv2.INTER_NEAREST,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+    source = np.round(source.reshape(-1, order='F')).astype(int)
+    target = np.where(source >= 0)[0]
+    selection = scipy.sparse.csc_matrix((np.ones(len(target)), (target, source[target])),
+                                        shape=(n_pixels, n_pixels))
+    return scipy.sparse.csc_matrix(selection.dot(scipy.sparse.csc_matrix(A)))
+
+def threshold_sparse(A, max_thr=0):
+    """
+    Sparse version of the thresholding in register_ROIs: pixels of each component that are not larger than max_thr
+    times the maximum of the component are removed.
+
+    Args:
+        A: ndarray or csc_matrix  # pixels x # of components
+            ROIs to threshold
+
+        max_thr: scalar
+            max threshold parameter before binarization
+
+    Returns:
+        A_thr: csc_matrix  # pixels x # of components
+            thresholded ROIs
+
+    """
+    A = scipy.sparse.csc_matrix(A, copy=True)
+    col_max = A.max(axis=0).toarray().ravel()
+    data_col = np.repeat(np.arange(A.shape[-1]), np.diff(A.indptr))
+    A.data[A.data <= max_thr * col_max[data_col]] = 0
+    A.eliminate_zeros()
+    return A
+
+def register_session_pair(pars):
+    """
+    Registers the ROIs of two sessions without densifying the footprints, used by register_multisession_pairwise.
+    ROIs of session 2 are aligned to the template of session 1 before matching.
+
+    Args:
+        pars: list
+            A1, A2, dims, template1, template2, align_flag, max_thr, use_opt_flow, thresh_cost, max_dist,
+            enclosed_thr (see register_ROIs) and return_aligned (bool, whether the aligned ROIs of session 2 are
+            returned)
+
+    Returns:
+        matched_ROIs1, matched_ROIs2: ndarray
+            indices of matched ROIs from session 1 and session 2
+
+        costs: ndarray
+            distance (1 - intersection over union) of every match
+
+        A2: csc_matrix or None
+            thresholded ROIs from session 2 aligned to session 1 (None if return_aligned is False)
+
+    """
+    (A1, A2, dims, template1, template2, align_flag, max_thr, use_opt_flow, thresh_cost, max_dist, enclosed_thr,
+     return_aligned) = pars
+
+    if align_flag and template1 is not None and template2 is not None:
+        # copies, because the templates are normalized in-place
+        x_remap, y_remap = get_remap_grid(template1.copy(), template2.copy(), dims, use_opt_flow=use_opt_flow)
+        A2 = remap_sparse(A2, x_remap, y_remap, dims)
+
+    A1 = threshold_sparse(A1, max_thr)
+    A2 = threshold_sparse(A2, max_thr)
+
+    cm_1 = com(A1, dims[0], dims[1])
+    cm_2 = com(A2, dims[0], dims[1])
+    D = distance_masks([A1, A2], [cm_1, cm_2], max_dist, enclosed_thr=enclosed_thr)
+
+    matches, costs = find_matches(D)
+    costs = np.array(costs[0])
+    idx_tp = np.where(costs < thresh_cost)[0]
+    return matches[0][0][idx_tp], matches[0][1][idx_tp], costs[idx_tp], A2 if return_aligned else None
+
+def register_multisession_pairwise(A, dims, templates=[None], align_flag=True, max_thr=0, use_opt_flow=True,
+                                   thresh_cost=.7, max_dist=10, enclosed_thr=None, dview=None):
+    """
+    Register ROIs across multiple sessions without sequential union growth. Every pair of sessions is registered once
+    (in parallel if dview is given, footprints stay sparse), and the pairwise matches of the Hungarian algorithm are
+    clustered globally: starting with the lowest cost, two matched ROIs are assigned to the same component unless this
+    would put two ROIs of the same session into one component. The result does therefore not depend on the order in
+    which sessions are added. ROIs of earlier sessions are aligned to later sessions, and A_union is in the coordinates
+    of the last session, like in register_multisession.
+
+    Args:
+        A: list of ndarray or csc_matrix matrices # pixels x # of components
+           ROIs from each session
+
+        dims: list or tuple
+            dimensionality of the FOV
+
+        templates: list of ndarray matrices of size dims
+            templates from each session
+
+        align_flag: bool
+            align the templates before matching
+
+        max_thr: scalar
+            max threshold parameter before binarization
+
+        use_opt_flow: bool
+            use dense optical flow to align templates
+
+        thresh_cost: scalar
+            maximum distance considered
+
+        max_dist: scalar
+            max distance between centroids
+
+        enclosed_thr: float
+            if not None set distance to at most the specified value when ground
+            truth is a subset of inferred
+
+        dview: multiprocessing or ipyparallel object
+            used to register session pairs in parallel
+
+    Returns:
+        A_union: csc_matrix # pixels x # of total distinct components
+            union of all kept ROIs (each component is represented by its ROI from the last session it appears in,
+            aligned to the last session)
+
+        assignments: ndarray int of size # of total distinct components x # sessions
+            element [i,j] = k if component k from session j is mapped to component
+            i in the A_union matrix. If there is no much the value is NaN
+
+        matchings: list of lists
+            matchings[i][j] = k means that component j from session i is represented
+            by component k in A_union
+
+    """
+    n_sessions = len(A)
+    templates = list(templates)
+    if len(templates) == 1:
+        templates = n_sessions*templates
+
+    if n_sessions <= 1:
+        raise Exception('number of sessions must be greater than 1')
+
+    A = [scipy.sparse.csc_matrix(a) for a in A]
+    last = n_sessions - 1
+
+    # register every pair of sessions once, ROIs of the earlier session are aligned to the later session
+    pairs = [(sess1, sess2) for sess2 in range(n_sessions) for sess1 in range(sess2)]
+    pars = [[A[sess2], A[sess1], dims, templates[sess2], templates[sess1], align_flag, max_thr, use_opt_flow,
+             thresh_cost, max_dist, enclosed_thr, sess2 == last] for sess1, sess2 in pairs]
+    if dview is not None:
+        if 'multiprocessing' in str(type(dview)):
+            res = dview.map_async(register_session_pair, pars).get(4294967)
+        else:
+            res = dview.map_sync(register_session_pair, pars)
+    else:
+        res = list(map(register_session_pair, pars))
+
+    # every ROI of every session is a node, matches are edges between nodes
+    offsets = np.cumsum([0] + [a.shape[-1] for a in A])
+    node_session = np.repeat(np.arange(n_sessions), np.diff(offsets))
+    edges = []
+    for (sess1, sess2), (mat_sess2, mat_sess1, costs, _) in zip(pairs, res):
+        edges += [(cost, offsets[sess1] + m1, offsets[sess2] + m2)
+                  for m1, m2, cost in zip(mat_sess1, mat_sess2, costs)]
+    edges.sort(key=lambda edge: edge[0])
+
+    # merge clusters of matched nodes (union-find), but never two clusters that contain ROIs of the same session
+    parent = np.arange(offsets[-1])
+    cluster_sessions = [{sess} for sess in node_session]
+
+    def find_root(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for _, node1, node2 in edges:
+        root1, root2 = find_root(node1), find_root(node2)
+        if root1 != root2 and not cluster_sessions[root1] & cluster_sessions[root2]:
+            parent[root2] = root1
+            cluster_sessions[root1] |= cluster_sessions[root2]
+
+    # number the components in order of their first appearance, as in the sequential registration
+    roots = np.array([find_root(node) for node in range(offsets[-1])], dtype=int)
+    _, first_node, union_idx = np.unique(roots, return_index=True, return_inverse=True)
+    rank = np.empty(len(first_node), dtype=int)
+    rank[np.argsort(first_node)] = np.arange(len(first_node))
+    union_idx = rank[union_idx]
+    n_union = len(first_node)
+
+    matchings = [union_idx[offsets[sess]:offsets[sess+1]].tolist() for sess in range(n_sessions)]
+    assignments = np.empty((n_union, n_sessions))*np.nan
+    for sess in range(n_sessions):
+        assignments[matchings[sess],sess] = range(len(matchings[sess]))
+
+    # ROIs of the union, taken from the last session each component appears in (aligned to the last session)
+    aligned = {sess1: r[3] for (sess1, sess2), r in zip(pairs, res) if sess2 == last}
+    aligned[last] = A[last]
+    latest_node = np.zeros(n_union, dtype=int)
+    np.maximum.at(latest_node, union_idx, np.arange(offsets[-1]))
+    latest_session = node_session[latest_node]
+    blocks, order = [], []
+    for sess in range(n_sessions):
+        comps = np.where(latest_session == sess)[0]
+        blocks.append(aligned[sess][:, latest_node[comps] - offsets[sess]])
+        order.append(comps)
+    A_union = scipy.sparse.hstack(blocks).tocsc()[:, np.argsort(np.concatenate(order))]
+
+    return A_union, assignments, matchings
+
 def extract_active_components(assignments, indices, only = True):
     """
     Computes the indices of components that were active in a specified set of 
@@ -768,11 +1040,13 @@ def norm_nrg(a_):
 def distance_masks(M_s, cm_s, max_dist, enclosed_thr=None):
     """
     Compute distance matrix based on an intersection over union metric. Matrix are compared in order,
-    with matrix i compared with matrix i+1
+    with matrix i compared with matrix i+1. Only pairs of components with centroids closer than max_dist (found with a
+    KD-tree) are compared, and their intersections are computed at once as a sparse product of the binarized masks.
+    All other pairs keep a distance of 1.
 
     Args:
         M_s: tuples of 1-D arrays
-            The thresholded A matrices (masks) to compare, output of threshold_components
+            The thresholded A matrices (masks) to compare, output of threshold_components. Masks are binarized (> 0)
 
         cm_s: list of list of 2-ples
             the centroids of the components in each M_s
@@ -795,56 +1069,53 @@ def distance_masks(M_s, cm_s, max_dist, enclosed_thr=None):
 
     for gt_comp, test_comp, cmgt_comp, cmtest_comp in zip(M_s[:-1], M_s[1:], cm_s[:-1], cm_s[1:]):
 
-        # todo : better with a function that calls itself
         logging.info('New Pair **')
-        # not to interfer with M_s
-        gt_comp = gt_comp.copy()[:, :]
-        test_comp = test_comp.copy()[:, :]
+        # binarized copies of the masks, not to interfer with M_s
+        gt_comp = (scipy.sparse.csc_matrix(gt_comp) > 0).astype(float)
+        test_comp = (scipy.sparse.csc_matrix(test_comp) > 0).astype(float)
 
         # the number of components for each
         nb_gt = np.shape(gt_comp)[-1]
         nb_test = np.shape(test_comp)[-1]
         D = np.ones((nb_gt, nb_test))
-
-        cmgt_comp = np.array(cmgt_comp)
-        cmtest_comp = np.array(cmtest_comp)
+        if nb_gt == 0 or nb_test == 0:
+            D_s.append(D)
+            continue
+
+        cmgt_comp = np.array(cmgt_comp, dtype=float)
+        cmtest_comp = np.array(cmtest_comp, dtype=float)
+
+        # candidate pairs: components whose centroids are closer than max_dist, found with a KD-tree
+        # (components with NaN centroids are never matched)
+        valid_gt = np.where(np.all(np.isfinite(cmgt_comp), axis=1))[0]
+        valid_test = np.where(np.all(np.isfinite(cmtest_comp), axis=1))[0]
+        if len(valid_gt) == 0 or len(valid_test) == 0:
+            D_s.append(D)
+            continue
+        neighbors = cKDTree(cmtest_comp[valid_test]).query_ball_point(cmgt_comp[valid_gt], max_dist)
+        idx_gt = np.repeat(valid_gt, [len(nb) for nb in neighbors])
+        idx_test = valid_test[np.concatenate([np.asarray(nb, dtype=int) for nb in neighbors])]
+        dist = np.linalg.norm(cmgt_comp[idx_gt] - cmtest_comp[idx_test], axis=1)
+        idx_gt, idx_test = idx_gt[dist < max_dist], idx_test[dist < max_dist]
+
+        # intersection of all pairs as one sparse product, union from the sizes of the components
+        intersection = np.asarray((gt_comp.T.dot(test_comp)).tocsr()[idx_gt, idx_test]).ravel()
+        size_gt = np.asarray(gt_comp.sum(axis=0)).ravel()
+        size_test = np.asarray(test_comp.sum(axis=0)).ravel()
+        union = size_gt[idx_gt] + size_test[idx_test]
+
+        # intersection is removed from union since union contains twice the overlaping area
+        # having the values in this format 0-1 is helpfull for the hungarian algorithm that follows
+        # if we don't have even a union this is pointless
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist_pairs = np.where(union > 0, 1 - 1. * intersection / (union - intersection), 1.)
         if enclosed_thr is not None:
-            gt_val = gt_comp.T.dot(gt_comp).diagonal()
-        for i in range(nb_gt):
-            # for each components of gt
-            k = gt_comp[:, np.repeat(i, nb_test)] + test_comp
-            # k is correlation matrix of this neuron to every other of the test
-            for j in range(nb_test):  # for each components on the tests
-                dist = np.linalg.norm(cmgt_comp[i] - cmtest_comp[j])
-                # we compute the distance of this one to the other ones
-                if dist < max_dist:
-                    # union matrix of the i-th neuron to the jth one
-                    union = k[:, j].sum()
-                    # we could have used OR for union and AND for intersection while converting
-                    # the matrice into real boolean before
-
-                    # product of the two elements' matrices
-                    # we multiply the boolean values from the jth omponent to the ith
-                    intersection = np.array(gt_comp[:, i].T.dot(
-                        test_comp[:, j]).todense()).squeeze()
-
-                    # if we don't have even a union this is pointless
-                    if union > 0:
-
-                        # intersection is removed from union since union contains twice the overlaping area
-                        # having the values in this format 0-1 is helpfull for the hungarian algorithm that follows
-                        D[i, j] = 1 - 1. * intersection / \
-                            (union - intersection)
-                        if enclosed_thr is not None:
-                            if intersection == gt_val[j] or intersection == gt_val[i]:
-                                D[i, j] = min(D[i, j], 0.5)
-                    else:
-                        D[i, j] = 1.
-
-                    if np.isnan(D[i, j]):
-                        raise Exception('Nan value produced. Error in inputs')
-                else:
-                    D[i, j] = 1
+            enclosed = (union > 0) & ((intersection == size_test[idx_test]) | (intersection == size_gt[idx_gt]))
+            dist_pairs[enclosed] = np.minimum(dist_pairs[enclosed], 0.5)
+
+        if np.any(np.isnan(dist_pairs)):
+            raise Exception('Nan value produced. Error in inputs')
+        D[idx_gt, idx_test] = dist_pairs
 
         D_s.append(D)
     return D_s